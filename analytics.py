@@ -0,0 +1,63 @@
+from typing import Optional
+
+import numpy as np
+
+# Metrics on the datasets export.py writes: dicts with an array per column in, dicts with an array per column out,
+# so results go into pandas.DataFrame as they are. Everything works on whole arrays, no Python loops over rows.
+
+
+def _groups(**keys: np.ndarray) -> tuple[dict[str, np.ndarray], np.ndarray]:
+    """Every distinct combination of keys, in order, as columns, and which one of them each row has."""
+    # Sorting the keys together is slow with strings, so number every key's values, and combine the numbers
+    values, codes = {}, 0
+    for name, key in keys.items():
+        values[name], inverse = np.unique(key, return_inverse=True)
+        codes = codes * len(values[name]) + inverse.ravel()
+    combinations, group = np.unique(codes, return_inverse=True)
+    columns = {}
+    for name in reversed(keys):
+        combinations, index = np.divmod(combinations, max(len(values[name]), 1))
+        columns[name] = values[name][index]
+    return {name: columns[name] for name in keys}, group.ravel()
+
+
+def vwap(trades: dict[str, np.ndarray], resolution: Optional[str] = None) -> dict[str, np.ndarray]:
+    """
+    VWAP and volume of every instrument, over all trades, or per period of resolution ('1s', '1m', '5m' like candles,
+    or any other NumPy datetime unit).
+    """
+    keys = {'instrument': trades['instrument']}
+    if resolution is not None:
+        keys['timestamp'] = trades['timestamp'].astype(f'datetime64[{resolution}]').astype(trades['timestamp'].dtype)
+    groups, group = _groups(**keys)
+    count = len(groups['instrument'])
+    volume = np.bincount(group, trades['amount'], count)
+    notional = np.bincount(group, trades['price'] * trades['amount'], count)
+    return {**groups, 'vwap': notional / volume, 'volume': volume.astype(np.int64)}
+
+
+def spread(book: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """Best bid and ask, the spread and the mid of every instrument in every book snapshot, NaN for an empty side."""
+    groups, group = _groups(sequence=book['sequence'], timestamp=book['timestamp'], instrument=book['instrument'])
+    buy, price = book['buy'], book['price'].astype(np.float64)
+    bid = np.full(len(groups['sequence']), -np.inf)
+    np.maximum.at(bid, group[buy], price[buy])
+    ask = np.full(len(groups['sequence']), np.inf)
+    np.minimum.at(ask, group[~buy], price[~buy])
+    bid[np.isinf(bid)] = np.nan
+    ask[np.isinf(ask)] = np.nan
+    return {**groups, 'bid': bid, 'ask': ask, 'spread': ask - bid, 'mid': (bid + ask) / 2}
+
+
+def volume_per_participant(trades: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """What every participant bought and sold of every instrument, and the cash that went in (+) or out (-) for it."""
+    # Every trade twice: once for the buyer, once for the seller, with a negative amount
+    bought = np.concatenate([trades['amount'], -trades['amount']])
+    prices = np.concatenate([trades['price'], trades['price']])
+    groups, group = _groups(participant_id=np.concatenate([trades['buyer'], trades['seller']]),
+                            instrument=np.concatenate([trades['instrument'], trades['instrument']]))
+    count = len(groups['participant_id'])
+    buys = np.bincount(group, np.maximum(bought, 0), count).astype(np.int64)
+    sells = np.bincount(group, np.maximum(-bought, 0), count).astype(np.int64)
+    return {**groups, 'trades': np.bincount(group, minlength=count), 'bought': buys, 'sold': sells,
+            'volume': buys + sells, 'cash': -np.bincount(group, bought * prices, count).astype(np.int64)}
@@ -1,107 +1,437 @@
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
-from fastapi import FastAPI, Depends, status, Request
+from fastapi import FastAPI, Body, Depends, Query, status, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
+from starlette.requests import HTTPConnection, Request
 
 from auth import User, get_user_for_token, HTTPException, admin
 from auth import create_authenticated_token, create_user
-from db_utils import db_cursor, query
-from engine import limit_order
-
+import db_utils
+from db_utils import db_read_cursor, get_pool, query, trace_request, DEFAULT_INSTRUMENT
+from engine import limit_order, limit_orders, cancel_orders, cancel_all_orders, amend_order, depth, engine_lock
+from engine import subscribe
+from engine import drop_book, mark_price, order_instrument
+from engine import transfer_cash, allocate_shares, distribute_dividend, add_earnings, add_instrument
+from candles import CandleStore
+from feed import MarketDataFeed
+from workers import get_worker
+from ratelimit import TokenBucketLimiter
+from tape import TapeReader, TradeTape, as_trade
+import capture
+import export
+import journal
+import metrics
+import positions
+
+from collections import defaultdict
+from concurrent.futures import Future
 from datetime import datetime
+import asyncio
+from itertools import islice
+import json
+import logging
+import math
 import os
-from typing import Literal
+from time import perf_counter
+from typing import Literal, Optional
 
-EPOCH = datetime.now()
 load_dotenv()
+logger = logging.getLogger(__name__)
 
-N_REQUESTS = 5
-N_SECONDS = 1
+MAX_BATCH_SIZE = 100
 
+# Token buckets per route group: order entry is everything that changes state, market data is everything else.
+# Both are keyed by IP. Order entry per IP is only a flood guard, the actual limit on trading is per participant.
+RATE_LIMITS = {
+    'order_entry': TokenBucketLimiter(rate=50, burst=50),
+    'market_data': TokenBucketLimiter(rate=20, burst=20),
+    'participant': TokenBucketLimiter(rate=5, burst=5),
+}
+if os.environ.get('DISABLE_RATE_LIMITS'):
+    RATE_LIMITS.clear()  # For load testing
 
-def rate_limit(request: Request, c=Depends(db_cursor)):
-    """Use ratelimit table to limit number of requests to n_requests per n_seconds."""
-    request_timestamp = (datetime.now() - EPOCH).total_seconds()
-    request_ip = request.client.host
 
-    requests_in_last_second = query(
-        c,
-        'select count(rowid) from ratelimit where ip=? and relative_timestamp >= ?',
-        (request_ip, request_timestamp - N_SECONDS)
-    )[0]['count(rowid)']
-    if requests_in_last_second >= N_REQUESTS:
+def check_rate_limit(group: str, key):
+    limiter = RATE_LIMITS.get(group)
+    if limiter is not None and not limiter.allow(key):
+        metrics.rate_limited.inc(group)
         raise HTTPException(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-            detail='Exceeded 5 requests per second, try again later.'
+            detail=f'Exceeded {limiter.rate:g} requests per second, try again later.',
+            headers={'Retry-After': str(math.ceil(limiter.wait(key)))}
         )
-    c.execute('insert into ratelimit(ip, relative_timestamp) values (?, ?)', (request_ip, request_timestamp))
-    c.execute('delete from ratelimit where ip = ? and relative_timestamp < ?', (request_ip, request_timestamp - 1))
-    c.connection.commit()
+
+
+def rate_limit(request: HTTPConnection):
+    """Limit the number of requests per IP. Doesn't touch the database. Websockets count as market data."""
+    group = 'order_entry' if request.scope.get('method', 'GET') != 'GET' else 'market_data'
+    check_rate_limit(group, request.client.host)
+
+
+def rate_limit_participant(user=Depends(get_user_for_token)):
+    """Limit order entry per participant, so traders sharing an IP don't share a limit."""
+    check_rate_limit('participant', user.participant_id)
 
 
 app = FastAPI(dependencies=[Depends(rate_limit)])
 
 
+@app.middleware('http')
+async def record_latency(request: Request, call_next):
+    start = perf_counter()
+    if db_utils.profiling:
+        with trace_request(f'{request.method} {request.url.path}'):
+            response = await call_next(request)
+    else:
+        response = await call_next(request)
+    # By route rather than by path, so /trades?after=1 and /trades?after=2 end up together
+    route = getattr(request.scope.get('route'), 'path', 'unmatched')
+    metrics.requests.observe(perf_counter() - start, request.method, route, response.status_code)
+    return response
+
+
+feed = MarketDataFeed()
+subscribe(feed.publish)
+candles = CandleStore()
+subscribe(candles.publish)
+# Written by whichever process matches, read by all of them
+trade_tape: Optional[TradeTape] = None
+trade_tape_reader = TapeReader(os.path.join(os.environ['TAPE_DIR'], 'trades')) if os.environ.get('TAPE_DIR') else None
+
+
+def instruments(c) -> list[str]:
+    return [symbol for symbol, *_ in c.execute('select symbol from instruments order by symbol')]
+
+
+def require_instrument(c, instrument: str):
+    if c.execute('select 1 from instruments where symbol=?', (instrument,)).fetchone() is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Unknown instrument {instrument}.')
+
+
+@app.on_event('startup')
+def recover_from_journal():
+    """
+    Bring the database up to date with this version (see db_utils.migrate) and catch the tables up with the journal,
+    then start capturing if CAPTURE_PATH is set, see capture.py, and writing the tape if TAPE_DIR is set, see tape.py.
+    With a sequencer, that's the one process that writes, so it does all that. Without one, we have to be the only
+    process, see db_utils.claim_writer.
+    """
+    if os.environ.get('SEQUENCER_ADDRESS'):
+        return
+    db_utils.claim_writer(os.environ.get('DB_LOCATION', ':memory:'))
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        with engine_lock:
+            db_utils.migrate(conn)
+            sequence = journal.recover(conn)
+            if sequence is not None:
+                drop_book(conn)
+                logger.info('Replayed the journal up to %s', sequence)
+            if os.environ.get('CAPTURE_PATH'):
+                capture.start(os.environ['CAPTURE_PATH'], conn)
+                logger.info('Capturing to %s', os.environ['CAPTURE_PATH'])
+            if os.environ.get('TAPE_DIR'):
+                global trade_tape
+                trade_tape = TradeTape(os.environ['TAPE_DIR'], os.environ.get('DB_LOCATION', ':memory:'))
+                trade_tape.catch_up(conn)
+                subscribe(trade_tape.publish)
+    finally:
+        pool.release(conn)
+
+
+@app.on_event('shutdown')
+def stop_capture():
+    capture.stop()
+    journal.close_snapshotters()
+    if trade_tape is not None:
+        trade_tape.close()
+
+
 @app.get('/')
 def home():
     return 'Welcome to the orderbook game!'
 
 
+@app.get('/metrics', response_class=PlainTextResponse)
+def get_metrics():
+    """Metrics of this process in the Prometheus text format."""
+    return PlainTextResponse(metrics.expose(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/instruments')
+def list_instruments(c=Depends(db_read_cursor)):
+    return instruments(c)
+
+
+@app.post('/instruments', status_code=201)
+def new_instrument(symbol: str, is_admin=Depends(admin)):
+    admin_change(get_worker(symbol).submit(add_instrument, symbol=symbol))
+    return symbol
+
+
 @app.get('/orderbook')
-def orderbook(c=Depends(db_cursor)):
-    book = query(c, 'select * from exchange')
+def orderbook(instrument: Optional[str] = None, c=Depends(db_read_cursor)):
+    if instrument is None:
+        book = query(c, 'select * from exchange')
+    else:
+        book = query(c, 'select * from exchange where instrument=?', (instrument,))
     return {'data': {
         'buy': [r for r in book if r['amount'] >= 0],
         'sell': [r for r in book if r['amount'] < 0],
     }}
 
 
+@app.get('/depth')
+def book_depth(instrument: str = DEFAULT_INSTRUMENT, levels: Optional[int] = Query(default=None, gt=0),
+               c=Depends(db_read_cursor)):
+    """Total amount and number of orders per price level, best price first, optionally only the best few levels."""
+    require_instrument(c, instrument)
+    return {'data': depth(c, levels, instrument)}
+
+
+@app.websocket('/feed')
+async def market_data_feed(websocket: WebSocket, since: Optional[int] = None):
+    """
+    Stream trades and price level changes, the ones of every commit in one message with its sequence number, which is
+    the same in every API process (see feed.py).
+    New clients get a snapshot of the depth of every instrument first.
+    A client that reconnects with the last sequence number it saw gets the messages it missed instead,
+    or a new snapshot if we don't have those anymore.
+    Clients that don't keep up get disconnected, and can reconnect the same way.
+    """
+    await websocket.accept()
+    pool = get_pool(read_only=True)
+    conn = pool.acquire()
+    try:
+        # Nothing gets published while we hold the engine lock, so the snapshot matches the sequence number
+        with engine_lock:
+            subscription, backlog, sequence = feed.subscribe(asyncio.get_running_loop(), since)
+            snapshot = None if backlog is not None else {
+                'type': 'snapshot',
+                'sequence': sequence,
+                'books': {instrument: depth(conn, instrument=instrument) for instrument in instruments(conn)}
+            }
+    finally:
+        pool.release(conn)
+
+    try:
+        for message in [snapshot] if backlog is None else backlog:
+            await websocket.send_json(message)
+        while True:
+            message = await subscription.queue.get()
+            if message is None:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason='Too slow, reconnect to resync.')
+                return
+            await websocket.send_json(message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        feed.unsubscribe(subscription)
+
+
+@app.get('/candles')
+def get_candles(instrument: str = DEFAULT_INSTRUMENT, resolution: Literal['1s', '1m', '5m'] = '1m',
+                limit: int = Query(default=100, gt=0), c=Depends(db_read_cursor)):
+    """Most recent OHLCV candles with their VWAP, oldest first, and the VWAP of every trade so far."""
+    if not candles.loaded:
+        with engine_lock:
+            if not candles.loaded:
+                candles.backfill(c)
+    return {'data': candles.get(resolution, limit, instrument), 'vwap': candles.vwap(instrument)}
+
+
 @app.get('/trades')
-def trades(c=Depends(db_cursor)):
-    return query(c, 'select * from log where event ->> \'type\' = \'trade\'')
+def trades(after: int = 0, limit: int = Query(default=100, gt=0, le=1000), instrument: Optional[str] = None,
+           since: Optional[datetime] = None, until: Optional[datetime] = None, c=Depends(db_read_cursor)):
+    """
+    Trades in the order they happened, at most `limit` at a time.
+    To get the next page, pass the sequence number of the last trade you got as `after`.
+    Optionally only trades in one instrument, and only trades with since <= timestamp < until.
+    """
+    if trade_tape_reader is not None and instrument is None and since is None and until is None:
+        # The tape finds `after` without a lookup. For one instrument or a time range the indexes on trades do better,
+        # the tape would have to go through every trade after `after` to find them.
+        return [as_trade(record) for record in islice(trade_tape_reader.records(after + 1), limit)]
+    conditions, data = ['sequence > ?'], [after]
+    if instrument is not None:
+        conditions.append('instrument = ?')
+        data.append(instrument)
+    if since is not None:
+        conditions.append('timestamp >= ?')
+        data.append(since)
+    if until is not None:
+        conditions.append('timestamp < ?')
+        data.append(until)
+    return query(
+        c,
+        f'select * from trades where {" and ".join(conditions)} order by sequence limit ?',
+        (*data, limit)
+    )
 
 
 @app.get('/earnings')
-def list_earnings(c=Depends(db_cursor)):
-    return query(c, 'select * from earnings order by timestamp desc')
+def list_earnings(instrument: Optional[str] = None, c=Depends(db_read_cursor)):
+    if instrument is None:
+        return query(c, 'select * from earnings order by timestamp desc')
+    return query(c, 'select * from earnings where instrument=? order by timestamp desc', (instrument,))
 
 
 @app.post('/earnings')
-def post_earnings(amount: int, c=Depends(db_cursor), is_admin=Depends(admin)):
-    c.execute('insert into earnings (amount, timestamp) values (?, ?)', (amount, datetime.now()))
-    c.connection.commit()
+def post_earnings(amount: int, instrument: str = DEFAULT_INSTRUMENT, c=Depends(db_read_cursor),
+                  is_admin=Depends(admin)):
+    require_instrument(c, instrument)
+    admin_change(get_worker(instrument).submit(add_earnings, instrument=instrument, amount=amount,
+                                                timestamp=str(datetime.now())))
+
+
+# The admin operations below are one statement each however many participants they touch, see engine.credit_cash
+# and friends, and commit once, so they're all or nothing and hold the write lock for as short as possible.
+class Transfer(BaseModel):
+    user_name: str
+    amount: int
+
+
+class Allocation(BaseModel):
+    user_name: str
+    stock: int
+
+
+def participant_amounts(c, amounts: list[tuple[str, int]]) -> list[tuple[int, int]]:
+    """(participant_id, total) for every user in a list of (user name, amount), or a 404 naming the unknown users."""
+    totals = defaultdict(int)
+    for user_name, amount in amounts:
+        totals[user_name] += amount
+    participants = dict(c.execute(
+        'select name, participant_id from auth where name in (select value from json_each(?))',
+        (json.dumps(list(totals)),)
+    ).fetchall())
+    unknown = [user_name for user_name in totals if user_name not in participants]
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Unknown user{"s" * (len(unknown) > 1)} {", ".join(unknown)}.')
+    return sorted((participants[user_name], total) for user_name, total in totals.items())
+
+
+def admin_change(future: Future):
+    """
+    Wait for an admin change handed to a matching worker, like orders are, see engine.transfer_cash.
+    With a sequencer, that's the sequencer, the one process that writes.
+    """
+    try:
+        return future.result()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def pay_out(c, amounts: list[tuple[str, int]]) -> dict:
+    """Add the amounts to the users' balances, returning the totals."""
+    transfers = participant_amounts(c, amounts)
+    admin_change(get_worker(DEFAULT_INSTRUMENT).submit(transfer_cash, transfers=transfers))
+    return {'recipients': len(transfers), 'total': sum(amount for _, amount in transfers)}
 
 
 @app.post('/send_cash')
-def send_cash(user_name: str, amount: int, c=Depends(db_cursor), is_admin=Depends(admin)):
-    c.execute(
-        'update accounts set balance = balance + ?'
-        'where participant_id=(select participant_id from users where name=?)',
-        (amount, user_name)
-    )
-    c.connection.commit()
+def send_cash(user_name: str, amount: int, c=Depends(db_read_cursor), is_admin=Depends(admin)):
+    return pay_out(c, [(user_name, amount)])
+
+
+@app.post('/send_cash/bulk')
+def send_cash_bulk(transfers: list[Transfer], c=Depends(db_read_cursor), is_admin=Depends(admin)):
+    """Send cash to many users at once. A user can appear more than once, and gets the sum."""
+    return pay_out(c, [(transfer.user_name, transfer.amount) for transfer in transfers])
+
+
+@app.post('/stock_allocation')
+def allocate_stock(allocations: list[Allocation], instrument: str = DEFAULT_INSTRUMENT, c=Depends(db_read_cursor),
+                   is_admin=Depends(admin)):
+    """Give (or with negative stock, take) shares to many users at once, say at the start of a game."""
+    require_instrument(c, instrument)
+    stock = participant_amounts(c, [(allocation.user_name, allocation.stock) for allocation in allocations])
+    admin_change(get_worker(instrument).submit(allocate_shares, instrument=instrument, allocations=stock))
+    return {'instrument': instrument, 'recipients': len(stock), 'stock': sum(amount for _, amount in stock)}
 
 
 @app.post('/stock_sale')
-def stock_sale(amount: int, price: int, c=Depends(db_cursor), is_admin=Depends(admin)):
-    limit_order(c, participant_id='0', price=price, amount=-amount, time_in_force='GTC')
-    c.connection.commit()
+def stock_sale(amount: int, price: int, instrument: str = DEFAULT_INSTRUMENT, c=Depends(db_read_cursor),
+               is_admin=Depends(admin)):
+    require_instrument(c, instrument)
+    try:
+        get_worker(instrument).submit(
+            limit_order, participant_id=0, price=price, amount=-amount, time_in_force='GTC', instrument=instrument
+        ).result()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post('/dividends')
-def pay_dividends(dividend_per_share: int, c=Depends(db_cursor), is_admin=Depends(admin)):
-    all_accounts = query(c, 'select participant_id, stock from accounts')
-    c.executemany('update accounts set balance = balance + ? where participant_id=?',
-                  [(r['stock'] * dividend_per_share, r['participant_id']) for r in all_accounts])
-    c.connection.commit()
+def pay_dividends(dividend_per_share: int, instrument: str = DEFAULT_INSTRUMENT, c=Depends(db_read_cursor),
+                  is_admin=Depends(admin)):
+    """Pay every holder of the instrument, or charge short sellers. Returns the totals paid out."""
+    require_instrument(c, instrument)
+    holders, shares = admin_change(
+        get_worker(instrument).submit(distribute_dividend, instrument=instrument, dividend=dividend_per_share)
+    )
+    return {'instrument': instrument, 'holders': holders, 'shares': shares, 'paid': shares * dividend_per_share}
 
 
 @app.get('/balance')
-def balance(c=Depends(db_cursor), user=Depends(get_user_for_token)):
+def balance(c=Depends(db_read_cursor), user=Depends(get_user_for_token)):
     return query(c, 'select balance from accounts natural join auth where auth.name=?', (user.name,))[0]
 
 
+def portfolio_of(cash: int, held: list[tuple], marks: dict[str, Optional[float]]) -> dict:
+    """Cash, every position and the totals, from (instrument, stock, cost, realized) rows."""
+    figures = {instrument: positions.pnl(stock, cost, realized, marks[instrument])
+               for instrument, stock, cost, realized in held}
+    return {
+        'cash': cash,
+        'equity': cash + sum(position['value'] for position in figures.values()),
+        **{total: sum(position[total] for position in figures.values()) for total in ('realized', 'unrealized', 'pnl')},
+        'positions': figures,
+    }
+
+
+# Positions keep their cost and realized P&L up to date with every fill and dividend, see positions.py,
+# so all that's left to do here is value them at the mark price.
+@app.get('/portfolio')
+def portfolio(mark: Literal['mid', 'last'] = 'mid', c=Depends(db_read_cursor), user=Depends(get_user_for_token)):
+    """Cash, stock, average entry price and P&L of every position, valued at the mid or last trade price."""
+    cash, = c.execute('select balance from accounts where participant_id=?', (user.participant_id,)).fetchone()
+    held = c.execute('select instrument, stock, cost, realized from positions where participant_id=?',
+                     (user.participant_id,)).fetchall()
+    marks = {instrument: mark_price(c, instrument, mark) for instrument, *_ in held}
+    return portfolio_of(cash, held, marks)
+
+
+@app.get('/leaderboard')
+def leaderboard(mark: Literal['mid', 'last'] = 'mid', c=Depends(db_read_cursor), is_admin=Depends(admin)):
+    """Everyone's portfolio without the positions, best P&L first."""
+    marks = {instrument: mark_price(c, instrument, mark) for instrument in instruments(c)}
+    held = defaultdict(list)
+    for participant_id, *position in c.execute('select participant_id, instrument, stock, cost, realized '
+                                               'from positions'):
+        held[participant_id].append(position)
+    board = []
+    for participant_id, name, cash in c.execute('select participant_id, name, balance from auth natural join accounts'):
+        summary = portfolio_of(cash, held[participant_id], marks)
+        del summary['positions']
+        board.append({'participant_id': participant_id, 'name': name, **summary})
+    return sorted(board, key=lambda row: -row['pnl'])
+
+
+@app.post('/export')
+def export_columns(c=Depends(db_read_cursor), is_admin=Depends(admin)):
+    """
+    Write trades, earnings, dividends and book snapshots as NumPy arrays to a new directory in EXPORT_DIR on the
+    server, see export.py. Returns the directory and how many rows of each there are.
+    """
+    directory = os.path.join(os.environ.get('EXPORT_DIR') or 'exports', datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+    return {'directory': directory, 'rows': export.write(c, directory, trade_tape_reader)}
+
+
 @app.get('/orders/active')
-def active_orders(c=Depends(db_cursor), user=Depends(get_user_for_token)):
+def active_orders(c=Depends(db_read_cursor), user=Depends(get_user_for_token)):
     return query(c, 'select * from exchange where exchange.participant_id=?', (user.participant_id,))
 
 
@@ -110,44 +440,144 @@ class Order(BaseModel):
     q: int = Field(..., gt=0)
     d: Literal['buy', 'sell'] = Field(...)
     tif: Literal['GTC', 'IOC'] = Field(default='GTC')
-
-
-@app.post('/submit')
-def submit(order: Order, c=Depends(db_cursor), user=Depends(get_user_for_token)):
+    s: str = Field(default=DEFAULT_INSTRUMENT)
+
+    def as_kwargs(self, participant_id) -> dict:
+        """Keyword arguments for engine.limit_order."""
+        return {
+            'participant_id': participant_id,
+            'price': self.p,
+            'amount': (self.q if self.d == 'buy' else -self.q),
+            'time_in_force': self.tif,
+            'instrument': self.s,
+        }
+
+
+# Order entry goes through the matching worker of the instrument, see workers.py
+@app.post('/submit', dependencies=[Depends(rate_limit_participant)])
+def submit(order: Order, c=Depends(db_read_cursor), user=Depends(get_user_for_token)):
+    require_instrument(c, order.s)
     try:
-        timestamp = limit_order(
-            c,
-            participant_id=user.participant_id,
-            price=order.p,
-            amount=(order.q if order.d == 'buy' else -order.q),
-            time_in_force=order.tif
-        )
+        timestamp = get_worker(order.s).submit(limit_order, **order.as_kwargs(user.participant_id)).result()
         return timestamp
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.post('/cancel')
-def cancel(logical_timestamp: int, c=Depends(db_cursor), user=Depends(get_user_for_token)):
-    # Validate user has right to cancel
-    cancelled = c.execute(
-        'delete from exchange where participant_id=? and logical_timestamp=? returning logical_timestamp',
-        (user.participant_id, logical_timestamp)
-    ).fetchall()
+@app.post('/submit/batch', dependencies=[Depends(rate_limit_participant)])
+def submit_batch(orders: list[Order] = Body(...), c=Depends(db_read_cursor), user=Depends(get_user_for_token)):
+    """
+    Submit orders, returning a timestamp and fills, or an error, for each of them. A malformed order fails the whole
+    batch with the usual 422, like it does for /submit, but an order in an unknown instrument, or one the engine
+    rejects, only gets an error of its own.
+    Orders in the same instrument are matched in the given order, in a single transaction.
+    """
+    if len(orders) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f'At most {MAX_BATCH_SIZE} orders per batch.')
+    known = set(instruments(c))
+    results: list[Optional[dict]] = [None] * len(orders)
+    by_instrument = defaultdict(list)
+    for idx, order in enumerate(orders):
+        if order.s not in known:
+            results[idx] = {'error': f'Unknown instrument {order.s}.'}
+            continue
+        by_instrument[order.s].append((idx, order))
+    futures = {
+        instrument: get_worker(instrument).submit(
+            limit_orders, orders=[order.as_kwargs(user.participant_id) for _, order in items]
+        )
+        for instrument, items in by_instrument.items()
+    }
+    for instrument, items in by_instrument.items():
+        try:
+            outcomes = futures[instrument].result()
+        except Exception as e:
+            outcomes = [{'error': str(e)}] * len(items)
+        for (idx, _), result in zip(items, outcomes):
+            results[idx] = result
+    return results
+
+
+def cancelled_orders(futures: list[Future]) -> list[int]:
+    """What cancel_orders or cancel_all_orders cancelled in every instrument, or a 400 if any of them failed."""
+    cancelled, errors = [], []
+    for future in futures:
+        try:
+            cancelled.extend(future.result())
+        except Exception as e:
+            errors.append(str(e))
+    if errors:
+        detail = ' '.join(errors)
+        if cancelled:
+            detail += f' Cancelled {sorted(cancelled)} nonetheless.'
+        raise HTTPException(status_code=400, detail=detail)
+    return sorted(cancelled)
+
+
+@app.post('/cancel', dependencies=[Depends(rate_limit_participant)])
+def cancel(logical_timestamp: list[int] = Query(...), c=Depends(db_read_cursor), user=Depends(get_user_for_token)):
+    """
+    Cancel one order, or several with the parameter repeated. Orders that are gone already, say because they traded,
+    are skipped, as long as at least one gets cancelled.
+    """
+    if len(logical_timestamp) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f'At most {MAX_BATCH_SIZE} orders per cancel.')
+    by_instrument = defaultdict(list)
+    for ts, instrument in c.execute(
+            'select logical_timestamp, instrument from exchange '
+            'where participant_id=? and logical_timestamp in (select value from json_each(?))',
+            (user.participant_id, json.dumps(logical_timestamp))
+    ):
+        by_instrument[instrument].append(ts)
+    cancelled = cancelled_orders([
+        get_worker(instrument).submit(cancel_orders, participant_id=user.participant_id, logical_timestamps=tss,
+                                      instrument=instrument)
+        for instrument, tss in by_instrument.items()
+    ])
     if not cancelled:
-        raise HTTPException(status.HTTP_401_UNAUTHORIZED, f'User {user} does not own order {logical_timestamp}')
-    c.connection.commit()
-    return f'Cancelled order {logical_timestamp}.'
-
-
-@app.post('/cancel/all')
-def cancel_all(c=Depends(db_cursor), user=Depends(get_user_for_token)):
-    cancelled = c.execute(
-        'delete from exchange where participant_id=? returning logical_timestamp',
-        (user.participant_id,)
-    ).fetchall()
-    c.connection.commit()
-    cancelled = [ts for ts, *_ in cancelled]
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED,
+                            f'User {user} does not own order{"s" * (len(logical_timestamp) > 1)} '
+                            f'{", ".join(map(str, logical_timestamp))}')
+    if len(logical_timestamp) == 1:
+        return f'Cancelled order {cancelled[0]}.'
+    return f'Cancelled {len(cancelled)} orders: {cancelled}.'
+
+
+class Amendment(BaseModel):
+    logical_timestamp: int
+    p: Optional[int] = Field(default=None, gt=0)
+    q: Optional[int] = Field(default=None, gt=0)
+
+
+@app.post('/amend', dependencies=[Depends(rate_limit_participant)])
+def amend(amendment: Amendment, c=Depends(db_read_cursor), user=Depends(get_user_for_token)):
+    """
+    Change the price and/or size of a resting order, atomically, returning its logical timestamp afterwards.
+    It only keeps its place in the queue if it shrinks at the same price, otherwise it's a new order.
+    """
+    instrument = order_instrument(c, amendment.logical_timestamp)
+    timestamp = None
+    if instrument is not None:
+        try:
+            timestamp = get_worker(instrument).submit(
+                amend_order, participant_id=user.participant_id, logical_timestamp=amendment.logical_timestamp,
+                price=amendment.p, size=amendment.q, instrument=instrument
+            ).result()
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if timestamp is None:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED,
+                            f'User {user} does not own order {amendment.logical_timestamp}')
+    return timestamp
+
+
+@app.post('/cancel/all', dependencies=[Depends(rate_limit_participant)])
+def cancel_all(c=Depends(db_read_cursor), user=Depends(get_user_for_token)):
+    active = c.execute('select distinct instrument from exchange where participant_id=?', (user.participant_id,))
+    cancelled = cancelled_orders([
+        get_worker(instrument).submit(cancel_all_orders, participant_id=user.participant_id, instrument=instrument)
+        for instrument, *_ in active.fetchall()
+    ])
     return f'Cancelled {len(cancelled)} orders: {cancelled}.'
 
 
@@ -1,17 +1,27 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sqlite3
+import threading
 from datetime import timedelta, datetime
+from time import time
 from typing import Optional
 
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.security import OAuth2PasswordRequestForm
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from pydantic import BaseModel, SecretStr
 
-from db_utils import db_cursor, query
+from db_utils import db_cursor, db_read_cursor, get_pool, query, DEFAULT_INSTRUMENT
+from engine import add_accounts
+import journal
+import metrics
+from workers import get_worker
 
 load_dotenv()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=os.environ['TOKEN_URL'])
@@ -29,17 +39,113 @@ def verify_password(plaintext: str, hashed: str) -> bool:
     return password_context.verify(plaintext, hashed)
 
 
+class HashingExecutor:
+    """
+    Runs bcrypt on its own small thread pool, so a burst of signups and logins doesn't take the workers that serve
+    order entry. At most `workers` hashes run at the same time, and once `max_queue` are waiting we turn people away.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hashing')
+        self.max_queue = max_queue
+        self.queue_depth = 0  # Running or waiting to run
+        self.lock = threading.Lock()
+
+    async def run(self, func, *args):
+        with self.lock:
+            if self.queue_depth >= self.max_queue:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail='Too many logins in progress, try again later.'
+                )
+            self.queue_depth += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            with self.lock:
+                self.queue_depth -= 1
+
+
+hashing = HashingExecutor(
+    workers=int(os.environ.get('HASH_WORKERS', 2)), max_queue=int(os.environ.get('HASH_MAX_QUEUE', 64))
+)
+metrics.register(metrics.Gauge('auth_hashing_queue_depth', 'Password hashes running or waiting to run.', (),
+                               lambda: {(): hashing.queue_depth}))
+
+
 class User(BaseModel):
     name: str
     participant_id: int
 
 
-async def get_user_for_token(c=Depends(db_cursor), token: str = Depends(oauth2_scheme)):
+class TokenCache:
+    """
+    Bounded LRU cache of verified token -> User, so we don't decode the JWT and look up the user on every request.
+    Entries expire together with their token. Counts hits and misses, so we can see whether it's working.
+    """
+
+    def __init__(self, max_size: int = 10_000):
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[User, float]] = OrderedDict()  # token -> (user, expiry)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[User]:
+        with self.lock:
+            user, expires = self.entries.get(token, (None, 0))
+            if user is None or expires <= time():
+                self.entries.pop(token, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return user
+
+    def put(self, token: str, user: User, expires: float):
+        with self.lock:
+            self.entries[token] = (user, expires)
+            self.entries.move_to_end(token)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate_user(self, name: str):
+        """Forget the tokens of a user, for when it changes or goes away while we're running."""
+        with self.lock:
+            for token in [token for token, (user, _) in self.entries.items() if user.name == name]:
+                del self.entries[token]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+token_cache = TokenCache()
+journal.restore_listeners.append(token_cache.clear)  # Users may be gone or different afterwards
+metrics.register(metrics.Gauge('auth_token_cache_total', 'Token lookups, by whether they were cached.', ('result',),
+                               lambda: {('hit',): token_cache.hits, ('miss',): token_cache.misses}, kind='counter'))
+
+
+def _find_user(name: str) -> list[dict]:
+    # Only on a cache miss, so a hit doesn't need a connection at all
+    pool = get_pool(read_only=True)
+    conn = pool.acquire()
+    try:
+        return query(conn.cursor(), 'select participant_id, name from auth where name=?', (name,))
+    finally:
+        pool.release(conn)
+
+
+async def get_user_for_token(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Invalid authentication credentials',
         headers={'WWW-Authenticate': 'Bearer'},
     )
+    user = token_cache.get(token)
+    if user is not None:
+        return user
+
     try:
         payload = jwt.decode(token, os.environ['SECRET_KEY'], algorithms=[ALGORITHM])
     except JWTError:
@@ -49,16 +155,20 @@ async def get_user_for_token(c=Depends(db_cursor), token: str = Depends(oauth2_s
         raise credentials_exception
     username = payload['sub']
 
-    matches = query(c, 'select participant_id, name, hashed_password from auth where name=?', (username,))
+    matches = await run_in_threadpool(_find_user, username)
     if not matches:
         raise credentials_exception
     else:
         match = matches[0]
-        return User(participant_id=match['participant_id'], name=match['name'])
+        user = User(participant_id=match['participant_id'], name=match['name'])
+        token_cache.put(token, user, payload.get('exp', 0))
+        return user
 
 
-def authenticate_user(c: sqlite3.Cursor, name: str, password: str) -> User:
-    matches = query(c, 'select participant_id, name, hashed_password from auth where name=?', (name,))
+async def authenticate_user(c: sqlite3.Cursor, name: str, password: str) -> User:
+    # We're on the event loop, sqlite goes to the threadpool like it does for sync endpoints, bcrypt to hashing
+    matches = await run_in_threadpool(query, c, 'select participant_id, name, hashed_password from auth where name=?',
+                                      (name,))
     if not matches:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -66,7 +176,7 @@ def authenticate_user(c: sqlite3.Cursor, name: str, password: str) -> User:
         )
 
     match = matches[0]
-    if not verify_password(password, match['hashed_password']):
+    if not await hashing.run(verify_password, password, match['hashed_password']):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail='Invalid username or password'
@@ -74,22 +184,26 @@ def authenticate_user(c: sqlite3.Cursor, name: str, password: str) -> User:
     return User(participant_id=match['participant_id'], name=name)
 
 
-def create_user(name: str, password: SecretStr, c=Depends(db_cursor)) -> User:
+async def create_user(name: str, password: SecretStr, c=Depends(db_read_cursor)) -> User:
     # Todo: take hashed password
-    matches = query(c, 'select participant_id, name, hashed_password from auth where name=?', (name,))
+    matches = await run_in_threadpool(query, c, 'select participant_id from auth where name=?', (name,))
     if matches:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f'This user already exists!'
+            detail='This user already exists!'
+        )
+    hashed_password = await hashing.run(hash_password, password.get_secret_value())
+    # Written like any other change to accounts, so with a sequencer, it's the one doing it
+    future = get_worker(DEFAULT_INSTRUMENT).submit(add_accounts, accounts=[(name, hashed_password)], balance=100)
+    try:
+        participant_id, = await asyncio.wrap_future(future)
+    except Exception as e:
+        # Like someone else signing up with this name while we were hashing
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
         )
-    participant = query(
-        c,
-        'insert into auth(name, hashed_password) values (?, ?) returning participant_id, name',
-        (name, hash_password(password.get_secret_value()))
-    )[0]
-    c.execute('insert into accounts(participant_id, balance) values (?, 100)', (participant['participant_id'],))
-    c.connection.commit()
-    return User(**participant)
+    return User(participant_id=participant_id, name=name)
 
 
 def create_token(data: dict, expires: Optional[timedelta] = None) -> str:
@@ -99,8 +213,8 @@ def create_token(data: dict, expires: Optional[timedelta] = None) -> str:
     return jwt.encode(to_encode, os.environ['SECRET_KEY'], algorithm=ALGORITHM)
 
 
-def create_authenticated_token(c=Depends(db_cursor), form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(c, form_data.username, form_data.password)
+async def create_authenticated_token(c=Depends(db_cursor), form_data: OAuth2PasswordRequestForm = Depends()):
+    user = await authenticate_user(c, form_data.username, form_data.password)
     token = create_token({'sub': user.name})
     return {'access_token': token, 'token_type': 'bearer'}
 
@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from contextlib import nullcontext
+from functools import partial
+from time import perf_counter_ns
+from typing import Callable, Optional
+
+from db_utils import create_db, enable_profiling, StackSampler, DEFAULT_INSTRUMENT
+from engine import limit_order, limit_orders, cancel_order, drop_book, get_book
+
+TRADERS = 100
+MID = 1_000_000  # Far enough from 0 for any spread
+PERCENTILES = {'p50': 0.5, 'p99': 0.99, 'p999': 0.999}
+
+
+def setup(c, rng: random.Random, resting: int = 0, spread: int = 100):
+    """
+    Traders with plenty of cash and stock, and optionally a book with `resting` orders on each side,
+    spread over `spread` price levels below and above MID.
+    """
+    c.executemany('insert into accounts(participant_id, balance) values (?, ?)',
+                  [(i, 10 ** 15) for i in range(TRADERS)])
+    c.executemany('insert into positions(participant_id, instrument, stock) values (?, ?, ?)',
+                  [(i, DEFAULT_INSTRUMENT, 10 ** 9) for i in range(TRADERS)])
+    c.executemany('insert into exchange(participant_id, instrument, price, amount) values (?, ?, ?, ?)', [
+        (rng.randrange(TRADERS), DEFAULT_INSTRUMENT, MID + side * rng.randint(1, spread), -side * rng.randint(1, 10))
+        for _ in range(resting)
+        for side in (-1, 1)
+    ])
+    c.connection.commit()
+    drop_book(c)
+    get_book(c)  # Loading the book isn't part of the first order
+
+
+def random_order(rng: random.Random, i: int, spread: int) -> dict:
+    return {'participant_id': i % TRADERS, 'price': MID + rng.randint(-spread, spread),
+            'amount': rng.choice((-1, 1)) * rng.randint(1, 10)}
+
+
+def timed(calls: list[Callable[[], object]]) -> list[int]:
+    """Latency of every call in nanoseconds."""
+    latencies = []
+    for call in calls:
+        start = perf_counter_ns()
+        call()
+        latencies.append(perf_counter_ns() - start)
+    return latencies
+
+
+# Every scenario sets up the database, then returns the calls to time, ready to go so we only time the engine
+def empty_book(c, n: int, rng: random.Random) -> list[Callable]:
+    """Orders around the same price, that mostly trade with the ones before them, so the book stays close to empty."""
+    setup(c, rng)
+    return [partial(limit_order, c, **random_order(rng, i, 5)) for i in range(n)]
+
+
+def deep_book(resting: int):
+    def scenario(c, n: int, rng: random.Random) -> list[Callable]:
+        setup(c, rng, resting)
+        return [partial(limit_order, c, **random_order(rng, i, 50)) for i in range(n)]
+
+    scenario.__doc__ = f'{resting} resting orders per side, that orders mostly join, and now and then trade with.'
+    return scenario
+
+
+def sweep(c, n: int, rng: random.Random) -> list[Callable]:
+    """Big orders that sweep through tens of thin price levels, alternating sides. Only n / 10 of them."""
+    setup(c, rng, 10 * n, 5 * n)
+    return [partial(limit_order, c, participant_id=i % TRADERS, price=MID + (-1) ** i * 10 * n,
+                    amount=(-1) ** i * 500, time_in_force='IOC')
+            for i in range(n // 10)]
+
+
+def cancel_heavy(c, n: int, rng: random.Random) -> list[Callable]:
+    """Place an order, then cancel it, the way market makers requote. Every other call is a cancel."""
+    setup(c, rng, 1_000)
+    placed = []
+
+    def place(order: dict):
+        placed.append((order['participant_id'], limit_order(c, **order)))
+
+    def cancel():
+        participant_id, timestamp = placed.pop()
+        cancel_order(c, participant_id=participant_id, logical_timestamp=timestamp)
+
+    return [partial(place, random_order(rng, i, 50)) if i % 2 == 0 else cancel for i in range(n)]
+
+
+def batch(c, n: int, rng: random.Random) -> list[Callable]:
+    """Batches of 10 orders in one transaction, like /submit/batch. Latency is per batch."""
+    setup(c, rng, 1_000)
+    return [partial(limit_orders, c, [random_order(rng, i, 50) for _ in range(10)]) for i in range(n // 10)]
+
+
+SCENARIOS = {
+    'empty_book': empty_book,
+    'deep_book_10k': deep_book(10_000),
+    'deep_book_100k': deep_book(100_000),
+    'sweep': sweep,
+    'cancel_heavy': cancel_heavy,
+    'batch': batch,
+}
+
+
+def summarize(latencies: list[int], orders: int) -> dict:
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        'calls': len(ordered),
+        'orders_per_second': orders / (total / 1e9) if total else None,
+        **{name: ordered[min(len(ordered) - 1, int(q * len(ordered)))] / 1e3 for name, q in PERCENTILES.items()},
+    }
+
+
+def run(scenario: str, storage: str, n: int, seed: int = 0, sampler: Optional[StackSampler] = None) -> dict:
+    """
+    Run a scenario against a fresh in-memory or on-disk database. Latencies are in microseconds.
+    A sampler, if given, samples the timed part.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        conn = create_db(':memory:' if storage == 'memory' else os.path.join(directory, 'bench.db'))
+        try:
+            calls = SCENARIOS[scenario](conn.cursor(), n, random.Random(seed))
+            with sampler or nullcontext():
+                latencies = timed(calls)
+        finally:
+            drop_book(conn)
+            conn.close()
+    orders = 10 * len(calls) if scenario == 'batch' else len(calls)
+    return {'scenario': scenario, 'storage': storage, 'n': n, 'seed': seed, **summarize(latencies, orders)}
+
+
+def regressions(results: list[dict], baseline: list[dict], threshold: float) -> list[str]:
+    """Everything that got more than `threshold` (a fraction) slower than in the baseline."""
+    before = {(result['scenario'], result['storage']): result for result in baseline}
+    found = []
+    for result in results:
+        old = before.get((result['scenario'], result['storage']))
+        if old is None:
+            continue
+        name = f"{result['scenario']} ({result['storage']})"
+        if result['orders_per_second'] < old['orders_per_second'] * (1 - threshold):
+            found.append(f"{name}: {old['orders_per_second']:.0f} -> {result['orders_per_second']:.0f} orders/s")
+        if result['p99'] > old['p99'] * (1 + threshold):
+            found.append(f"{name}: p99 {old['p99']:.0f} -> {result['p99']:.0f} us")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the matching engine, without the API in front of it.')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--storage', nargs='+', choices=['memory', 'disk'], default=['memory', 'disk'])
+    parser.add_argument('-n', type=int, default=10_000, help='Orders per scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Save the results as JSON, to compare against later')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown that counts as a regression')
+    parser.add_argument('--flamegraph', help='Profile the statements and sample the stacks, saving folded stacks '
+                                             'here. Slows everything down, so leave out when comparing.')
+    args = parser.parse_args()
+
+    sampler = None
+    if args.flamegraph:
+        enable_profiling()
+        sampler = StackSampler()
+    results = []
+    print(f"{'scenario':<16}{'storage':<8}{'orders/s':>10}{'p50 us':>10}{'p99 us':>10}{'p999 us':>10}")
+    for scenario in args.scenarios:
+        for storage in args.storage:
+            result = run(scenario, storage, args.n, args.seed, sampler)
+            results.append(result)
+            print(f"{scenario:<16}{storage:<8}{result['orders_per_second']:>10.0f}"
+                  f"{result['p50']:>10.0f}{result['p99']:>10.0f}{result['p999']:>10.0f}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if sampler is not None:
+        with open(args.flamegraph, 'w') as file:
+            sampler.dump(file)
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(results, json.load(file), args.threshold)
+        for regression in found:
+            print(f'Regression: {regression}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
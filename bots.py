@@ -0,0 +1,467 @@
+import argparse
+import asyncio
+from collections import defaultdict, deque
+import json
+import logging
+import os
+import random
+import secrets
+import tempfile
+from time import perf_counter, thread_time
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+
+from db_utils import claim_writer, connect_to_db, create_db, migrate, DEFAULT_INSTRUMENT
+from engine import limit_order, cancel_orders, cancel_all_orders, amend_order, depth, engine_lock
+from engine import add_accounts, allocate_shares, drop_book, listeners, subscribe
+from ratelimit import TokenBucketLimiter
+from workers import get_worker, close_workers
+import journal
+
+logger = logging.getLogger(__name__)
+
+# Bots: strategies that trade in the same process as the matching engine, thousands at a time, without paying for
+# HTTP, auth, rate limits and JSON on every order like fuzz.py and loadgen.py do. Every bot is an asyncio task that
+# wakes up every `every` ticks of the runtime to decide what to do. Orders go straight to the matching workers (or the
+# sequencer, with SEQUENCER_ADDRESS set), and market data comes in as callbacks from an engine listener, so nobody
+# polls. Bot code runs on the event loop and has a CPU budget: a bot that used up its budget sits out its turns until
+# it's earned it back. Market data is always delivered, but counts towards the budget too. A bot also sits out its turn
+# while engine calls from its last turn haven't come back, so when there's more than the engine can handle, the bots
+# slow down, rather than the line in front of the engine growing without end.
+# With an in-process engine, nothing else should be matching in the same database while the bots run.
+TICK = 0.1  # Seconds
+CPU_BUDGET = 0.002  # CPU seconds per second, per bot
+BURST = 1.0  # Seconds worth of budget a bot can save up
+DEFAULT_MIX = 'market_maker=10,noise=200,momentum=20'
+
+
+class Stats:
+    """
+    What a bot did. Turns it sat out are skipped if it was over its CPU budget, busy if it was waiting for the engine.
+    Latency is from sending an engine call to getting its result, waiting in line included.
+    """
+    __slots__ = ('turns', 'skipped', 'busy', 'cpu', 'calls', 'orders', 'rejected', 'fills', 'volume', 'latency')
+
+    def __init__(self):
+        self.turns = self.skipped = self.busy = self.calls = self.orders = self.rejected = self.fills = self.volume = 0
+        self.cpu = self.latency = 0.0
+
+
+class Quotes:
+    """The book of an instrument and its last trade price, as the engine has reported them, for all bots to read."""
+
+    def __init__(self, book: dict[str, list[dict]]):
+        self.levels = {is_buy: {level['price']: level['amount'] for level in book['buy' if is_buy else 'sell']}
+                       for is_buy in (True, False)}
+        self._best: dict[bool, Optional[int]] = {}
+        self.last: Optional[int] = None
+
+    def apply(self, event: dict):
+        if event['type'] == 'trade':
+            self.last = event['price']
+            return
+        is_buy = event['side'] == 'buy'
+        if event['amount']:
+            self.levels[is_buy][event['price']] = event['amount']
+        else:
+            self.levels[is_buy].pop(event['price'], None)
+        self._best.pop(is_buy, None)
+
+    def best(self, is_buy: bool) -> Optional[int]:
+        if is_buy not in self._best:
+            levels = self.levels[is_buy]
+            self._best[is_buy] = (max(levels) if is_buy else min(levels)) if levels else None
+        return self._best[is_buy]
+
+    @property
+    def bid(self) -> Optional[int]:
+        return self.best(True)
+
+    @property
+    def ask(self) -> Optional[int]:
+        return self.best(False)
+
+    @property
+    def mid(self) -> Optional[float]:
+        bid, ask = self.bid, self.ask
+        return None if bid is None or ask is None else (bid + ask) / 2
+
+
+class Bot:
+    """
+    A strategy. The runtime calls on_tick every `every` ticks, on_trades with the trades in the bot's instrument if
+    the strategy has it, and on_fill with the bot's own trades, after updating stock and cash. None of them should
+    block: the order methods return a future of what the engine call returns, and don't wait for it.
+    """
+    every = 1
+
+    def __init__(self, name: str, instrument: str = DEFAULT_INSTRUMENT, seed: int = 0, price: int = 100):
+        self.name = name
+        self.instrument = instrument
+        self.rng = random.Random(seed)
+        self.price = price  # Where to start, while there's no market yet
+        self.participant_id = None
+        self.stock = self.cash = 0
+        self.outstanding = 0  # Engine calls we haven't heard back from
+        self.stats = Stats()
+        self.runtime: Optional[Runtime] = None
+
+    @property
+    def quotes(self) -> Quotes:
+        return self.runtime.quotes[self.instrument]
+
+    def reference(self) -> float:
+        """Best guess of what the instrument is worth: the mid, the last price, or where we started."""
+        quotes = self.quotes
+        return quotes.mid or quotes.last or self.price
+
+    def submit(self, price: int, amount: int, time_in_force: str = 'GTC') -> asyncio.Future:
+        """Buy (or sell, with a negative amount) at price, see engine.limit_order. Gives the logical timestamp."""
+        self.stats.orders += 1
+        return self.runtime.call(self, limit_order, participant_id=self.participant_id, price=max(1, round(price)),
+                                 amount=amount, time_in_force=time_in_force, instrument=self.instrument)
+
+    def cancel(self, *logical_timestamps: int) -> asyncio.Future:
+        return self.runtime.call(self, cancel_orders, participant_id=self.participant_id,
+                                 logical_timestamps=list(logical_timestamps), instrument=self.instrument)
+
+    def cancel_all(self) -> asyncio.Future:
+        return self.runtime.call(self, cancel_all_orders, participant_id=self.participant_id,
+                                 instrument=self.instrument)
+
+    def amend(self, logical_timestamp: int, price: Optional[int] = None, size: Optional[int] = None) -> asyncio.Future:
+        return self.runtime.call(self, amend_order, participant_id=self.participant_id,
+                                 logical_timestamp=logical_timestamp, price=price, size=size,
+                                 instrument=self.instrument)
+
+    def on_tick(self):
+        pass
+
+    def on_trades(self, trades: list[dict]):
+        pass
+
+    def on_fill(self, trade: dict):
+        pass
+
+
+class MarketMaker(Bot):
+    """Quotes both sides around the reference price, and leans its quotes against what it has bought or sold."""
+    every = 5
+
+    def __init__(self, *args, spread: int = 2, size: int = 5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spread = spread
+        self.size = size
+        self.start: Optional[int] = None
+
+    def on_tick(self):
+        if self.start is None:
+            self.start = self.stock
+        skew = (self.stock - self.start) / (10 * self.size)
+        reference = self.reference() - skew
+        self.cancel_all()
+        self.submit(min(reference - self.spread, (self.quotes.ask or reference) - 1), self.size)
+        if self.stock >= self.size:
+            self.submit(max(reference + self.spread, (self.quotes.bid or reference) + 1), -self.size)
+
+
+class NoiseTrader(Bot):
+    """Now and then, a random order around the reference price, that mostly trades right away."""
+    every = 10
+
+    def on_tick(self):
+        rng = self.rng
+        if rng.random() < 0.1:
+            self.cancel_all()
+        if rng.random() < 0.5:
+            amount = rng.randint(1, 10) * rng.choice((-1, 1))
+            if self.stock + amount >= 0:
+                self.submit(self.reference() + rng.gauss(0, 3), amount, 'IOC' if rng.random() < 0.7 else 'GTC')
+
+
+class Momentum(Bot):
+    """Follows the trend: buys when the average of recent trade prices is above a longer average, sells when below."""
+    every = 10
+
+    def __init__(self, *args, short: int = 5, long: int = 20, size: int = 5, limit: int = 50, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prices: deque[int] = deque(maxlen=long)
+        self.short = short
+        self.size = size
+        self.limit = limit
+
+    def on_trades(self, trades: list[dict]):
+        self.prices.extend(trade['price'] for trade in trades)
+
+    def on_tick(self):
+        if len(self.prices) < self.prices.maxlen:
+            return
+        recent = list(self.prices)
+        trend = sum(recent[-self.short:]) / self.short - sum(recent) / len(recent)
+        if trend > 0 and self.stock < self.limit and self.quotes.ask is not None:
+            self.submit(self.quotes.ask, self.size, 'IOC')
+        elif trend < 0 and self.stock >= self.size and self.quotes.bid is not None:
+            self.submit(self.quotes.bid, -self.size, 'IOC')
+
+
+STRATEGIES = {'market_maker': MarketMaker, 'noise': NoiseTrader, 'momentum': Momentum}
+
+
+class Runtime:
+    """
+    Runs bots on the current event loop, see run. Every bot gets its turn on its own schedule, spread over the ticks,
+    and only wakes up when it's its turn.
+    """
+
+    def __init__(self, bots: list[Bot], tick: float = TICK, cpu_budget: float = CPU_BUDGET):
+        self.bots = bots
+        self.interval = tick
+        self.budget = TokenBucketLimiter(rate=cpu_budget, burst=cpu_budget * BURST, max_keys=len(bots))
+        self.quotes: dict[str, Quotes] = {}
+        self.by_participant = {}
+        self.watchers: dict[str, list[Bot]] = defaultdict(list)  # Bots with an on_trades, by instrument
+        self.pending: set[asyncio.Future] = set()
+        self.tick = 0
+        self.late = 0  # Ticks that started late, because the bots took too long
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._due: dict[int, asyncio.Future] = {}
+
+    def call(self, bot: Bot, func: Callable, **kwargs) -> asyncio.Future:
+        """Have the matching worker of the bot's instrument call func, see MatchingWorker.submit."""
+        bot.stats.calls += 1
+        bot.outstanding += 1
+        start = perf_counter()
+        future = asyncio.wrap_future(get_worker(bot.instrument).submit(func, **kwargs), loop=self.loop)
+        self.pending.add(future)
+        future.add_done_callback(lambda done: self._done(bot, start, done))
+        return future
+
+    def _done(self, bot: Bot, start: float, future: asyncio.Future):
+        self.pending.discard(future)
+        bot.outstanding -= 1
+        bot.stats.latency += perf_counter() - start
+        if not future.cancelled() and future.exception() is not None:
+            bot.stats.rejected += 1
+
+    def _turn(self, bot: Bot, callback: Callable, *args):
+        """Run some bot code, charging it for the CPU it takes."""
+        start = thread_time()
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception('Bot %s failed', bot.name)
+        finally:
+            elapsed = thread_time() - start
+            bot.stats.cpu += elapsed
+            self.budget.charge(bot.name, elapsed)
+
+    def publish(self, events: list[dict]):
+        """Engine listener, see engine.subscribe. Called on a worker thread, so it hands the events to the loop."""
+        self.loop.call_soon_threadsafe(self._dispatch, events)
+
+    def _dispatch(self, events: list[dict]):
+        trades = defaultdict(list)
+        for event in events:
+            quotes = self.quotes.get(event['instrument'])
+            if quotes is not None:
+                quotes.apply(event)
+            if event['type'] == 'trade':
+                trades[event['instrument']].append(event)
+        for instrument, made in trades.items():
+            for trade in made:
+                for participant_id, sign in ((trade['buyer'], 1), (trade['seller'], -1)):
+                    bot = self.by_participant.get(participant_id)
+                    if bot is not None and bot.instrument == instrument:
+                        bot.stock += sign * trade['amount']
+                        bot.cash -= sign * trade['amount'] * trade['price']
+                        bot.stats.fills += 1
+                        bot.stats.volume += trade['amount']
+                        self._turn(bot, bot.on_fill, trade)
+            for bot in self.watchers[instrument]:
+                self._turn(bot, bot.on_trades, made)
+
+    def _at(self, tick: int) -> asyncio.Future:
+        future = self._due.get(tick)
+        if future is None:
+            future = self._due[tick] = self.loop.create_future()
+        return future
+
+    async def _run(self, bot: Bot):
+        tick = self.tick + 1 + bot.rng.randrange(bot.every)
+        while True:
+            await self._at(tick)
+            tick += bot.every
+            if bot.outstanding:
+                bot.stats.busy += 1
+                continue
+            if not self.budget.allow(bot.name, 0):
+                bot.stats.skipped += 1
+                continue
+            bot.stats.turns += 1
+            self._turn(bot, bot.on_tick)
+
+    def _start(self):
+        """Hook up to the engine, and get the books and the bots' stock and cash to start from."""
+        instruments = sorted({bot.instrument for bot in self.bots})
+        ids = json.dumps([bot.participant_id for bot in self.bots])
+        conn = connect_to_db(read_only=True)
+        try:
+            with engine_lock:  # So the books we read and the events we get after line up
+                subscribe(self.publish)
+                self.quotes = {instrument: Quotes(depth(conn, None, instrument)) for instrument in instruments}
+            cash = dict(conn.execute('select participant_id, balance from accounts '
+                                     'where participant_id in (select value from json_each(?))', (ids,)))
+            stock = {(participant_id, instrument): amount for participant_id, instrument, amount in conn.execute(
+                'select participant_id, instrument, stock from positions '
+                'where participant_id in (select value from json_each(?))', (ids,))}
+        finally:
+            conn.close()
+        for bot in self.bots:
+            bot.runtime = self
+            bot.cash = cash.get(bot.participant_id, 0)
+            bot.stock = stock.get((bot.participant_id, bot.instrument), 0)
+            self.by_participant[bot.participant_id] = bot
+            if type(bot).on_trades is not Bot.on_trades:
+                self.watchers[bot.instrument].append(bot)
+
+    async def run(self, duration: Optional[float] = None):
+        """Run the bots for duration seconds, or until cancelled, then wait for their last engine calls."""
+        self.loop = asyncio.get_running_loop()
+        self._start()
+        tasks = [asyncio.create_task(self._run(bot)) for bot in self.bots]
+        start = perf_counter()
+        try:
+            while duration is None or perf_counter() - start < duration:
+                self.tick += 1
+                wait = start + self.tick * self.interval - perf_counter()
+                if wait < 0:
+                    self.late += 1
+                await asyncio.sleep(max(0.0, wait))
+                due = self._due.pop(self.tick, None)
+                if due is not None:
+                    due.set_result(None)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(*self.pending, return_exceptions=True)
+            listeners.remove(self.publish)
+
+    def summary(self) -> dict[str, dict]:
+        """Stats per strategy, with its share of the CPU the bots used and of the engine calls they made."""
+        totals = defaultdict(lambda: defaultdict(float))
+        for bot in self.bots:
+            strategy = totals[type(bot).__name__]
+            strategy['bots'] += 1
+            for name in Stats.__slots__:
+                strategy[name] += getattr(bot.stats, name)
+        cpu = sum(strategy['cpu'] for strategy in totals.values()) or 1
+        calls = sum(strategy['calls'] for strategy in totals.values()) or 1
+        return {
+            name: {
+                **{key: int(value) for key, value in strategy.items() if key not in ('cpu', 'latency')},
+                'cpu_ms': strategy['cpu'] * 1e3,
+                'cpu_share': strategy['cpu'] / cpu,
+                'call_share': strategy['calls'] / calls,
+                'latency_ms': strategy['latency'] / strategy['calls'] * 1e3 if strategy['calls'] else None,
+            }
+            for name, strategy in totals.items()
+        }
+
+
+def register(c, names: list[str], cash: int, stock: int, instrument: str = DEFAULT_INSTRUMENT) -> list[int]:
+    """
+    Participant ids of bots by name. Signs up the ones that don't exist yet, with cash and stock, through a matching
+    worker like any other signup, so with a sequencer it's still the only one writing.
+    """
+    from auth import hash_password  # Not at the top, it needs TOKEN_URL, and we only need it for new bots
+
+    known = dict(c.execute('select name, participant_id from auth where name in (select value from json_each(?))',
+                           (json.dumps(names),)))
+    new = [name for name in names if name not in known]
+    if new:
+        hashed_password = hash_password(secrets.token_urlsafe())  # Bots don't log in
+        worker = get_worker(instrument)
+        known.update(zip(new, worker.submit(add_accounts, accounts=[(name, hashed_password) for name in new],
+                                            balance=cash).result()))
+        if stock:
+            worker.submit(allocate_shares, instrument=instrument,
+                          allocations=[(known[name], stock) for name in new]).result()
+    return [known[name] for name in names]
+
+
+def make_bots(mix: str, instrument: str = DEFAULT_INSTRUMENT, price: int = 100, seed: int = 0) -> list[Bot]:
+    """Bots from counts per strategy, like 'market_maker=10,noise=200'. Every bot has its own seed."""
+    bots = []
+    for item in mix.split(','):
+        strategy, count = item.split('=')
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Unknown strategy {strategy}')
+        bots += [STRATEGIES[strategy](f'bot-{strategy}-{i}', instrument, seed + len(bots) + i, price)
+                 for i in range(int(count))]
+    return bots
+
+
+def main():
+    load_dotenv()
+    os.environ.setdefault('TOKEN_URL', 'token')
+    parser = argparse.ArgumentParser(description='Run trading bots in process, straight against the matching engine.')
+    parser.add_argument('--bots', default=DEFAULT_MIX, help=f'Bots per strategy, defaults to {DEFAULT_MIX}')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds')
+    parser.add_argument('--tick', type=float, default=TICK, help='Seconds')
+    parser.add_argument('--cpu-budget', type=float, default=CPU_BUDGET * 1e3, help='CPU ms per second, per bot')
+    parser.add_argument('--db', help='Database to trade in, defaults to DB_LOCATION, or a fresh one if not set')
+    parser.add_argument('--instrument', default=DEFAULT_INSTRUMENT)
+    parser.add_argument('--price', type=int, default=100, help='Where to start trading, without a market yet')
+    parser.add_argument('--cash', type=int, default=10 ** 9, help='For new bots')
+    parser.add_argument('--stock', type=int, default=1_000, help='For new bots')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Save the stats as JSON')
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    if args.db or os.environ.get('DB_LOCATION'):
+        os.environ['DB_LOCATION'] = args.db or os.environ['DB_LOCATION']
+        conn = connect_to_db()
+    else:
+        os.environ['DB_LOCATION'] = os.path.join(directory.name, 'bots.db')
+        conn = create_db(os.environ['DB_LOCATION'])
+        conn.commit()  # The bots sign up from a worker
+    bots = make_bots(args.bots, args.instrument, args.price, args.seed)
+    try:
+        if not os.environ.get('SEQUENCER_ADDRESS'):
+            # We do the matching, so like the API without a sequencer, see api.recover_from_journal
+            claim_writer(os.environ['DB_LOCATION'])
+            with engine_lock:
+                migrate(conn)
+                if journal.recover(conn) is not None:
+                    drop_book(conn)
+        for bot, participant_id in zip(bots, register(conn.cursor(), [bot.name for bot in bots], args.cash,
+                                                      args.stock, args.instrument)):
+            bot.participant_id = participant_id
+    finally:
+        conn.close()
+
+    runtime = Runtime(bots, args.tick, args.cpu_budget / 1e3)
+    try:
+        asyncio.run(runtime.run(args.duration))
+    finally:
+        close_workers()
+        directory.cleanup()
+    summary = runtime.summary()
+    print(f'{runtime.tick} ticks, {runtime.late} late.')
+    print(f"{'strategy':<14}{'bots':>6}{'turns':>9}{'skipped':>9}{'busy':>9}{'cpu %':>7}{'calls %':>9}{'orders':>9}"
+          f"{'rejected':>10}{'fills':>8}{'latency ms':>12}")
+    for name, stats in summary.items():
+        print(f"{name:<14}{stats['bots']:>6}{stats['turns']:>9}{stats['skipped']:>9}{stats['busy']:>9}"
+              f"{stats['cpu_share']:>7.0%}"
+              f"{stats['call_share']:>9.0%}{stats['orders']:>9}{stats['rejected']:>10}{stats['fills']:>8}"
+              f"{stats['latency_ms'] or 0:>12.2f}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'ticks': runtime.tick, 'late': runtime.late, 'strategies': summary}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+import sqlite3
+import threading
+from typing import Optional, Union
+
+from db_utils import DEFAULT_INSTRUMENT
+
+# Resolutions we keep candles for, in seconds
+RESOLUTIONS = {'1s': 1, '1m': 60, '5m': 300}
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+
+class Candle:
+    __slots__ = ('start', 'open', 'high', 'low', 'close', 'volume', 'notional')
+
+    def __init__(self, start: int, open: int, high: int, low: int, close: int, volume: int, notional: int):
+        self.start = start  # Seconds since the epoch, in server local time like every other timestamp
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.notional = notional  # Sum of price * amount, so VWAP is notional / volume
+
+    def add(self, price: int, amount: int):
+        self.high = max(self.high, price)
+        self.low = min(self.low, price)
+        self.close = price
+        self.volume += amount
+        self.notional += price * amount
+
+    def as_dict(self) -> dict:
+        return {
+            'start': str(UNIX_EPOCH + timedelta(seconds=self.start)),
+            'open': self.open, 'high': self.high, 'low': self.low, 'close': self.close,
+            'volume': self.volume, 'vwap': self.notional / self.volume,
+        }
+
+
+# Every trade up to trade :last, both from the trades table and the older ones that only live in the log (all in the
+# default instrument)
+ALL_TRADES_SQL = '''
+with all_trades as (
+    select :default_instrument as instrument, timestamp, event ->> 'price' as price, event ->> 'amount' as amount,
+           0 as source, rowid as position
+    from log where event ->> 'type' = 'trade'
+    union all
+    select instrument, timestamp, price, amount, 1 as source, sequence as position from trades where sequence <= :last
+)
+'''
+# Compute all candles of one resolution in a single pass with window functions, rather than row by row in Python
+BACKFILL_SQL = ALL_TRADES_SQL + '''
+, bucketed as (
+    select instrument, cast(strftime('%s', timestamp) as integer) / :resolution * :resolution as start, price, amount,
+           source, position
+    from all_trades
+)
+select distinct instrument, start,
+    first_value(price) over bucket, max(price) over bucket, min(price) over bucket, last_value(price) over bucket,
+    sum(amount) over bucket, sum(price * amount) over bucket
+from bucketed
+window bucket as (
+    partition by instrument, start order by source, position rows between unbounded preceding and unbounded following
+)
+order by instrument, start
+'''
+TOTALS_SQL = ALL_TRADES_SQL + '''
+select instrument, sum(amount), sum(price * amount) from all_trades group by instrument
+'''
+
+
+class CandleStore:
+    """
+    OHLCV candles per instrument and resolution in ring buffers of the last `size` candles, plus the VWAP of the
+    whole session per instrument.
+    Kept up to date by listening to the engine, but only after it's been backfilled from the database once.
+    Trades that arrive before that are in the database already, so the backfill picks them up. Trades can also
+    arrive after it while being in the database already, from a sequencer, so we skip those the backfill read.
+    """
+
+    def __init__(self, size: int = 1_000):
+        # instrument -> resolution -> candles
+        self.candles = defaultdict(lambda: {name: deque(maxlen=size) for name in RESOLUTIONS})
+        self.volume = defaultdict(int)
+        self.notional = defaultdict(int)
+        self.loaded = False
+        self.backfilled = 0  # Sequence number of the last trade the backfill read
+        self.lock = threading.Lock()
+
+    def vwap(self, instrument: str = DEFAULT_INSTRUMENT) -> Optional[float]:
+        with self.lock:
+            volume = self.volume.get(instrument, 0)
+            return self.notional[instrument] / volume if volume else None
+
+    def publish(self, events: list[dict]):
+        """Engine listener, see engine.subscribe."""
+        with self.lock:
+            if not self.loaded:
+                return
+            for event in events:
+                if event['type'] == 'trade' and event['sequence'] > self.backfilled:
+                    self.add(event['instrument'], datetime.fromisoformat(event['timestamp']), event['price'],
+                             event['amount'])
+
+    def add(self, instrument: str, timestamp: datetime, price: int, amount: int):
+        seconds = int((timestamp - UNIX_EPOCH).total_seconds())
+        self.volume[instrument] += amount
+        self.notional[instrument] += price * amount
+        for name, resolution in RESOLUTIONS.items():
+            candles = self.candles[instrument][name]
+            start = seconds // resolution * resolution
+            if candles and candles[-1].start >= start:
+                candles[-1].add(price, amount)
+            else:
+                candles.append(Candle(start, price, price, price, price, amount, price * amount))
+
+    def backfill(self, c: Union[sqlite3.Connection, sqlite3.Cursor]):
+        """
+        Rebuild everything from the trades in the database.
+        Hold the engine lock while calling this, so no trades get published halfway through.
+        """
+        with self.lock:
+            self.candles.clear()
+            # Everything up to the same trade, however many commits happen while we read
+            self.backfilled, = c.execute('select coalesce(max(sequence), 0) from trades').fetchone()
+            parameters = {'default_instrument': DEFAULT_INSTRUMENT, 'last': self.backfilled}
+            for name, resolution in RESOLUTIONS.items():
+                for instrument, *row in c.execute(BACKFILL_SQL, {**parameters, 'resolution': resolution}):
+                    self.candles[instrument][name].append(Candle(*row))
+            self.volume.clear()
+            self.notional.clear()
+            for instrument, volume, notional in c.execute(TOTALS_SQL, parameters):
+                self.volume[instrument] = volume
+                self.notional[instrument] = notional
+            self.loaded = True
+
+    def get(self, resolution: str, limit: int, instrument: str = DEFAULT_INSTRUMENT) -> list[dict]:
+        with self.lock:
+            if instrument not in self.candles:
+                return []
+            candles = self.candles[instrument][resolution]
+            return [candle.as_dict() for candle in list(candles)[max(0, len(candles) - limit):]]
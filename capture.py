@@ -0,0 +1,110 @@
+from contextvars import ContextVar
+import json
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional, TextIO
+
+# Capture: with CAPTURE_PATH set, everything that changes the state of the exchange is written to a log, with the
+# participant and when it arrived, so replay.py can run the same flow through the engine again.
+# Engine calls are recorded once they commit what they appended to the journal (see committed, engine.commit calls it
+# while it still holds the engine lock), so the log is in the order things got committed. Calls that don't change
+# anything, like rejected orders, or that roll back, aren't in it at all. Every line is a JSON array:
+#   [seconds since the start, participant_id, engine function, its keyword arguments] for calls from matching workers
+#   [seconds since the start, null, "event", journal entry] for everything else, like accounts a script sets up
+# Starting a capture copies the database next to the log, as the state to replay from.
+# With a sequencer, capture in the sequencer process: admin changes and signups go through it as well.
+
+
+class Call:
+    __slots__ = ('name', 'kwargs', 'arrival', 'changed', 'recorded')
+
+    def __init__(self, name: str, kwargs: dict, arrival: float):
+        self.name = name
+        self.kwargs = kwargs
+        self.arrival = arrival
+        self.changed = False
+        self.recorded = False
+
+
+class Recorder:
+    def __init__(self, file: TextIO):
+        self.file = file
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def write(self, arrival: float, participant_id, name: str, payload):
+        line = json.dumps([round(arrival - self.start, 6), participant_id, name, payload], separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+recorder: Optional[Recorder] = None
+_call: ContextVar[Optional[Call]] = ContextVar('captured_call', default=None)
+_pending = threading.local()  # Journal entries from outside calls, waiting for their commit
+
+
+def start(path: str, conn: sqlite3.Connection) -> Recorder:
+    """Copy the database to path + '.db' and record everything from now on to path. Nothing should be writing yet."""
+    global recorder
+    target = sqlite3.connect(f'{path}.db')
+    try:
+        conn.backup(target)
+    finally:
+        target.close()
+    recorder = Recorder(open(path, 'w'))
+    return recorder
+
+
+def stop():
+    global recorder
+    if recorder is not None:
+        recorder.close()
+        recorder = None
+
+
+def run(func: Callable, c, arrival: float, **kwargs):
+    """Call func(c, **kwargs) for a matching worker, recording it if it changes anything."""
+    if recorder is None:
+        return func(c, **kwargs)
+    token = _call.set(Call(func.__name__, kwargs, arrival))
+    try:
+        return func(c, **kwargs)
+    finally:
+        _call.reset(token)
+
+
+def journaled(event: dict):
+    """Called for every journal entry, see journal.append."""
+    if recorder is None:
+        return
+    call = _call.get()
+    if call is None:
+        if not hasattr(_pending, 'events'):
+            _pending.events = []
+        _pending.events.append(event)
+    else:
+        call.changed = True
+
+
+def committed():
+    """
+    Call after committing journal entries, to record what they came from. engine.commit does, anything else that
+    appends to the journal outside a matching worker has to call it itself.
+    """
+    if recorder is None:
+        return
+    call = _call.get()
+    if call is not None and call.changed and not call.recorded:
+        call.recorded = True
+        orders = call.kwargs.get('orders') or [call.kwargs]  # A batch is all from one participant
+        recorder.write(call.arrival, orders[0].get('participant_id'), call.name, call.kwargs)
+    events = getattr(_pending, 'events', None)
+    if events:
+        for event in events:
+            recorder.write(time.time(), None, 'event', event)
+        events.clear()
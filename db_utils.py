@@ -1,14 +1,40 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
 import json
+import logging
 import os
 from pathlib import Path
 from datetime import datetime
+import fcntl
+import queue
 import sqlite3
-from typing import Optional, Any, Union
+import sys
+import threading
+from time import perf_counter
+from typing import Callable, Optional, Any, TextIO, Union
+
+import journal
+
+logger = logging.getLogger(__name__)
 
 sqlite3.register_converter('boolean', lambda v: bool(int(v)))
 sqlite3.register_adapter(bool, int)
 sqlite3.register_converter('json', json.loads)
 
+# Applied to every connection we open. WAL lets readers and the writer work at the same time, and with WAL
+# synchronous=normal is still safe against corruption, it only risks losing the last commits on power loss.
+PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,  # milliseconds
+    'mmap_size': 256 * 1024 * 1024,  # bytes
+    'cache_size': -32 * 1024,  # negative means KiB rather than pages
+}
+POOL_SIZE = 8
+# The instrument every database starts out with, and that everything refers to unless it says otherwise
+DEFAULT_INSTRUMENT = 'STOCK'
+
 
 def create_mock_db(location: Union[Path,str]) -> sqlite3.Connection:
     conn = create_db(location)
@@ -32,12 +58,20 @@ def create_mock_db(location: Union[Path,str]) -> sqlite3.Connection:
         'insert into auth(participant_id, name, hashed_password) values (:participant_id, :name, :hashed_password)',
         accounts
     )
+    conn.executemany('insert into accounts(participant_id, balance) values (:participant_id, :balance)', accounts)
     conn.executemany(
-        'insert into accounts(participant_id, balance, stock) values (:participant_id, :balance, :stock)', accounts
-    )
-    conn.execute(
-        'insert into earnings(amount, timestamp) values (?, ?)', (10000, datetime.now())
+        'insert into positions(participant_id, instrument, stock) values (:participant_id, :instrument, :stock)',
+        [{**account, 'instrument': DEFAULT_INSTRUMENT} for account in accounts]
     )
+    earnings = {'type': 'earnings', 'instrument': DEFAULT_INSTRUMENT, 'amount': 10000, 'timestamp': str(datetime.now())}
+    conn.execute('insert into earnings(instrument, amount, timestamp) values (:instrument, :amount, :timestamp)',
+                 earnings)
+    for account in accounts:
+        journal.append(conn, {'type': 'account', 'participant_id': account['participant_id'],
+                              'balance': account['balance']})
+        journal.append(conn, {'type': 'position', 'participant_id': account['participant_id'],
+                              'instrument': DEFAULT_INSTRUMENT, 'stock': account['stock']})
+    journal.append(conn, earnings)
     conn.commit()
     return conn
 
@@ -45,8 +79,17 @@ def create_mock_db(location: Union[Path,str]) -> sqlite3.Connection:
 def create_db(location):
     if location != ':memory:':
         location = Path(location)
-        location.unlink(missing_ok=True)
+        for path in (location, Path(f'{location}-wal'), Path(f'{location}-shm')):
+            path.unlink(missing_ok=True)
     conn = connect_to_db(location)
+    create_tables(conn)
+    conn.execute('insert into instruments(symbol) values (?)', (DEFAULT_INSTRUMENT,))
+    journal.append(conn, {'type': 'instrument', 'symbol': DEFAULT_INSTRUMENT})
+    return conn
+
+
+def create_tables(conn: sqlite3.Connection):
+    """Create the tables and indexes that aren't there yet, see migrate."""
     # Terminology:
     # - A logical timestamp is an integer which can be used to order events
     # - A relative timestamp is a real that indicates a certain offset from some epoch
@@ -54,71 +97,424 @@ def create_db(location):
 
     # Trading tables
     conn.execute(
-        'create table exchange ('
+        'create table if not exists instruments ('
+        '  symbol text primary key'
+        ')'
+    )
+    conn.execute(
+        'create table if not exists exchange ('
         '   participant_id integer,'
+        '   instrument text not null,'
         '   price integer,'
         '   amount integer,'
         '   logical_timestamp integer primary key autoincrement'
         ')'
     )
+    # Covering indexes for reading each side of a book in priority order, and for cancelling by participant
+    conn.execute(
+        'create index if not exists exchange_bids '
+        'on exchange(instrument, price, logical_timestamp, participant_id, amount) where amount > 0'
+    )
     conn.execute(
-        'create table accounts ('
+        'create index if not exists exchange_asks '
+        'on exchange(instrument, price, logical_timestamp, participant_id, amount) where amount < 0'
+    )
+    conn.execute('create index if not exists exchange_participant '
+                 'on exchange(participant_id, instrument, logical_timestamp)')
+    # Cash is shared between instruments, stock is per instrument
+    conn.execute(
+        'create table if not exists accounts ('
         '  participant_id integer primary key,'
-        '  balance integer default 0 not null,'
-        '  stock integer default 0 not null'
+        '  balance integer default 0 not null'
         ')'
     )
+    # Cost and realized P&L are kept up to date with every fill and dividend, see positions.py
     conn.execute(
-        'create table log ('
+        'create table if not exists positions ('
+        '  participant_id integer not null,'
+        '  instrument text not null,'
+        '  stock integer default 0 not null,'
+        '  cost real default 0 not null,'
+        '  realized real default 0 not null,'
+        '  primary key (participant_id, instrument)'
+        ')'
+    )
+    conn.execute(
+        'create table if not exists trades ('
+        '  sequence integer primary key autoincrement,'
+        '  instrument text not null,'
+        '  timestamp text not null,'
+        '  buyer integer not null,'
+        '  seller integer not null,'
+        '  price integer not null,'
+        '  amount integer not null'
+        ')'
+    )
+    conn.execute('create index if not exists trades_timestamp on trades(timestamp)')
+    conn.execute('create index if not exists trades_instrument on trades(instrument, sequence)')
+    # The journal: everything that changed the state of the exchange, in order, see journal.py
+    conn.execute(
+        'create table if not exists log ('
+        '  sequence integer primary key autoincrement,'
         '  event json,'
         '  timestamp text'
         ')'
     )
+    conn.execute(
+        'create table if not exists snapshots ('
+        '  sequence integer primary key,'
+        '  state json not null,'
+        '  timestamp text'
+        ')'
+    )
+    # The last journal entry the tables above reflect
+    conn.execute('create table if not exists journal_state (sequence integer not null)')
+    conn.execute('insert into journal_state(sequence) select 0 where not exists (select * from journal_state)')
     # Earnings table
     conn.execute(
-        'create table earnings ('
+        'create table if not exists earnings ('
+        '  instrument text not null,'
         '  amount integer,'
         '  timestamp text'
         ')'
     )
     # Auxiliary tables
     conn.execute(
-        'create table auth ('
+        'create table if not exists auth ('
         '  participant_id integer primary key,'
         '  name text unique not null,'
         '  hashed_password text not null'
         ')'
     )
-    conn.execute(
-        'create table ratelimit ('
-        '  rowid integer primary key,'
-        '  ip text,'
-        '  relative_timestamp real'
-        ')'
-    )
-    return conn
 
 
-def connect_to_db(location: Optional[Path] = None) -> sqlite3.Connection:
+def _columns(conn: sqlite3.Connection, table: str) -> set[str]:
+    return {row[1] for row in conn.execute(f'pragma table_info({table})')}
+
+
+def migrate(conn: sqlite3.Connection):
+    """
+    Bring a database made by an older version up to date and commit, so it can be run again: missing columns are
+    added, missing tables are created, and stock moves from accounts to positions. A database from before the journal
+    was replayable gets a snapshot of its state, since its log is only trades, see journal.py. Nothing else should be
+    running yet. Does nothing to a database that's up to date.
+    """
+    had_journal = bool(_columns(conn, 'journal_state'))
+    exchange, earnings, positions = _columns(conn, 'exchange'), _columns(conn, 'earnings'), _columns(conn, 'positions')
+    # Everything was the default instrument before there were others
+    if exchange and 'instrument' not in exchange:
+        conn.execute(f"alter table exchange add column instrument text not null default '{DEFAULT_INSTRUMENT}'")
+    if earnings and 'instrument' not in earnings:
+        conn.execute(f"alter table earnings add column instrument text not null default '{DEFAULT_INSTRUMENT}'")
+    if positions and 'cost' not in positions:
+        conn.execute('alter table positions add column cost real default 0 not null')
+        conn.execute('alter table positions add column realized real default 0 not null')
+    # The log used to be without sequence numbers, number the entries in the order they were made
+    rebuild_log = 'sequence' not in _columns(conn, 'log') and bool(_columns(conn, 'log'))
+    if rebuild_log:
+        conn.execute('alter table log rename to log_unnumbered')
+    create_tables(conn)
+    if rebuild_log:
+        conn.execute('insert into log(sequence, event, timestamp) '
+                     'select rowid, event, timestamp from log_unnumbered order by rowid')
+        conn.execute('drop table log_unnumbered')
+    if 'stock' in _columns(conn, 'accounts'):
+        conn.execute('insert or ignore into positions(participant_id, instrument, stock) '
+                     'select participant_id, ?, stock from accounts where stock != 0', (DEFAULT_INSTRUMENT,))
+        conn.execute('alter table accounts drop column stock')
+    conn.execute('insert or ignore into instruments(symbol) '
+                 'select ? union select instrument from exchange union select instrument from positions',
+                 (DEFAULT_INSTRUMENT,))
+    if not had_journal:
+        # The tables are what the whole log led up to
+        conn.execute('update journal_state set sequence=(select coalesce(max(sequence), 0) from log)')
+        journal.snapshot(conn)
+    conn.commit()
+
+
+class Connection(sqlite3.Connection):
+    """
+    A regular sqlite3 connection, except that it can be weakly referenced and have attributes set on it,
+    because the engine keeps in-memory state per database.
+    """
+    location: Optional[str] = None  # Filled in by the engine, empty for in-memory databases
+
+
+# Profiling: off unless SQL_PROFILE is set, because it times every statement in Python.
+# Every statement's time goes to the request it ran for, and requests slower than SLOW_REQUEST_MS get logged with
+# their statements. sqlite3's trace callback only says when a statement starts, so we time the calls themselves.
+profiling = bool(os.environ.get('SQL_PROFILE'))
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 100))
+_trace: ContextVar[Optional['RequestTrace']] = ContextVar('sql_trace', default=None)
+_running: dict[int, str] = {}  # Thread id -> statement it's running, for StackSampler
+
+
+def enable_profiling(enabled: bool = True):
+    """Only affects connections opened from now on."""
+    global profiling
+    profiling = enabled
+
+
+class RequestTrace:
+    def __init__(self, name: str):
+        self.name = name
+        self.statements: list[tuple[str, float]] = []  # (sql, seconds), appended from whichever thread ran it
+
+    def breakdown(self) -> list[tuple[str, int, float]]:
+        """Every distinct statement with how often it ran and its total seconds, slowest first."""
+        totals = defaultdict(lambda: [0, 0.0])
+        for sql, seconds in self.statements:
+            totals[sql][0] += 1
+            totals[sql][1] += seconds
+        return sorted(((sql, count, seconds) for sql, (count, seconds) in totals.items()), key=lambda t: -t[2])
+
+
+@contextmanager
+def trace_request(name: str):
+    """Attribute statements to a request, here and in whatever it hands work to with the same context."""
+    trace = RequestTrace(name)
+    token = _trace.set(trace)
+    start = perf_counter()
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+        elapsed = perf_counter() - start
+        if elapsed * 1e3 >= SLOW_REQUEST_MS:
+            breakdown = trace.breakdown()
+            logger.warning(
+                'Slow request %s: %.1f ms, of which %.1f ms in %d statements:\n%s', name, elapsed * 1e3,
+                sum(seconds for _, _, seconds in breakdown) * 1e3, len(trace.statements),
+                '\n'.join(f'{seconds * 1e3:9.2f} ms {count:5}x  {" ".join(sql.split())}'
+                          for sql, count, seconds in breakdown)
+            )
+
+
+def _timed(sql: str, func: Callable, *args):
+    thread = threading.get_ident()
+    _running[thread] = sql
+    start = perf_counter()
+    try:
+        return func(*args)
+    finally:
+        elapsed = perf_counter() - start
+        _running.pop(thread, None)
+        trace = _trace.get()
+        if trace is not None:
+            trace.statements.append((sql, elapsed))
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Times executing and fetching, since a select only runs up to its first row in execute."""
+    sql = ''
+
+    def execute(self, sql, parameters=()):
+        self.sql = sql
+        return _timed(sql, super().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        self.sql = sql
+        return _timed(sql, super().executemany, sql, parameters)
+
+    def fetchone(self):
+        return _timed(self.sql, super().fetchone)
+
+    def fetchmany(self, *args):
+        return _timed(self.sql, super().fetchmany, *args)
+
+    def fetchall(self):
+        return _timed(self.sql, super().fetchall)
+
+    def __next__(self):
+        return _timed(self.sql, super().__next__)
+
+
+class ProfilingConnection(Connection):
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def commit(self):
+        return _timed('commit', super().commit)
+
+    def rollback(self):
+        return _timed('rollback', super().rollback)
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread every `interval` seconds, with the statement it's running on top if we're
+    profiling, and counts them as folded stacks: what flamegraph.pl, speedscope and friends read.
+    """
+
+    def __init__(self, thread: Optional[int] = None, interval: float = 0.001):
+        self.thread = threading.get_ident() if thread is None else thread
+        self.interval = interval
+        self.samples: dict[str, int] = defaultdict(int)
+        self.stopped = threading.Event()
+        self.sampler: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self._run, daemon=True)
+        self.sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.sampler.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread)
+            stack = []
+            while frame is not None:
+                stack.append(f'{frame.f_code.co_name} ({Path(frame.f_code.co_filename).name})')
+                frame = frame.f_back
+            if not stack:
+                continue
+            stack.reverse()
+            sql = _running.get(self.thread)
+            if sql is not None:
+                stack.append(' '.join(sql.split()))
+            self.samples[';'.join(name.replace(';', ',') for name in stack)] += 1
+
+    def dump(self, file: TextIO):
+        for stack, count in sorted(self.samples.items()):
+            file.write(f'{stack} {count}\n')
+
+
+def connect_to_db(location: Optional[Path] = None, read_only: bool = False) -> sqlite3.Connection:
     """
     Connect to a sqlite database with the correct settings.
     If no argument is passed, this function checks the DB_LOCATION environment variable.
     If DB_LOCATION is not set, it defaults to opening an in-memory database (:memory:).
+    A read only connection can't write, and doesn't try to change the journal mode. In-memory databases ignore it.
     It's the responsibility of the caller to close the database connection.
     """
     # Take from environment variable if not passed in, fall back on :memory: if that's not present
     location = os.environ.get('DB_LOCATION', ':memory:') if location is None else location
-    conn = sqlite3.connect(location, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+    read_only = read_only and str(location) != ':memory:'
+    conn = sqlite3.connect(
+        f'{Path(location).resolve().as_uri()}?mode=ro' if read_only else location,
+        uri=read_only, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES,
+        factory=ProfilingConnection if profiling else Connection
+    )
+    for pragma, value in PRAGMAS.items():
+        if not (read_only and pragma == 'journal_mode'):
+            conn.execute(f'pragma {pragma}={value}')
+    if read_only:
+        conn.execute('pragma query_only=true')
     return conn
 
 
+class ConnectionPool:
+    """
+    Keeps up to `size` idle connections to one database, so requests don't pay for connecting and configuring.
+    Connections are created on demand, so we never block waiting for one, and closed if the pool is already full.
+    """
+
+    def __init__(self, location: Union[Path, str], read_only: bool = False, size: int = POOL_SIZE):
+        self.location = location
+        self.read_only = read_only
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return connect_to_db(self.location, read_only=self.read_only)
+
+    def release(self, conn: sqlite3.Connection):
+        # Whatever the request didn't commit, it didn't want
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools: dict[tuple[str, bool], ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(read_only: bool = False) -> ConnectionPool:
+    """Pool for the database at DB_LOCATION. Read only connections get a separate pool."""
+    key = (os.environ.get('DB_LOCATION', ':memory:'), read_only)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(key[0], read_only=read_only)
+        return _pools[key]
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+# Lock files of the databases this process is the writer of, see claim_writer. Open for as long as we live.
+_claimed: dict[str, TextIO] = {}
+_claimed_lock = threading.Lock()
+
+
+def claim_writer(location: Union[Path, str]):
+    """
+    Make sure we're the only process writing to the database at location, or raise RuntimeError.
+    The engine keeps the books in memory, so a second process matching orders would trade against stale books.
+    With several API processes, order entry has to go through a sequencer, see sequencer.py, and that's the writer.
+    Holds a lock on location.writer until this process exits. In-memory databases are ours alone anyway.
+    """
+    if str(location) == ':memory:':
+        return
+    path = str(Path(location).resolve())
+    with _claimed_lock:
+        if path in _claimed:
+            return
+        file = open(f'{path}.writer', 'w')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            raise RuntimeError(f'Another process is writing to {location} already. To run more than one API process, '
+                               'start a sequencer and set SEQUENCER_ADDRESS.')
+        file.write(f'{os.getpid()}\n')
+        file.flush()
+        _claimed[path] = file
+
+
 def db_cursor() -> sqlite3.Cursor:
     """db_connection for use with FastAPI. Otherwise, we're allowing callers to connect to arbitrary databases."""
-    conn = connect_to_db(None)
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn.cursor()
+    finally:
+        pool.release(conn)
+
+
+def db_read_cursor() -> sqlite3.Cursor:
+    """Like db_cursor, but read only, so GET endpoints don't contend with order entry."""
+    pool = get_pool(read_only=True)
+    conn = pool.acquire()
     try:
         yield conn.cursor()
     finally:
-        conn.close()
+        pool.release(conn)
 
 
 def query(c: Union[sqlite3.Connection, sqlite3.Cursor], sql: str, data: tuple = None) -> list[dict[str, Any]]:
@@ -1,109 +1,787 @@
-from collections import defaultdict
+from bisect import bisect_left, insort
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 import json
+import logging
 import sqlite3
+import threading
+from time import perf_counter
+from typing import Callable, Optional, Union
+import weakref
 
+from db_utils import DEFAULT_INSTRUMENT
+import capture
+import journal
+import metrics
+import positions
 
-def insert_order(book: sqlite3.Cursor, participant_id: str, price: int, amount: int):
+logger = logging.getLogger(__name__)
+
+
+class RestingOrder:
+    __slots__ = ('participant_id', 'price', 'amount', 'logical_timestamp')
+
+    def __init__(self, participant_id, price: int, amount: int, logical_timestamp: int):
+        self.participant_id = participant_id
+        self.price = price
+        self.amount = amount
+        self.logical_timestamp = logical_timestamp
+
+    def __repr__(self):
+        return f'RestingOrder({self.participant_id}, {self.price}, {self.amount}, {self.logical_timestamp})'
+
+
+class PriceLevels:
+    """
+    The price levels of a book: a sorted list of prices per side, and the total absolute amount and number of
+    orders at every price. That's all it takes to read the depth and the best prices. API processes keep just this
+    when the sequencer does the matching, see follow: level events say what a level looks like now, so they can be
+    applied as they come, without ever reading the whole book again.
+    """
+
+    def __init__(self):
+        # Keyed by "is this the buy side?"
+        self.prices: dict[bool, list[int]] = {True: [], False: []}
+        self.sizes: dict[bool, dict[int, int]] = {True: {}, False: {}}
+        self.counts: dict[bool, dict[int, int]] = {True: {}, False: {}}
+
+    @classmethod
+    def from_db(cls, c: Union[sqlite3.Connection, sqlite3.Cursor],
+                instrument: str = DEFAULT_INSTRUMENT) -> 'PriceLevels':
+        levels = cls()
+        for is_buy, price, amount, orders in c.execute(
+                'select amount > 0 as buy, price, sum(abs(amount)), count(*) from exchange where instrument=? '
+                'group by buy, price', (instrument,)):
+            levels.set(bool(is_buy), price, amount, orders)
+        return levels
+
+    def set(self, is_buy: bool, price: int, amount: int, orders: int):
+        sizes = self.sizes[is_buy]
+        if orders:
+            if price not in sizes:
+                insort(self.prices[is_buy], price)
+            sizes[price] = amount
+            self.counts[is_buy][price] = orders
+        elif price in sizes:
+            del sizes[price]
+            del self.counts[is_buy][price]
+            prices = self.prices[is_buy]
+            del prices[bisect_left(prices, price)]
+
+    def apply(self, event: dict):
+        """Apply a level event, see Changes.events."""
+        self.set(event['side'] == 'buy', event['price'], event['amount'], event['orders'])
+
+    def orders_at(self, is_buy: bool, price: int) -> int:
+        return self.counts[is_buy].get(price, 0)
+
+    def best(self, is_buy: bool) -> Optional[int]:
+        prices = self.prices[is_buy]
+        if not prices:
+            return None
+        return prices[-1] if is_buy else prices[0]
+
+    def depth(self, is_buy: bool, n: Optional[int] = None) -> list[dict]:
+        """Aggregated price levels on one side, best first. If n is given, only the best n levels."""
+        prices = self.prices[is_buy]
+        n = len(prices) if n is None else min(n, len(prices))
+        best_first = reversed(prices[len(prices) - n:]) if is_buy else prices[:n]
+        return [{'price': price, 'amount': self.sizes[is_buy][price], 'orders': self.orders_at(is_buy, price)}
+                for price in best_first]
+
+    def level(self, is_buy: bool, price: int) -> dict:
+        """Aggregated state of one price level, zero if there is nothing resting."""
+        return {'side': 'buy' if is_buy else 'sell', 'price': price, 'amount': self.sizes[is_buy].get(price, 0),
+                'orders': self.orders_at(is_buy, price)}
+
+
+class OrderBook(PriceLevels):
+    """
+    Price-time priority order book for one instrument, held in memory.
+    Each side keeps a sorted list of prices and, per price, a FIFO queue of orders keyed by logical timestamp,
+    so we can match without touching SQL and cancel in O(1). The exchange table is a durable mirror of this book.
+    Positive amounts are bids, negative amounts are asks.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.orders: dict[int, RestingOrder] = {}
+        self.levels: dict[bool, dict[int, OrderedDict[int, RestingOrder]]] = {True: {}, False: {}}
+
+    @classmethod
+    def from_db(cls, c: Union[sqlite3.Connection, sqlite3.Cursor], instrument: str = DEFAULT_INSTRUMENT) -> 'OrderBook':
+        # Read each side in priority order straight off the exchange_bids/exchange_asks covering indexes,
+        # so every order is appended to the end of its level and we never hold the whole table in memory twice.
+        book = cls()
+        for side in ('amount > 0', 'amount < 0'):
+            rows = c.execute('select participant_id, price, amount, logical_timestamp from exchange '
+                             f'where instrument=? and {side} order by price asc, logical_timestamp asc', (instrument,))
+            for row in rows:
+                book.add(RestingOrder(*row))
+        return book
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __contains__(self, logical_timestamp: int):
+        return logical_timestamp in self.orders
+
+    def get(self, logical_timestamp: int) -> Optional[RestingOrder]:
+        return self.orders.get(logical_timestamp)
+
+    def add(self, order: RestingOrder):
+        is_buy = order.amount > 0
+        levels = self.levels[is_buy]
+        if order.price not in levels:
+            levels[order.price] = OrderedDict()
+            self.sizes[is_buy][order.price] = 0
+            insort(self.prices[is_buy], order.price)
+        levels[order.price][order.logical_timestamp] = order
+        self.sizes[is_buy][order.price] += abs(order.amount)
+        self.orders[order.logical_timestamp] = order
+
+    def remove(self, logical_timestamp: int) -> RestingOrder:
+        order = self.orders.pop(logical_timestamp)
+        is_buy = order.amount > 0
+        level = self.levels[is_buy][order.price]
+        del level[logical_timestamp]
+        self.sizes[is_buy][order.price] -= abs(order.amount)
+        if not level:
+            self._drop_level(is_buy, order.price)
+        return order
+
+    def reduce(self, logical_timestamp: int, amount: int):
+        """Shrink a resting order to amount, with the same sign, keeping its place in the queue."""
+        order = self.orders[logical_timestamp]
+        self.sizes[order.amount > 0][order.price] -= abs(order.amount) - abs(amount)
+        order.amount = amount
+
+    def _drop_level(self, is_buy: bool, price: int):
+        del self.levels[is_buy][price]
+        del self.sizes[is_buy][price]
+        prices = self.prices[is_buy]
+        del prices[bisect_left(prices, price)]
+
+    def orders_at(self, is_buy: bool, price: int) -> int:
+        return len(self.levels[is_buy].get(price, ()))
+
+    def match(self, order: RestingOrder) -> list[tuple[RestingOrder, int]]:
+        """
+        Match an incoming order against the opposite side, best price first and oldest first within a price.
+        Returns a list of (counter order, traded amount) where the traded amount has the sign of the counter order.
+        Fully filled counter orders are removed from the book, and order.amount is left at the unfilled remainder.
+        The incoming order itself is never added: whether it rests is up to the caller.
+        """
+        buying = order.amount > 0
+        fills = []
+        while order.amount != 0:
+            best = self.best(not buying)
+            if best is None or (best > order.price if buying else best < order.price):
+                break
+            level = self.levels[not buying][best]
+            while order.amount != 0 and level:
+                counter = next(iter(level.values()))
+                quantity = min(abs(order.amount), abs(counter.amount))
+                traded = quantity if counter.amount > 0 else -quantity
+                counter.amount -= traded
+                order.amount += traded
+                self.sizes[not buying][best] -= quantity
+                fills.append((counter, traded))
+                if counter.amount == 0:
+                    del level[counter.logical_timestamp]
+                    del self.orders[counter.logical_timestamp]
+            if not level:
+                self._drop_level(not buying, best)
+        return fills
+
+
+# Books are cached per database file and instrument, so every connection to the same file shares them.
+# In-memory databases are private to their connection, so those books live as long as the connection does.
+# Note that this assumes this process is the only one writing to the exchange table. With several API processes,
+# order entry goes through the sequencer process (see sequencer.py), and the others only keep the price levels of
+# every book, from the level events it sends, see follow.
+# Requests in different threads share a book through different connections, so everything that touches a book
+# holds the engine lock, from reading the book up to and including the commit.
+_books: dict[str, dict[str, OrderBook]] = {}
+_followed: dict[str, dict[str, PriceLevels]] = {}
+_memory_books = weakref.WeakKeyDictionary()
+engine_lock = threading.RLock()
+
+
+def _connection(c: Union[sqlite3.Connection, sqlite3.Cursor]) -> sqlite3.Connection:
+    return c if isinstance(c, sqlite3.Connection) else c.connection
+
+
+def _book_cache(c: Union[sqlite3.Connection, sqlite3.Cursor]) -> tuple[Union[dict, weakref.WeakKeyDictionary], object]:
+    conn = _connection(c)
+    location = getattr(conn, 'location', None)
+    if location is None:
+        _, _, location = conn.execute('pragma database_list').fetchone()
+        conn.location = location  # db_utils.Connection can hold on to this, so we only ask once
+    return (_books, location) if location else (_memory_books, conn)
+
+
+def get_book(c: Union[sqlite3.Connection, sqlite3.Cursor], instrument: str = DEFAULT_INSTRUMENT) -> OrderBook:
+    """Get the in-memory book for the database c is connected to, loading it from the exchange table if needed."""
+    cache, key = _book_cache(c)
+    with engine_lock:
+        books = cache.setdefault(key, {})
+        if instrument not in books:
+            books[instrument] = OrderBook.from_db(c, instrument)
+        return books[instrument]
+
+
+def follow(c: Union[sqlite3.Connection, sqlite3.Cursor]) -> str:
+    """
+    Read the books of the database c is connected to as price levels kept up to date with apply_levels, rather than
+    books loaded from the database. For processes that get told about every change by the one process that matches.
+    Returns the location to give apply_levels.
+    """
+    cache, key = _book_cache(c)
+    if cache is not _books:
+        raise ValueError("Can't follow an in-memory database from elsewhere.")
+    with engine_lock:
+        _followed.setdefault(key, {})
+    return key
+
+
+def apply_levels(location: str, events: list[dict]):
+    """Apply level events committed elsewhere to the price levels we're following, see follow."""
+    with engine_lock:
+        followed = _followed.get(location, {})
+        for event in events:
+            if event['type'] == 'level' and event['instrument'] in followed:
+                followed[event['instrument']].apply(event)
+
+
+def read_book(c: Union[sqlite3.Connection, sqlite3.Cursor], instrument: str = DEFAULT_INSTRUMENT) -> PriceLevels:
+    """The book to read the depth and best prices from: its price levels if we follow it, otherwise the book."""
+    cache, key = _book_cache(c)
+    with engine_lock:
+        followed = _followed.get(key) if cache is _books else None
+        if followed is None:
+            return get_book(c, instrument)
+        if instrument not in followed:
+            # Level events for commits that this already has can still be on their way, but applying them again
+            # only sets those levels to what they were until the events after them come in
+            followed[instrument] = PriceLevels.from_db(c, instrument)
+        return followed[instrument]
+
+
+def _book_gauge(read: Callable[[OrderBook, bool], int]) -> Callable[[], dict[tuple[str, str], int]]:
+    def gauge():
+        values = defaultdict(int)
+        for books in [*_books.values(), *_memory_books.values()]:
+            for instrument, book in list(books.items()):
+                for is_buy, side in ((True, 'buy'), (False, 'sell')):
+                    values[instrument, side] += read(book, is_buy)
+        return values
+    return gauge
+
+
+metrics.register(metrics.Gauge('engine_price_levels', 'Price levels in the books held in memory.',
+                               ('instrument', 'side'), _book_gauge(lambda book, is_buy: len(book.prices[is_buy]))))
+metrics.register(metrics.Gauge(
+    'engine_resting_amount', 'Total amount resting in the books held in memory.', ('instrument', 'side'),
+    _book_gauge(lambda book, is_buy: sum(book.sizes[is_buy].values()))
+))
+
+
+def commit(c: Union[sqlite3.Connection, sqlite3.Cursor]):
+    start = perf_counter()
+    _connection(c).commit()
+    metrics.commit_time.observe(perf_counter() - start)
+    capture.committed()
+
+
+def drop_book(c: Union[sqlite3.Connection, sqlite3.Cursor], instrument: Optional[str] = None):
+    """Forget the in-memory book (or all books), so it gets reloaded from the exchange table on next use."""
+    cache, key = _book_cache(c)
+    with engine_lock:
+        if instrument is None:
+            cache.pop(key, None)
+        else:
+            cache.get(key, {}).pop(instrument, None)
+
+
+class Changes:
+    """What one or more engine calls did, to tell the listeners about once it's committed."""
+
+    def __init__(self):
+        self.trades: list[dict] = []
+        self.levels: set[tuple[str, bool, int]] = set()  # (instrument, is buy, price)
+
+    def events(self, c: Union[sqlite3.Connection, sqlite3.Cursor]) -> list[dict]:
+        """
+        Trades in the order they happened, then the new state of every price level that changed, all with the
+        journal sequence number of the commit, the same in every process.
+        """
+        levels = [{'type': 'level', 'instrument': instrument, **get_book(c, instrument).level(is_buy, price)}
+                  for instrument, is_buy, price in sorted(self.levels)]
+        journaled = journal.appended()
+        return [{**event, 'journal': journaled} for event in self.trades + levels]
+
+
+# Called with a list of events after every commit that changed the book, while holding the engine lock,
+# so listeners see changes in the order they happened. They shouldn't do anything slow.
+listeners: list[Callable[[list[dict]], None]] = []
+
+
+def subscribe(listener: Callable[[list[dict]], None]):
+    listeners.append(listener)
+
+
+def publish(c: Union[sqlite3.Connection, sqlite3.Cursor], changes: Changes):
+    notify(changes.events(c))
+
+
+def notify(events: list[dict]):
+    """Hand events to the listeners. Only call this yourself for events committed elsewhere, like the sequencer."""
+    if not events:
+        return
+    for listener in listeners:
+        try:
+            listener(events)
+        except Exception:
+            # The changes are committed already, a broken listener shouldn't make order entry fail
+            logger.exception('Listener %s failed', listener)
+
+
+def depth(c: Union[sqlite3.Connection, sqlite3.Cursor], n: Optional[int] = None,
+          instrument: str = DEFAULT_INSTRUMENT) -> dict[str, list[dict]]:
+    """Aggregated depth of the book for the database c is connected to, see OrderBook.depth."""
+    with engine_lock:
+        book = read_book(c, instrument)
+        return {'buy': book.depth(True, n), 'sell': book.depth(False, n)}
+
+
+def mark_price(c: Union[sqlite3.Connection, sqlite3.Cursor], instrument: str = DEFAULT_INSTRUMENT,
+               prefer: str = 'mid') -> Optional[float]:
+    """
+    Price to value positions at: the middle of the best bid and ask, or the last trade price.
+    Falls back to the other one, if what we prefer isn't there, and returns None if neither is.
+    """
+    with engine_lock:
+        book = read_book(c, instrument)
+        bid, ask = book.best(True), book.best(False)
+    mid = None if bid is None or ask is None else (bid + ask) / 2
+    if prefer == 'mid' and mid is not None:
+        return mid
+    last = c.execute('select price from trades where instrument=? order by sequence desc limit 1',
+                     (instrument,)).fetchone()
+    return mid if last is None else last[0]
+
+
+def insert_order(book: sqlite3.Cursor, participant_id: str, price: int, amount: int,
+                 instrument: str = DEFAULT_INSTRUMENT):
     book.execute(
-        'insert into exchange(participant_id, price, amount) values(:participant_id, :price, :amount)',
-        {'participant_id': participant_id, 'price': price, 'amount': amount})
+        'insert into exchange(participant_id, instrument, price, amount) '
+        'values(:participant_id, :instrument, :price, :amount)',
+        {'participant_id': participant_id, 'instrument': instrument, 'price': price, 'amount': amount})
     return book.lastrowid
 
 
-def limit_order(c: sqlite3.Cursor, *, participant_id: str, price: int, amount: int, time_in_force='GTC') -> int:
-    assert time_in_force in ('GTC', 'IOC')
-    assert price > 0
-    # print('limit order', participant_id, price, amount, time_in_force)
+def get_stock(c: sqlite3.Cursor, participant_id, instrument: str = DEFAULT_INSTRUMENT) -> int:
+    stock = c.execute('select stock from positions where participant_id=? and instrument=?',
+                      (participant_id, instrument)).fetchone()
+    return 0 if stock is None else stock[0]
+
+
+def check_order(c: sqlite3.Cursor, *, participant_id: str, price: int, amount: int, time_in_force='GTC',
+                instrument: str = DEFAULT_INSTRUMENT):
+    """Raise if this order may not be placed. Doesn't write anything, so there is nothing to roll back."""
+    assert time_in_force in ('GTC', 'IOC'), f'Unknown time in force {time_in_force}.'
+    assert price > 0, 'Price must be positive.'
+    if c.execute('select 1 from instruments where symbol=?', (instrument,)).fetchone() is None:
+        raise Exception(f'Unknown instrument {instrument}.')
 
     # Check if allowed: no short restriction is active
-    stock_in_account, *_ = c.execute('select stock from accounts where participant_id=?', (participant_id,)).fetchone()
-    if stock_in_account + amount < 0: raise Exception('Shorting is not allowed.')
-
-    # Insert transaction into order book, so it gets a timestamp
-    timestamp = insert_order(c, participant_id=participant_id, price=price, amount=amount)
-
-    # Fetch matching transactions from the order c
-    if amount > 0:
-        matching = c.execute(
-            'select participant_id, logical_timestamp, amount, price '
-            'from exchange where amount < 0 and price <= ? order by price asc, logical_timestamp asc',
-            (price,)
-        ).fetchall()
-    else:
-        matching = c.execute(
-            'select participant_id, logical_timestamp, amount, price '
-            'from exchange where amount > 0 and price >= ? order by price desc, logical_timestamp asc',
-            (price,)
-        ).fetchall()
+    if get_stock(c, participant_id, instrument) + amount < 0: raise Exception('Shorting is not allowed.')
 
-    # Fulfill transactions in turn
-    remaining = amount
-    delta = defaultdict(lambda: [])
-    log = []
-    fulfilled = []
-    for idx, ts, counter_amount, price in matching:
-        if remaining > -counter_amount:
-            # "Eat" this order, still some appetite left
-            remaining += counter_amount
-
-            # Note: during the accounts update below, we subtract from balance and add to stock.
-            # If counter_amount > 0, counterparty is buying, so balance needs to shrink and stock to grow
-            # If counter_amount < 0, counterparty is selling, so balance needs to grow and stock to shrink
-            delta[idx].append((counter_amount, price))
-            delta[participant_id].append((-counter_amount, price))
-
-            fulfilled.append(ts)
-            log.append((idx, counter_amount, price))
-        elif remaining == -counter_amount:
-            # "Eat" this order, appetite fulfilled
-            delta[idx].append((counter_amount, price))
-            delta[participant_id].append((-counter_amount, price))
-
-            fulfilled.append(ts)
-            fulfilled.append(timestamp)
-            log.append((idx, counter_amount, price))
-            break
-        elif remaining < -counter_amount:
-            # Appetite fulfilled, but this order too big
-            c.execute('update exchange set amount=? where logical_timestamp=?', (counter_amount + remaining, ts))
-
-            # Signs reversed here compared to above because remaining has the opposite sign to counter_amount.
-            # Easier to program this by just writing a test! See test_engine.py
-            delta[idx].append((-remaining, price))
-            delta[participant_id].append((remaining, price))
-
-            fulfilled.append(timestamp)
-            log.append((idx, counter_amount, price))
-            break
-        else:
-            raise Exception('Unexpected logic error')
+
+def match_order(c: sqlite3.Cursor, *, participant_id: str, price: int, amount: int, time_in_force='GTC',
+                instrument: str = DEFAULT_INSTRUMENT,
+                changes: Optional[Changes] = None) -> tuple[int, list[tuple[RestingOrder, int]]]:
+    """
+    Match a checked order against the book and write the result, without committing.
+    Returns the logical timestamp of the order and its fills, see OrderBook.match, and records them in changes.
+    If this raises, the caller has to roll back and drop the book.
+    """
+    start = perf_counter()
+    book = get_book(c, instrument)
+    # Insert transaction into exchange table, so it gets a timestamp
+    timestamp = insert_order(c, participant_id=participant_id, price=price, amount=amount, instrument=instrument)
+
+    # Match in memory, then mirror the result to the exchange table
+    matching = perf_counter()
+    order = RestingOrder(participant_id, price, amount, timestamp)
+    fills = book.match(order)
+    if order.amount != 0 and time_in_force == 'GTC':
+        book.add(order)
+    matching = perf_counter() - matching
+
+    c.executemany('delete from exchange where logical_timestamp=?',
+                  [(counter.logical_timestamp,) for counter, _ in fills if counter.amount == 0])
+    c.executemany('update exchange set amount=? where logical_timestamp=?',
+                  [(counter.amount, counter.logical_timestamp) for counter, _ in fills if counter.amount != 0])
+    if timestamp in book:
+        if order.amount != amount:
+            c.execute('update exchange set amount=? where logical_timestamp=?', (order.amount, timestamp))
     else:
-        # We fell off the end there: this means our order did not get completely fulfilled
-        if time_in_force == 'GTC':
-            c.execute('update exchange set amount=? where logical_timestamp=?', (remaining, timestamp))
-        else:
-            fulfilled.append(timestamp)
-    c.executemany('delete from exchange where logical_timestamp=?', [(ts,) for ts in fulfilled])
+        c.execute('delete from exchange where logical_timestamp=?', (timestamp,))
 
     # Update account balances
-    updates = [(sum(amount*price for amount, price in values), sum(amount for amount, _ in values), idx)
-               for idx, values in delta.items()]
-    c.executemany('update accounts set balance=balance-?, stock=stock+? where participant_id=?', updates)
-    c.connection.commit()
+    # Note: we subtract from balance and add to stock. The traded amount has the sign of the counter order, so
+    # if it's > 0, counterparty is buying, so balance needs to shrink and stock to grow, and vice versa.
+    delta = defaultdict(int)
+    for counter, traded in fills:
+        delta[counter.participant_id] += traded * counter.price
+        delta[participant_id] -= traded * counter.price
+    c.executemany('update accounts set balance=balance-? where participant_id=?',
+                  [(cash, idx) for idx, cash in delta.items()])
+    if fills:
+        # Positions go fill by fill, in the same order the journal replays them in
+        held = {idx: (stock, cost, realized) for idx, stock, cost, realized in c.execute(
+            'select participant_id, stock, cost, realized from positions '
+            'where instrument=? and participant_id in (select value from json_each(?))',
+            (instrument, json.dumps(list(delta)))
+        )}
+        for counter, traded in fills:
+            held[participant_id] = positions.fill(*held.get(participant_id, (0, 0.0, 0.0)), counter.price, -traded)
+            held[counter.participant_id] = positions.fill(*held.get(counter.participant_id, (0, 0.0, 0.0)),
+                                                          counter.price, traded)
+        c.executemany('insert into positions(participant_id, instrument, stock, cost, realized) values (?, ?, ?, ?, ?) '
+                      'on conflict do update set stock=excluded.stock, cost=excluded.cost, realized=excluded.realized',
+                      [(idx, instrument, *position) for idx, position in held.items()])
 
-    log = [
+    now = datetime.now()
+    trades = [
         {
             'type': 'trade',
-            'buyer': participant_id,
-            'seller': idx,
-            'amount': -counter_amount if amount > 0 else counter_amount,
-            'price': price
+            'instrument': instrument,
+            'timestamp': str(now),
+            'buyer': participant_id if amount > 0 else counter.participant_id,
+            'seller': counter.participant_id if amount > 0 else participant_id,
+            'amount': abs(traded),
+            'price': counter.price
         }
-        for idx, counter_amount, price in log
+        for counter, traded in fills
     ]
-    c.executemany('insert into log(event, timestamp) values (?, ?)',
-                  [(json.dumps(item), datetime.now()) for item in log])
-    c.connection.commit()
+    c.executemany('insert into trades(instrument, timestamp, buyer, seller, price, amount) values (?, ?, ?, ?, ?, ?)',
+                  [(instrument, now, item['buyer'], item['seller'], item['price'], item['amount']) for item in trades])
+    if trades:
+        # The rows we just inserted are the last ones, nobody else can write in the meantime
+        last, = c.execute("select seq from sqlite_sequence where name='trades'").fetchone()
+        for sequence, trade in enumerate(trades, last - len(trades) + 1):
+            trade['sequence'] = sequence
+    journal.append(c, {
+        'type': 'order', 'logical_timestamp': timestamp, 'participant_id': participant_id, 'instrument': instrument,
+        'price': price, 'amount': amount, 'time_in_force': time_in_force,
+        'fills': [(counter.logical_timestamp, counter.price, -traded) for counter, traded in fills],
+        'resting': order.amount if timestamp in book else 0,
+    })
+
+    if changes is not None:
+        changes.trades.extend(trades)
+        changes.levels.update((instrument, not (amount > 0), counter.price) for counter, _ in fills)
+        if timestamp in book:
+            changes.levels.add((instrument, amount > 0, price))
+    metrics.match_time.observe(matching, 'python')
+    metrics.match_time.observe(perf_counter() - start - matching, 'sql')
+    metrics.fills.observe(len(fills))
+    return timestamp, fills
+
 
+def limit_order(c: sqlite3.Cursor, *, participant_id: str, price: int, amount: int, time_in_force='GTC',
+                instrument: str = DEFAULT_INSTRUMENT) -> int:
+    # print('limit order', participant_id, price, amount, time_in_force)
+    with engine_lock:
+        check_order(c, participant_id=participant_id, price=price, amount=amount, time_in_force=time_in_force,
+                    instrument=instrument)
+        changes = Changes()
+        try:
+            timestamp, _ = match_order(
+                c, participant_id=participant_id, price=price, amount=amount, time_in_force=time_in_force,
+                instrument=instrument, changes=changes
+            )
+            commit(c)
+        except Exception:
+            # The book may be ahead of the database now, start over from what actually got committed
+            c.connection.rollback()
+            drop_book(c, instrument)
+            raise
+        publish(c, changes)
     return timestamp
+
+
+def limit_orders(c: sqlite3.Cursor, orders: list[dict]) -> list[dict]:
+    """
+    Submit a batch of orders in arrival order, in a single transaction with a single commit.
+    Each order is a dict with the keyword arguments of limit_order. A rejected order doesn't affect the others:
+    its result is {'error': reason}, otherwise it's {'logical_timestamp': ..., 'fills': [...]} where every fill has
+    the logical timestamp of the counter order, the price and the amount traded (positive means we bought).
+    """
+    with engine_lock:
+        if not c.connection.in_transaction:
+            c.execute('begin')
+        results = []
+        changes = Changes()
+        try:
+            for order in orders:
+                try:
+                    check_order(c, **order)
+                except Exception as e:
+                    results.append({'error': str(e)})
+                    continue
+
+                c.execute('savepoint batch_order')
+                try:
+                    timestamp, fills = match_order(c, **order, changes=changes)
+                except Exception as e:
+                    # Only undo this order. The book reloads from what this transaction has written so far.
+                    c.execute('rollback to batch_order')
+                    drop_book(c, order.get('instrument', DEFAULT_INSTRUMENT))
+                    results.append({'error': str(e)})
+                else:
+                    results.append({
+                        'logical_timestamp': timestamp,
+                        'fills': [
+                            {'logical_timestamp': counter.logical_timestamp, 'price': counter.price, 'amount': -traded}
+                            for counter, traded in fills
+                        ]
+                    })
+                c.execute('release batch_order')
+            commit(c)
+        except Exception:
+            c.connection.rollback()
+            drop_book(c)
+            raise
+        publish(c, changes)
+    return results
+
+
+def cancel_order(c: sqlite3.Cursor, *, participant_id, logical_timestamp: int,
+                 instrument: str = DEFAULT_INSTRUMENT) -> bool:
+    """Cancel a single resting order. Returns False if participant_id has no resting order with this timestamp."""
+    return bool(cancel_orders(c, participant_id=participant_id, logical_timestamps=[logical_timestamp],
+                              instrument=instrument))
+
+
+def _delete_orders(c: sqlite3.Cursor, book: OrderBook, orders: list[RestingOrder], changes: Changes,
+                   instrument: str):
+    """Delete resting orders in one statement and journal it, without committing."""
+    c.execute('delete from exchange where logical_timestamp in (select value from json_each(?))',
+              (json.dumps([order.logical_timestamp for order in orders]),))
+    journal.append(c, {'type': 'cancel', 'participant_id': orders[0].participant_id,
+                       'logical_timestamps': [order.logical_timestamp for order in orders]})
+    for order in orders:
+        book.remove(order.logical_timestamp)
+        changes.levels.add((instrument, order.amount > 0, order.price))
+
+
+def cancel_orders(c: sqlite3.Cursor, *, participant_id, logical_timestamps: list[int],
+                  instrument: str = DEFAULT_INSTRUMENT) -> list[int]:
+    """
+    Cancel resting orders in one instrument, returning the logical timestamps of the ones that got cancelled.
+    Timestamps that aren't resting orders of participant_id (anymore) are skipped.
+    """
+    with engine_lock:
+        book = get_book(c, instrument)
+        orders = {ts: book.get(ts) for ts in logical_timestamps}
+        orders = [order for order in orders.values() if order is not None and order.participant_id == participant_id]
+        if not orders:
+            return []
+        changes = Changes()
+        try:
+            _delete_orders(c, book, orders, changes, instrument)
+            commit(c)
+        except Exception:
+            c.connection.rollback()
+            drop_book(c, instrument)
+            raise
+        publish(c, changes)
+    return [order.logical_timestamp for order in orders]
+
+
+def amend_order(c: sqlite3.Cursor, *, participant_id, logical_timestamp: int, price: Optional[int] = None,
+                size: Optional[int] = None, instrument: str = DEFAULT_INSTRUMENT) -> Optional[int]:
+    """
+    Change the price and/or size (unsigned, what's left to trade) of a resting order in one transaction.
+    Shrinking it at the same price keeps its time priority. Anything else cancels it and places a new GTC order
+    instead, which can trade right away like any other. Returns the logical timestamp of the order afterwards,
+    or None if participant_id has no resting order with this timestamp.
+    """
+    with engine_lock:
+        book = get_book(c, instrument)
+        order = book.get(logical_timestamp)
+        if order is None or order.participant_id != participant_id:
+            return None
+        price = order.price if price is None else price
+        size = abs(order.amount) if size is None else size
+        assert size > 0, 'Size must be positive, cancel the order instead.'
+        amount = size if order.amount > 0 else -size
+        if price == order.price and size == abs(order.amount):
+            return logical_timestamp
+
+        in_place = price == order.price and size < abs(order.amount)
+        if not in_place:
+            # Before cancelling anything, so a rejected amendment leaves the order alone
+            check_order(c, participant_id=participant_id, price=price, amount=amount, instrument=instrument)
+        changes = Changes()
+        try:
+            if in_place:
+                c.execute('update exchange set amount=? where logical_timestamp=?', (amount, logical_timestamp))
+                journal.append(c, {'type': 'amend', 'logical_timestamp': logical_timestamp, 'amount': amount})
+                book.reduce(logical_timestamp, amount)
+                changes.levels.add((instrument, amount > 0, price))
+            else:
+                _delete_orders(c, book, [order], changes, instrument)
+                logical_timestamp, _ = match_order(c, participant_id=participant_id, price=price, amount=amount,
+                                                   instrument=instrument, changes=changes)
+            commit(c)
+        except Exception:
+            c.connection.rollback()
+            drop_book(c, instrument)
+            raise
+        publish(c, changes)
+    return logical_timestamp
+
+
+def cancel_all_orders(c: sqlite3.Cursor, *, participant_id, instrument: Optional[str] = None) -> list[int]:
+    """Cancel all resting orders of a participant, in one or all instruments, returning their logical timestamps."""
+    with engine_lock:
+        cancelled = c.execute(
+            'delete from exchange where participant_id=? and coalesce(instrument=?, true) '
+            'returning logical_timestamp, instrument',
+            (participant_id, instrument)
+        ).fetchall()
+        if cancelled:
+            journal.append(c, {'type': 'cancel', 'participant_id': participant_id,
+                               'logical_timestamps': [ts for ts, _ in cancelled]})
+        commit(c)
+        changes = Changes()
+        for ts, order_instrument in cancelled:
+            book = get_book(c, order_instrument)
+            if ts in book:
+                order = book.remove(ts)
+                changes.levels.add((order_instrument, order.amount > 0, order.price))
+        publish(c, changes)
+    return [ts for ts, _ in cancelled]
+
+
+# Admin changes that don't touch the books. Rows go in as a JSON array of [participant_id, amount] pairs,
+# see json_each, so it's one statement however many participants there are. None of these commit, the commands
+# after them do.
+def credit_cash(c: sqlite3.Cursor, transfers: list[tuple[int, int]]):
+    """Add amounts to balances."""
+    c.execute(
+        'update accounts set balance = balance + t.amount '
+        "from (select json_extract(value, '$[0]') as participant_id, json_extract(value, '$[1]') as amount "
+        '      from json_each(?)) as t '
+        'where accounts.participant_id = t.participant_id',
+        (json.dumps(transfers),)
+    )
+    journal.append(c, {'type': 'cash', 'transfers': transfers})
+
+
+def credit_stock(c: sqlite3.Cursor, instrument: str, allocations: list[tuple[int, int]]):
+    """Add stock to positions, at no cost. Nothing changes if that would leave anyone short."""
+    short = [participant_id for participant_id, in c.execute(
+        "select t.participant_id from (select json_extract(value, '$[0]') as participant_id, "
+        "                                     sum(json_extract(value, '$[1]')) as stock "
+        '                              from json_each(?) group by 1) as t '
+        'left join positions p on p.participant_id = t.participant_id and p.instrument = ? '
+        'where coalesce(p.stock, 0) + t.stock < 0 order by 1',
+        (json.dumps(allocations), instrument)
+    )]
+    if short:
+        raise ValueError(f'That would leave participant{"s" * (len(short) > 1)} {", ".join(map(str, short))} short.')
+    c.execute(
+        'insert into positions(participant_id, instrument, stock) '
+        "select json_extract(value, '$[0]'), ?, json_extract(value, '$[1]') from json_each(?) where true "
+        # Like positions.allocate
+        'on conflict do update set stock=stock+excluded.stock, cost=case '
+        '  when stock = 0 or stock + excluded.stock = 0 or (stock > 0) != (stock + excluded.stock > 0) then 0.0 '
+        '  when (stock > 0) = (excluded.stock > 0) then cost '
+        '  else cost * (stock + excluded.stock) / stock end',
+        (instrument, json.dumps(allocations))
+    )
+    journal.append(c, {'type': 'position', 'instrument': instrument, 'allocations': allocations})
+
+
+def pay_dividend(c: sqlite3.Cursor, instrument: str, dividend: int) -> tuple[int, int]:
+    """Pay every holder of an instrument (short sellers pay), returning the number of holders and shares."""
+    holders, shares = c.execute('select count(*), coalesce(sum(stock), 0) from positions '
+                                'where instrument=? and stock != 0', (instrument,)).fetchone()
+    c.execute(
+        'update accounts set balance = balance + positions.stock * ? '
+        'from positions '
+        'where positions.participant_id = accounts.participant_id and positions.instrument=? and positions.stock != 0',
+        (dividend, instrument)
+    )
+    c.execute('update positions set realized = realized + stock * ? where instrument=? and stock != 0',
+              (dividend, instrument))
+    journal.append(c, {'type': 'dividend', 'instrument': instrument, 'dividend': dividend})
+    return holders, shares
+
+
+# The admin changes as engine calls that commit, like the order functions, so the API can hand them to a matching
+# worker, or the sequencer if there is one: it's the only process that writes the state, and captures it.
+def transfer_cash(c: sqlite3.Cursor, transfers: list[tuple[int, int]]):
+    with engine_lock:
+        credit_cash(c, transfers)
+        commit(c)
+
+
+def allocate_shares(c: sqlite3.Cursor, instrument: str, allocations: list[tuple[int, int]]):
+    with engine_lock:
+        credit_stock(c, instrument, allocations)
+        commit(c)
+
+
+def distribute_dividend(c: sqlite3.Cursor, instrument: str, dividend: int) -> tuple[int, int]:
+    with engine_lock:
+        holders, shares = pay_dividend(c, instrument, dividend)
+        commit(c)
+    return holders, shares
+
+
+def add_earnings(c: sqlite3.Cursor, instrument: str, amount: int, timestamp: str):
+    earnings = {'type': 'earnings', 'instrument': instrument, 'amount': amount, 'timestamp': timestamp}
+    with engine_lock:
+        c.execute('insert into earnings (instrument, amount, timestamp) values (:instrument, :amount, :timestamp)',
+                  earnings)
+        journal.append(c, earnings)
+        commit(c)
+
+
+def add_instrument(c: sqlite3.Cursor, symbol: str):
+    with engine_lock:
+        if c.execute('insert or ignore into instruments(symbol) values (?)', (symbol,)).rowcount:
+            journal.append(c, {'type': 'instrument', 'symbol': symbol})
+        commit(c)
+
+
+def add_accounts(c: sqlite3.Cursor, accounts: list[tuple[str, str]], balance: int) -> list[int]:
+    """Sign up (name, hashed password) pairs with balance each, returning their participant ids in the same order."""
+    with engine_lock:
+        try:
+            participant_ids = [
+                c.execute('insert into auth(name, hashed_password) values (?, ?) returning participant_id',
+                          account).fetchone()[0]
+                for account in accounts]
+        except sqlite3.IntegrityError:
+            c.connection.rollback()
+            raise ValueError('This user already exists!')
+        c.executemany('insert into accounts(participant_id, balance) values (?, ?)',
+                      [(participant_id, balance) for participant_id in participant_ids])
+        for participant_id in participant_ids:
+            journal.append(c, {'type': 'account', 'participant_id': participant_id, 'balance': balance})
+        commit(c)
+    return participant_ids
+
+
+def order_instrument(c: Union[sqlite3.Connection, sqlite3.Cursor], logical_timestamp: int) -> Optional[str]:
+    """Instrument of a resting order, if there is such an order."""
+    row = c.execute('select instrument from exchange where logical_timestamp=?', (logical_timestamp,)).fetchone()
+    return None if row is None else row[0]
@@ -0,0 +1,149 @@
+import argparse
+import os
+import sqlite3
+from datetime import datetime
+from typing import Iterator, Optional
+
+import numpy as np
+
+from db_utils import connect_to_db
+import tape
+
+# Columnar export for analysis after a game: every dataset is a directory of .npz chunks of at most CHUNK_ROWS rows,
+# with one typed array per column, so a session loads in a moment rather than minutes of paging through /trades:
+#   pandas.DataFrame(export.load(directory, 'trades'))
+# Book snapshots are the aggregated price levels in every journal snapshot there is (one every SNAPSHOT_INTERVAL
+# entries, the last SNAPSHOTS_KEPT of them, see journal.py), plus the book as it is now. Buying levels have buy set,
+# amounts are always positive.
+# Timestamps are local time, like in the database. See analytics.py for what to do with it all.
+CHUNK_ROWS = 100_000
+DATASETS = {
+    'trades': {
+        'sql': 'select sequence, timestamp, instrument, buyer, seller, price, amount from trades '
+               'where sequence > ? and sequence <= ? order by sequence',
+        'columns': {'sequence': 'i8', 'timestamp': 'datetime64[us]', 'instrument': 'U', 'buyer': 'i8',
+                    'seller': 'i8', 'price': 'i8', 'amount': 'i8'},
+    },
+    'earnings': {
+        'sql': 'select timestamp, instrument, amount from earnings order by timestamp',
+        'columns': {'timestamp': 'datetime64[us]', 'instrument': 'U', 'amount': 'i8'},
+    },
+    'dividends': {
+        'sql': "select sequence, timestamp, event ->> 'instrument', event ->> 'dividend' from log "
+               "where event ->> 'type' = 'dividend' order by sequence",
+        'columns': {'sequence': 'i8', 'timestamp': 'datetime64[us]', 'instrument': 'U', 'dividend': 'i8'},
+    },
+    'book': {
+        'sql': "select s.sequence, s.timestamp, o.value ->> 2 as instrument, o.value ->> 4 > 0 as buy, "
+               "  o.value ->> 3 as price, abs(sum(o.value ->> 4)), count(*) "
+               "from snapshots s, json_each(s.state, '$.exchange') o "
+               'group by s.sequence, instrument, buy, price '
+               'order by s.sequence, instrument, buy, price',
+        'columns': {'sequence': 'i8', 'timestamp': 'datetime64[us]', 'instrument': 'U', 'buy': '?', 'price': 'i8',
+                    'amount': 'i8', 'orders': 'i8'},
+    },
+}
+# The current book, as one more snapshot
+CURRENT_BOOK = ('select ?, ?, instrument, amount > 0 as buy, price, abs(sum(amount)), count(*) from exchange '
+                'group by instrument, buy, price order by instrument, buy, price')
+# tape.RECORD, for reading the tape without unpacking it
+TAPE_RECORD = np.dtype([('sequence', '<i8'), ('timestamp', '<i8'), ('kind', 'u1'), ('', 'V7'),
+                        ('instrument', 'S16'), ('price', '<i8'), ('amount', '<i8'), ('buyer', '<i8'),
+                        ('seller', '<i8')])
+assert TAPE_RECORD.itemsize == tape.RECORD.size
+
+
+def columns(dataset: str, rows: list[tuple]) -> dict[str, np.ndarray]:
+    names = DATASETS[dataset]['columns']
+    values = list(zip(*rows)) if rows else [()] * len(names)
+    return {name: np.array(column, dtype=dtype) for (name, dtype), column in zip(names.items(), values)}
+
+
+def _chunks(rows: sqlite3.Cursor, dataset: str, chunk_rows: int) -> Iterator[dict[str, np.ndarray]]:
+    while True:
+        chunk = rows.fetchmany(chunk_rows)
+        if not chunk:
+            return
+        yield columns(dataset, chunk)
+
+
+def _tape_chunks(reader: tape.TapeReader, stop: int, chunk_rows: int) -> Iterator[dict[str, np.ndarray]]:
+    """Trades from the tape, without going through Python for every one of them."""
+    for view in reader.view(stop=stop):
+        records = np.frombuffer(view, dtype=TAPE_RECORD)
+        for start in range(0, len(records), chunk_rows):
+            chunk = records[start:start + chunk_rows]
+            yield {
+                'sequence': chunk['sequence'],
+                'timestamp': chunk['timestamp'].astype('datetime64[us]'),
+                'instrument': np.char.decode(chunk['instrument']),
+                **{name: chunk[name] for name in ('buyer', 'seller', 'price', 'amount')},
+            }
+
+
+def write(c: sqlite3.Cursor, directory: str, reader: Optional[tape.TapeReader] = None,
+          chunk_rows: int = CHUNK_ROWS) -> dict[str, int]:
+    """
+    Export everything in DATASETS to directory, all as of the same moment. Returns the number of rows of each.
+    Trades come from the tape if there is a reader for it, and from the database if they're not on it yet.
+    """
+    rows = {}
+    c.execute('begin')  # Everything from one snapshot of the database
+    try:
+        last, = c.execute('select coalesce(max(sequence), 0) from trades').fetchone()
+        head, = c.execute('select coalesce(max(sequence), 0) from log').fetchone()
+        for dataset, spec in DATASETS.items():
+            os.makedirs(os.path.join(directory, dataset))
+            chunks = []
+            if dataset == 'trades':
+                on_tape = 0
+                if reader is not None:
+                    chunks.append(_tape_chunks(reader, last + 1, chunk_rows))
+                    on_tape = min(last, reader.bounds()[1])
+                chunks.append(_chunks(c.execute(spec['sql'], (on_tape, last)), dataset, chunk_rows))
+            else:
+                chunks.append(_chunks(c.execute(spec['sql']), dataset, chunk_rows))
+            if dataset == 'book':
+                # Its own cursor, c is still going through the snapshots
+                current = c.connection.execute(CURRENT_BOOK, (head, datetime.now())).fetchall()
+                chunks.append([columns('book', current)])
+            rows[dataset] = 0
+            for chunk in (chunk for source in chunks for chunk in source):
+                np.savez(os.path.join(directory, dataset, f'{rows[dataset]:012d}.npz'), **chunk)
+                rows[dataset] += len(chunk['timestamp'])
+            if rows[dataset] == 0:
+                np.savez(os.path.join(directory, dataset, f'{0:012d}.npz'), **columns(dataset, []))
+    finally:
+        c.connection.rollback()
+    return rows
+
+
+def load(directory: str, dataset: str) -> dict[str, np.ndarray]:
+    """A dataset written by write, as one array per column."""
+    path = os.path.join(directory, dataset)
+    chunks = []
+    for name in sorted(os.listdir(path)):
+        with np.load(os.path.join(path, name)) as chunk:
+            chunks.append({column: chunk[column] for column in chunk.files})
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in DATASETS[dataset]['columns']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export trades, earnings, dividends and book snapshots for analysis.')
+    parser.add_argument('directory', help="Where to write them, shouldn't exist yet")
+    parser.add_argument('--db', help='Defaults to DB_LOCATION')
+    parser.add_argument('--tape', help='Read trades from the tape in this directory (TAPE_DIR), see tape.py')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+
+    conn = connect_to_db(args.db, read_only=True)
+    try:
+        reader = tape.TapeReader(os.path.join(args.tape, 'trades')) if args.tape else None
+        rows = write(conn.cursor(), args.directory, reader, args.chunk_rows)
+    finally:
+        conn.close()
+    print(', '.join(f'{count} {dataset}' for dataset, count in rows.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import asyncio
+from collections import deque
+import threading
+from typing import Optional
+
+
+class Subscription:
+    """
+    Messages waiting to be sent to one client. The engine publishes from worker threads, so messages are handed to
+    the client's event loop. If a client falls more than max_queue messages behind, we stop queueing for it and
+    leave a None on its queue: it's up to the client to reconnect and resync, the engine never waits for it.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_queue: int):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=max_queue + 1)  # One extra for the None
+        self.max_queue = max_queue
+        self.lagging = False
+
+    def push(self, message: dict):
+        self.loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message: dict):
+        if self.lagging:
+            return
+        if self.queue.qsize() >= self.max_queue:
+            self.lagging = True
+            message = None
+        self.queue.put_nowait(message)
+
+
+class MarketDataFeed:
+    """
+    Fans engine events out to subscribers, one message for the events of every commit. Messages are numbered with the
+    journal sequence number of the commit: it's the same in every API process, so a client can pick up where it
+    left off on any of them. They go up, but not necessarily by one.
+    The last `history` messages are kept, so a client that got disconnected can catch up from the last sequence
+    number it saw. If that's too far back, or from before we were around, it gets a fresh snapshot instead.
+    """
+
+    def __init__(self, history: int = 10_000, max_queue: int = 1_000):
+        self.sequence: Optional[int] = None  # Of the last message, None until there's been one
+        self.complete_after: Optional[int] = None  # We have every message after this sequence number
+        self.history: deque[dict] = deque(maxlen=history)
+        self.max_queue = max_queue
+        self.subscriptions: set[Subscription] = set()
+        self.lock = threading.Lock()
+
+    def publish(self, events: list[dict]):
+        """Engine listener, see engine.subscribe. Gets the events of one commit, with its journal sequence number."""
+        with self.lock:
+            if self.sequence is not None and events[0]['journal'] <= self.sequence:
+                self.history.clear()  # The journal started over, say it was restored, so we do too
+            self.sequence = events[0]['journal']
+            if not self.history:
+                self.complete_after = self.sequence - 1  # Whatever came before that was before our time
+            elif len(self.history) == self.history.maxlen:
+                self.complete_after = self.history[0]['sequence']
+            message = {'type': 'events', 'sequence': self.sequence, 'events': events}
+            self.history.append(message)
+            for subscription in self.subscriptions:
+                subscription.push(message)
+
+    def subscribe(self, loop: asyncio.AbstractEventLoop,
+                  since: Optional[int] = None) -> tuple[Subscription, Optional[list[dict]], Optional[int]]:
+        """
+        Start receiving messages after the current sequence number, which is returned too (None before the first
+        message, a snapshot with that can't be resumed from).
+        If since is given and we still have every message after it, those are returned to replay first, otherwise
+        that list is None and the caller should send a snapshot as of the current sequence number.
+        To get a snapshot that matches the sequence number, subscribe while holding the engine lock.
+        """
+        with self.lock:
+            subscription = Subscription(loop, self.max_queue)
+            self.subscriptions.add(subscription)
+            if since is not None and self.complete_after is not None and self.complete_after <= since <= self.sequence:
+                backlog = [message for message in self.history if message['sequence'] > since]
+            else:
+                backlog = None
+            return subscription, backlog, self.sequence
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
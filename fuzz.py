@@ -1,7 +1,10 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 import os
 from random import choice, randrange
-from time import time
+import threading
+from time import sleep, time
 import tempfile
 from typing import Callable
 
@@ -9,10 +12,14 @@ from fastapi.testclient import TestClient
 from hypothesis import strategies as st, given, settings
 
 import api as api
-from db_utils import create_db
+import auth
+from db_utils import create_db, close_pools, connect_to_db, DEFAULT_INSTRUMENT
+from ratelimit import TokenBucketLimiter
+from workers import close_workers
+import journal
 
 client = TestClient(api.app)  # Is it good to have a global test client?
-api.N_REQUESTS = 1e10  # disable rate limit
+api.RATE_LIMITS.clear()  # disable rate limit
 
 
 # We use a decorator here rather than a pytest fixture because of interactions with Hypothesis.
@@ -24,7 +31,12 @@ def with_temp_db(func: Callable) -> Callable:
             conn.commit()
             conn.close()
             os.environ['DB_LOCATION'] = file.name
-            return func(*a, **kw)
+            try:
+                return func(*a, **kw)
+            finally:
+                close_workers()
+                close_pools()
+                journal.close_snapshotters()
 
     return wrapped
 
@@ -35,6 +47,273 @@ def test_smoke():
     assert response.status_code == 200
 
 
+class Clock:
+    """A clock for rate limiters that only moves when we say so."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = Clock()
+    limiter = TokenBucketLimiter(rate=2, burst=3, max_keys=2, clock=clock)
+    assert [limiter.allow('a') for _ in range(4)] == [True, True, True, False]
+    assert limiter.wait('a') == 0.5
+    clock.now = 0.5
+    assert limiter.allow('a') and not limiter.allow('a')
+    clock.now = 100  # Refills up to the burst, not beyond
+    assert [limiter.allow('a') for _ in range(4)] == [True, True, True, False]
+    limiter.charge('b', 5)
+    assert not limiter.allow('b') and limiter.wait('b') == 1.5
+    limiter.allow('c')  # Only the two most recent keys are kept
+    assert list(limiter.buckets) == ['b', 'c']
+
+
+@with_temp_db
+def test_rate_limit(monkeypatch):
+    clock = Clock()
+    monkeypatch.setitem(api.RATE_LIMITS, 'market_data', TokenBucketLimiter(rate=1, burst=2, clock=clock))
+    assert [client.get('/').status_code for _ in range(3)] == [200, 200, 429]
+    response = client.get('/')
+    assert response.status_code == 429 and response.headers['Retry-After'] == '1'
+    clock.now = 1
+    assert client.get('/').status_code == 200
+
+
+def test_token_cache():
+    cache = auth.TokenCache(max_size=2)
+    ada, bob = auth.User(name='ada', participant_id=1), auth.User(name='bob', participant_id=2)
+    cache.put('expired', ada, time() - 1)
+    assert cache.get('expired') is None and 'expired' not in cache.entries
+    cache.put('ada', ada, time() + 60)
+    cache.put('bob', bob, time() + 60)
+    assert cache.get('ada') == ada
+    cache.put('ada again', ada, time() + 60)  # bob's token was used least recently
+    assert list(cache.entries) == ['ada', 'ada again']
+    cache.invalidate_user('ada')
+    assert cache.get('ada') is None and cache.entries == {}
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+@with_temp_db
+def test_cached_token(monkeypatch):
+    client.post('/signup', params={'name': 'ada', 'password': 'pwd'})
+    token = client.post('/token', data={'username': 'ada', 'password': 'pwd'}).json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    auth.token_cache.clear()
+    assert client.get('/me', headers=headers).json()['name'] == 'ada'
+    # From now on the user comes from the cache, the database isn't asked anymore
+    monkeypatch.setattr(auth, '_find_user', lambda name: [])
+    hits = auth.token_cache.hits
+    assert client.get('/me', headers=headers).status_code == 200
+    assert auth.token_cache.hits == hits + 1
+    auth.token_cache.invalidate_user('ada')
+    assert client.get('/me', headers=headers).status_code == 401
+
+
+class Concurrency:
+    """Wraps a function to see how many calls of it run at the same time at most."""
+
+    def __init__(self, func: Callable, seconds: float = 0.05):
+        self.func, self.seconds = func, seconds
+        self.running = self.most = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+        try:
+            sleep(self.seconds)
+            return self.func(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def test_hashing_executor():
+    hashing = auth.HashingExecutor(workers=2, max_queue=4)
+    slow = Concurrency(lambda x: x)
+
+    async def burst():
+        return await asyncio.gather(*(hashing.run(slow, i) for i in range(6)), return_exceptions=True)
+
+    try:
+        results = asyncio.run(burst())
+    finally:
+        hashing.executor.shutdown()
+    # Four get in line, two of them at a time, the last two are turned away rather than queued
+    assert results[:4] == [0, 1, 2, 3] and [result.status_code for result in results[4:]] == [503, 503]
+    assert slow.most == 2 and hashing.queue_depth == 0
+
+
+@with_temp_db
+def test_concurrent_logins(monkeypatch):
+    hashing = auth.HashingExecutor(workers=1, max_queue=64)
+    monkeypatch.setattr(auth, 'hashing', hashing)
+    verify = Concurrency(auth.verify_password, 0)
+    monkeypatch.setattr(auth, 'verify_password', verify)
+    for i in range(4):
+        client.post('/signup', params={'name': f'user{i}', 'password': 'pwd'})
+
+    def login(i):
+        return client.post('/token', data={'username': f'user{i}', 'password': 'pwd'}).status_code
+
+    try:
+        with ThreadPoolExecutor(8) as logins:
+            assert list(logins.map(login, [i % 4 for i in range(8)])) == [200] * 8
+    finally:
+        hashing.executor.shutdown()
+    assert verify.most == 1  # However many requests come in at once, bcrypt only runs as often as we allow
+
+
+def sign_up(name: str) -> dict:
+    """Headers to act as a new user."""
+    client.post('/signup', params={'name': name, 'password': 'pwd'})
+    token = client.post('/token', data={'username': name, 'password': 'pwd'}).json()['access_token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+def sign_up_admin() -> dict:
+    """Headers to act as participant 0, who gets to do the admin things. Nobody can sign up as that."""
+    conn = connect_to_db(os.environ['DB_LOCATION'])
+    conn.execute('insert into auth(participant_id, name, hashed_password) values (0, ?, ?)',
+                 ('boss', auth.hash_password('pwd')))
+    conn.execute('insert into accounts(participant_id, balance) values (0, 0)')
+    conn.commit()
+    conn.close()
+    token = client.post('/token', data={'username': 'boss', 'password': 'pwd'}).json()['access_token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+@with_temp_db
+def test_bulk_admin():
+    boss, ada = sign_up_admin(), sign_up('ada')
+    sign_up('bob')
+
+    def holdings():
+        conn = connect_to_db(os.environ['DB_LOCATION'])
+        try:
+            return conn.execute('select name, balance, coalesce(stock, 0) from auth natural join accounts '
+                                'left join positions using (participant_id) where name != ? order by name',
+                                ('boss',)).fetchall()
+        finally:
+            conn.close()
+
+    response = client.post('/send_cash/bulk', headers=boss, json=[
+        {'user_name': 'ada', 'amount': 50}, {'user_name': 'bob', 'amount': -20}, {'user_name': 'ada', 'amount': 5}
+    ])
+    assert response.json() == {'recipients': 2, 'total': 35}
+    response = client.post('/stock_allocation', headers=boss, json=[{'user_name': 'ada', 'stock': 10},
+                                                                     {'user_name': 'bob', 'stock': 4}])
+    assert response.json() == {'instrument': DEFAULT_INSTRUMENT, 'recipients': 2, 'stock': 14}
+    assert holdings() == [('ada', 155, 10), ('bob', 80, 4)]
+
+    # All or nothing: one bad recipient and nobody gets anything
+    response = client.post('/send_cash/bulk', headers=boss, json=[{'user_name': 'ada', 'amount': 10},
+                                                                   {'user_name': 'nobody', 'amount': 10}])
+    assert response.status_code == 404
+    response = client.post('/stock_allocation', headers=boss, json=[{'user_name': 'ada', 'stock': 5},
+                                                                     {'user_name': 'bob', 'stock': -5}])
+    assert response.status_code == 400
+    assert holdings() == [('ada', 155, 10), ('bob', 80, 4)]
+
+    response = client.post('/dividends', headers=boss, params={'dividend_per_share': 3})
+    assert response.json() == {'instrument': DEFAULT_INSTRUMENT, 'holders': 2, 'shares': 14, 'paid': 42}
+    assert holdings() == [('ada', 185, 10), ('bob', 92, 4)]
+    assert client.post('/dividends', headers=ada, params={'dividend_per_share': 3}).status_code == 401
+
+
+@with_temp_db
+def test_batch():
+    ada = sign_up('ada')
+    response = client.post('/submit/batch', headers=ada, json=[{'p': 30, 'q': 1, 'd': 'buy'},
+                                                               {'p': 30, 'q': 1, 'd': 'buy', 's': 'NOPE'}])
+    assert response.status_code == 200
+    first, second = response.json()
+    assert first['fills'] == [] and second == {'error': 'Unknown instrument NOPE.'}
+    # Malformed orders get the usual validation error, with where in the batch they are
+    response = client.post('/submit/batch', headers=ada, json=[{'p': 30, 'q': 1, 'd': 'buy'}, {'p': 30, 'q': 1}])
+    assert response.status_code == 422
+    assert response.json()['detail'][0]['loc'] == ['body', 1, 'd']
+    assert len(client.get('/orders/active', headers=ada).json()) == 1
+
+
+@with_temp_db
+def test_portfolio():
+    boss, ada, bob = sign_up_admin(), sign_up('ada'), sign_up('bob')
+    client.post('/stock_allocation', headers=boss, json=[{'user_name': 'ada', 'stock': 10}])
+    client.post('/send_cash', headers=boss, params={'user_name': 'bob', 'amount': 200})
+    client.post('/submit', headers=ada, json={'p': 30, 'q': 4, 'd': 'sell'})
+    client.post('/submit', headers=bob, json={'p': 30, 'q': 4, 'd': 'buy'})
+    # Leaves a mid of 31, while the last trade was at 30
+    client.post('/submit', headers=bob, json={'p': 29, 'q': 1, 'd': 'buy'})
+    client.post('/submit', headers=ada, json={'p': 33, 'q': 1, 'd': 'sell'})
+
+    # The allocated shares cost nothing, so selling some is all profit
+    assert client.get('/portfolio', headers=ada).json() == {
+        'cash': 220, 'equity': 406, 'realized': 120, 'unrealized': 186, 'pnl': 306,
+        'positions': {DEFAULT_INSTRUMENT: {'stock': 6, 'average_price': 0, 'mark': 31, 'value': 186, 'realized': 120,
+                                           'unrealized': 186, 'pnl': 306}},
+    }
+    assert client.get('/portfolio', headers=bob, params={'mark': 'last'}).json() == {
+        'cash': 180, 'equity': 300, 'realized': 0, 'unrealized': 0, 'pnl': 0,
+        'positions': {DEFAULT_INSTRUMENT: {'stock': 4, 'average_price': 30, 'mark': 30, 'value': 120, 'realized': 0,
+                                           'unrealized': 0, 'pnl': 0}},
+    }
+    assert client.get('/leaderboard', headers=boss).json() == [
+        {'participant_id': 1, 'name': 'ada', 'cash': 220, 'equity': 406, 'realized': 120, 'unrealized': 186,
+         'pnl': 306},
+        {'participant_id': 2, 'name': 'bob', 'cash': 180, 'equity': 304, 'realized': 0, 'unrealized': 4, 'pnl': 4},
+        {'participant_id': 0, 'name': 'boss', 'cash': 0, 'equity': 0, 'realized': 0, 'unrealized': 0, 'pnl': 0},
+    ]
+    assert client.get('/leaderboard', headers=ada).status_code == 401
+
+
+@with_temp_db
+def test_feed():
+    ada = sign_up('ada')
+    with client.websocket_connect('/feed') as websocket:
+        snapshot = websocket.receive_json()
+        assert snapshot['type'] == 'snapshot' and snapshot['books'] == {DEFAULT_INSTRUMENT: {'buy': [], 'sell': []}}
+        client.post('/submit', json={'p': 10, 'q': 2, 'd': 'buy'}, headers=ada)
+        message = websocket.receive_json()
+        conn = connect_to_db(os.environ['DB_LOCATION'])
+        head = journal.head(conn)
+        conn.close()
+        assert message == {'type': 'events', 'sequence': head, 'events': [
+            {'type': 'level', 'instrument': DEFAULT_INSTRUMENT, 'side': 'buy', 'price': 10, 'amount': 2, 'orders': 1,
+             'journal': head}
+        ]}
+    client.post('/submit', json={'p': 11, 'q': 1, 'd': 'buy'}, headers=ada)  # While we're away
+    with client.websocket_connect(f'/feed?since={head}') as websocket:
+        assert websocket.receive_json() == {'type': 'events', 'sequence': head + 1, 'events': [
+            {'type': 'level', 'instrument': DEFAULT_INSTRUMENT, 'side': 'buy', 'price': 11, 'amount': 1, 'orders': 1,
+             'journal': head + 1}
+        ]}
+    with client.websocket_connect('/feed?since=-1') as websocket:  # Too far back, so a snapshot
+        snapshot = websocket.receive_json()
+        assert snapshot['type'] == 'snapshot' and snapshot['books'][DEFAULT_INSTRUMENT]['buy'] == [
+            {'price': 11, 'amount': 1, 'orders': 1}, {'price': 10, 'amount': 2, 'orders': 1}
+        ]
+
+
+@with_temp_db
+def test_token_of_removed_user():
+    conn = connect_to_db(os.environ['DB_LOCATION'])
+    before = journal.head(conn)
+    ada, bob = sign_up('ada'), sign_up('bob')
+    assert client.get('/me', headers=ada).status_code == client.get('/me', headers=bob).status_code == 200
+    # Back to before bob signed up: ada's cached token still works, bob's doesn't anymore
+    journal.restore(conn, before + 1)
+    conn.close()
+    assert client.get('/me', headers=ada).json()['name'] == 'ada'
+    assert client.get('/me', headers=bob).status_code == 401
+
+
 @st.composite
 def new_users(draw):
     return {
@@ -94,12 +373,32 @@ def test_fuzz():
         (client.post, '/submit', lambda: {'json': {
             'p': randrange(0, 100), 'q': randrange(0, 100), 'd': choice(['buy', 'sell']), 'tif': choice(['GTC', 'IOC'])
         }}),
+        (client.post, '/submit/batch', lambda: {'json': [{
+            'p': randrange(0, 100), 'q': randrange(0, 100), 'd': choice(['buy', 'sell']), 'tif': choice(['GTC', 'IOC'])
+        } for _ in range(randrange(0, 5))]}),
+        (client.get, '/depth', lambda: {'params': choice([{}, {'levels': randrange(0, 5)}])}),
+        (client.get, '/candles', lambda: {'params': {
+            'resolution': choice(['1s', '1m', '5m']), 'limit': randrange(0, 10)
+        }}),
         (client.post, '/cancel', lambda: {'params': {'logical_timestamp': randrange(0, 100)}}),
+        (client.post, '/cancel', lambda: {'params': {'logical_timestamp': [randrange(0, 100) for _ in range(3)]}}),
+        (client.post, '/amend', lambda: {'json': {
+            'logical_timestamp': randrange(0, 100), 'p': choice([None, randrange(1, 100)]), 'q': randrange(1, 100)
+        }}),
         (client.post, '/cancel/all', lambda: {}),
         (client.get, '/me', lambda: {}),
+        (client.get, '/portfolio', lambda: {'params': {'mark': choice(['mid', 'last'])}}),
+        (client.get, '/leaderboard', lambda: {}),
         (client.post, '/earnings', lambda: {'params': {'amount': randrange(-10000, 10000)}}),
         (client.post, '/stock_sale', lambda: {'params': {'amount': randrange(0, 1000), 'price': randrange(10, 100)}}),
-        (client.post, '/send_cash', lambda: {'params': {'user_name': choice(users)['name']}})
+        (client.post, '/send_cash', lambda: {'params': {'user_name': choice(users)['name']}}),
+        (client.post, '/send_cash/bulk', lambda: {'json': [
+            {'user_name': choice(users)['name'], 'amount': randrange(-100, 100)} for _ in range(randrange(0, 5))
+        ]}),
+        (client.post, '/stock_allocation', lambda: {'json': [
+            {'user_name': choice(users)['name'], 'stock': randrange(-10, 10)} for _ in range(randrange(0, 5))
+        ]}),
+        (client.post, '/dividends', lambda: {'params': {'dividend_per_share': randrange(0, 10)}}),
     ]
     start_time = time()
     while time() - start_time < 10:
@@ -0,0 +1,310 @@
+import argparse
+from datetime import datetime
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional, Union
+
+import capture
+import positions
+
+logger = logging.getLogger(__name__)
+
+# The journal is the log table: every change to the state of the exchange, in order, appended in the same transaction
+# that makes it, so the two never disagree. Every SNAPSHOT_INTERVAL entries we also store a snapshot of the state,
+# so rebuilding it only has to replay the tail. State is everything in TABLES, trades are history and stay put.
+# Snapshots are taken in the background (see Snapshotter) and only the last SNAPSHOTS_KEPT are kept, the journal
+# itself is enough to rebuild anything before those.
+SNAPSHOT_INTERVAL = 1_000
+SNAPSHOTS_KEPT = 10
+TABLES = {
+    'instruments': ('symbol',),
+    'exchange': ('logical_timestamp', 'participant_id', 'instrument', 'price', 'amount'),
+    'accounts': ('participant_id', 'balance'),
+    'positions': ('participant_id', 'instrument', 'stock', 'cost', 'realized'),
+    'earnings': ('instrument', 'amount', 'timestamp'),
+}
+_appended = threading.local()  # What this thread appended last, see appended
+# Called after restore rewrote the tables, by whatever keeps things from them in memory, like auth's token cache
+restore_listeners: list[Callable[[], None]] = []
+
+
+def append(c: Union[sqlite3.Connection, sqlite3.Cursor], event: dict) -> int:
+    """Add an event to the journal without committing, taking a snapshot if it's time. Returns its sequence number."""
+    sequence = c.execute('insert into log(event, timestamp) values (?, ?) returning sequence',
+                         (json.dumps(event), datetime.now())).fetchone()[0]
+    c.execute('update journal_state set sequence=?', (sequence,))
+    if sequence % SNAPSHOT_INTERVAL == 0:
+        location = c.execute('pragma database_list').fetchone()[2]
+        if location:
+            get_snapshotter(location).request(sequence)
+        else:
+            snapshot(c)  # In memory, no other connection can see it
+    capture.journaled(event)
+    _appended.sequence = sequence
+    return sequence
+
+
+def appended() -> int:
+    """Sequence number of the last entry this thread appended, so the engine can number its events without a query."""
+    return getattr(_appended, 'sequence', 0)
+
+
+def head(c: Union[sqlite3.Connection, sqlite3.Cursor]) -> int:
+    """Sequence number of the last entry in the journal."""
+    return c.execute('select coalesce(max(sequence), 0) from log').fetchone()[0]
+
+
+def _read_state(c: Union[sqlite3.Connection, sqlite3.Cursor]) -> tuple[int, str]:
+    """The last entry in the journal and the state as of it, as JSON. Read it in one transaction."""
+    state = {
+        table: c.execute(f'select {", ".join(columns)} from {table}').fetchall() for table, columns in TABLES.items()
+    }
+    return head(c), json.dumps(state)
+
+
+def _store(c: Union[sqlite3.Connection, sqlite3.Cursor], sequence: int, state: str):
+    c.execute('insert or replace into snapshots(sequence, state, timestamp) values (?, ?, ?)',
+              (sequence, state, datetime.now()))
+    c.execute('delete from snapshots where sequence not in '
+              '(select sequence from snapshots order by sequence desc limit ?)', (SNAPSHOTS_KEPT,))
+
+
+def snapshot(c: Union[sqlite3.Connection, sqlite3.Cursor]) -> int:
+    """Store the current state as of the last entry in the journal, without committing."""
+    sequence, state = _read_state(c)
+    _store(c, sequence, state)
+    return sequence
+
+
+class Snapshotter:
+    """
+    Takes the snapshots of one database on its own thread, so appending to the journal never waits for one.
+    It reads the state on a read only connection, in one transaction, so WAL gives it a consistent view while the
+    writer carries on. Only storing it takes the write lock, for one insert.
+    """
+
+    def __init__(self, location: str):
+        self.location = location
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='snapshots', daemon=True)
+        self.thread.start()
+
+    def request(self, sequence: int):
+        """Take a snapshot once entry sequence is committed, or as of whatever comes after it."""
+        self.requests.put(sequence)
+
+    def _run(self):
+        from db_utils import connect_to_db  # It journals the mock database, so it imports us
+
+        reader = connect_to_db(self.location, read_only=True)
+        writer = connect_to_db(self.location)
+        try:
+            while True:
+                sequence = self.requests.get()
+                if sequence is None:
+                    return
+                try:
+                    self._take(reader, writer, sequence)
+                except Exception:
+                    logger.exception('Failed to take a snapshot as of %s', sequence)
+        finally:
+            reader.close()
+            writer.close()
+
+    @staticmethod
+    def _take(reader: sqlite3.Connection, writer: sqlite3.Connection, sequence: int):
+        # It's requested before the entry is committed, give the writer a moment
+        for _ in range(100):
+            if head(reader) >= sequence:
+                break
+            time.sleep(0.01)
+        reader.execute('begin')
+        try:
+            sequence, state = _read_state(reader)
+        finally:
+            reader.rollback()
+        _store(writer, sequence, state)
+        writer.commit()
+
+    def close(self):
+        """Take the snapshots requested so far, then stop."""
+        self.requests.put(None)
+        self.thread.join()
+
+
+_snapshotters: dict[str, Snapshotter] = {}
+_snapshotters_lock = threading.Lock()
+
+
+def get_snapshotter(location: str) -> Snapshotter:
+    with _snapshotters_lock:
+        if location not in _snapshotters:
+            _snapshotters[location] = Snapshotter(location)
+        return _snapshotters[location]
+
+
+def close_snapshotters():
+    with _snapshotters_lock:
+        for snapshotter in _snapshotters.values():
+            snapshotter.close()
+        _snapshotters.clear()
+
+
+class State:
+    """The tables in TABLES, in memory, keyed so events are cheap to apply."""
+
+    def __init__(self, state: Optional[dict] = None):
+        state = state or {}
+        self.instruments = {symbol for symbol, in state.get('instruments', [])}
+        self.exchange = {ts: [participant_id, instrument, price, amount]
+                         for ts, participant_id, instrument, price, amount in state.get('exchange', [])}
+        self.accounts = dict(state.get('accounts', []))
+        # (participant_id, instrument) -> [stock, cost, realized]
+        self.positions = {(participant_id, instrument): [stock, cost, realized]
+                          for participant_id, instrument, stock, cost, realized in state.get('positions', [])}
+        self.earnings = [tuple(row) for row in state.get('earnings', [])]
+
+    def rows(self) -> dict[str, list[tuple]]:
+        return {
+            'instruments': [(symbol,) for symbol in sorted(self.instruments)],
+            'exchange': [(ts, *order) for ts, order in sorted(self.exchange.items())],
+            'accounts': sorted(self.accounts.items()),
+            'positions': [(*key, *position) for key, position in sorted(self.positions.items())],
+            'earnings': self.earnings,
+        }
+
+    def trade(self, participant_id, instrument: str, price: int, bought: int):
+        self.accounts[participant_id] = self.accounts.get(participant_id, 0) - bought * price
+        position = self.positions.get((participant_id, instrument), (0, 0.0, 0.0))
+        self.positions[participant_id, instrument] = list(positions.fill(*position, price, bought))
+
+    def apply(self, event: dict):
+        """
+        Events are dicts with a type and the change, see where they're appended. An order has its logical timestamp,
+        its fills as (logical timestamp of the counter order, price, amount bought), and the amount left resting.
+        Cash and positions go to one participant, or to many as (participant_id, amount) pairs from the bulk endpoints.
+        """
+        kind = event['type']
+        if kind == 'order':
+            participant_id, instrument = event['participant_id'], event['instrument']
+            for counter, price, bought in event['fills']:
+                order = self.exchange[counter]
+                order[3] += bought
+                if order[3] == 0:
+                    del self.exchange[counter]
+                self.trade(participant_id, instrument, price, bought)
+                self.trade(order[0], instrument, price, -bought)
+            if event['resting']:
+                self.exchange[event['logical_timestamp']] = [participant_id, instrument, event['price'],
+                                                             event['resting']]
+        elif kind == 'amend':
+            self.exchange[event['logical_timestamp']][3] = event['amount']
+        elif kind == 'cancel':
+            for ts in event['logical_timestamps']:
+                self.exchange.pop(ts, None)
+        elif kind == 'earnings':
+            self.earnings.append((event['instrument'], event['amount'], event['timestamp']))
+        elif kind == 'dividend':
+            for (participant_id, instrument), position in self.positions.items():
+                if instrument == event['instrument'] and position[0] != 0:
+                    paid = position[0] * event['dividend']
+                    self.accounts[participant_id] = self.accounts.get(participant_id, 0) + paid
+                    position[2] += paid
+        elif kind == 'cash':
+            for participant_id, amount in event.get('transfers') or [(event['participant_id'], event['amount'])]:
+                self.accounts[participant_id] = self.accounts.get(participant_id, 0) + amount
+        elif kind == 'account':
+            self.accounts[event['participant_id']] = event['balance']
+        elif kind == 'position':
+            for participant_id, stock in event.get('allocations') or [(event['participant_id'], event['stock'])]:
+                position = self.positions.setdefault((participant_id, event['instrument']), [0, 0.0, 0.0])
+                position[:2] = positions.allocate(position[0], position[1], stock)
+        elif kind == 'instrument':
+            self.instruments.add(event['symbol'])
+        # Anything else in the log, like trades from before we had a trades table, doesn't change the state
+
+
+def state_at(c: Union[sqlite3.Connection, sqlite3.Cursor], sequence: Optional[int] = None) -> tuple[State, int]:
+    """The state as of a sequence number (the latest by default), from the snapshot before it and the tail after."""
+    sequence = head(c) if sequence is None else sequence
+    row = c.execute('select sequence, state from snapshots where sequence <= ? order by sequence desc limit 1',
+                    (sequence,)).fetchone()
+    start, state = (0, State()) if row is None else (row[0], State(row[1]))
+    for event, in c.execute('select event from log where sequence > ? and sequence <= ? order by sequence',
+                            (start, sequence)):
+        state.apply(event)
+    return state, sequence
+
+
+def restore(c: Union[sqlite3.Connection, sqlite3.Cursor], sequence: Optional[int] = None) -> int:
+    """
+    Rewrite the state tables as of a sequence number and commit. Entries after it are dropped from the journal,
+    since the exchange carries on from there: rebuild into a copy to only have a look. So are the trades they made
+    and the logins of participants that signed up after it. A trade tape drops them when it next catches up.
+    Nothing else should be writing meanwhile. In-memory books of this database are stale afterwards, and so is
+    whatever other processes cache, like tokens of participants that are gone now: restart those.
+    """
+    state, sequence = state_at(c, sequence)
+    # Trades are numbered on their own, every fill after the sequence is one of the last trades
+    dropped, = c.execute("select coalesce(sum(json_array_length(event ->> 'fills')), 0) from log "
+                         "where sequence > ? and event ->> 'type' = 'order'", (sequence,)).fetchone()
+    c.execute('delete from trades where sequence > (select coalesce(max(sequence), 0) from trades) - ?', (dropped,))
+    c.execute('delete from log where sequence > ?', (sequence,))
+    c.execute('delete from snapshots where sequence > ?', (sequence,))
+    # Number what comes next right after what's left
+    c.execute("update sqlite_sequence set seq=(select coalesce(max(sequence), 0) from trades) where name='trades'")
+    c.execute("update sqlite_sequence set seq=? where name='log'", (sequence,))
+    for table, rows in state.rows().items():
+        columns = TABLES[table]
+        c.execute(f'delete from {table}')
+        c.executemany(f'insert into {table}({", ".join(columns)}) values ({", ".join("?" * len(columns))})', rows)
+    c.execute('delete from auth where participant_id not in (select participant_id from accounts)')
+    c.execute('update journal_state set sequence=?', (sequence,))
+    (c if isinstance(c, sqlite3.Connection) else c.connection).commit()
+    for listener in restore_listeners:
+        listener()
+    return sequence
+
+
+def recover(c: Union[sqlite3.Connection, sqlite3.Cursor]) -> Optional[int]:
+    """
+    On startup: if the tables are behind the journal, say because only the journal was copied over, catch them up.
+    Returns the sequence number we caught up to, or None if there was nothing to do.
+    """
+    applied, = c.execute('select sequence from journal_state').fetchone()
+    return restore(c) if applied < head(c) else None
+
+
+def main():
+    from dotenv import load_dotenv
+    from db_utils import connect_to_db  # It journals the mock database, so it imports us
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Snapshot the exchange, or rebuild it as of a sequence number.')
+    parser.add_argument('command', choices=['snapshot', 'rebuild'])
+    parser.add_argument('--db', help='Defaults to DB_LOCATION')
+    parser.add_argument('--sequence', type=int, help='Rebuild as of this entry, defaults to the last one')
+    parser.add_argument('--output', help='Rebuild into a copy of the database, rather than in place')
+    args = parser.parse_args()
+
+    conn = connect_to_db(args.db)
+    if args.command == 'snapshot':
+        sequence = snapshot(conn)
+        conn.commit()
+        print(f'Stored a snapshot as of {sequence}.')
+        return
+    if args.output is not None:
+        target = connect_to_db(args.output)
+        conn.backup(target)
+        conn.close()
+        conn = target
+    print(f'Rebuilt the state as of {restore(conn, args.sequence)}.')
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
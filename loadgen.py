@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+from collections import defaultdict
+import json
+import os
+import random
+import secrets
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, sleep
+from typing import Optional
+
+import httpx
+from dotenv import load_dotenv
+
+from db_utils import create_db, DEFAULT_INSTRUMENT
+import journal
+
+load_dotenv()
+# Only used if they're not set already, for the server we start ourselves
+os.environ.setdefault('TOKEN_URL', 'token')
+os.environ.setdefault('SECRET_KEY', secrets.token_hex(32))
+
+from auth import create_token, hash_password  # noqa: E402, needs the environment above
+
+PASSWORD = 'loadgen'
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1_000, 2_000, 5_000, float('inf'))
+DEFAULT_MIX = 'submit=40,cancel=10,depth=15,trades=10,orderbook=5,balance=10,active=10'
+
+
+class User:
+    """A simulated trader, with its own RNG so what it does only depends on the seed, not on the scheduling."""
+
+    def __init__(self, name: str, token: str, seed: int):
+        self.name = name
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.rng = random.Random(seed)
+        self.resting: list[int] = []  # Logical timestamps of orders we might still be able to cancel
+
+
+class Workload:
+    """What to send: the route mix, and the distribution of order prices and sizes."""
+
+    def __init__(self, mix: str, price: float, price_sd: float, max_quantity: int, ioc: float):
+        self.routes, self.weights = [], []
+        for item in mix.split(','):
+            route, weight = item.split('=')
+            if not hasattr(self, f'_{route}'):
+                raise ValueError(f'Unknown route {route}')
+            self.routes.append(route)
+            self.weights.append(float(weight))
+        self.price, self.price_sd, self.max_quantity, self.ioc = price, price_sd, max_quantity, ioc
+
+    def request(self, user: User) -> tuple[str, str, str, dict]:
+        """Pick a route for a user: name, method, path and keyword arguments for httpx."""
+        route = user.rng.choices(self.routes, self.weights)[0]
+        return (route, *getattr(self, f'_{route}')(user))
+
+    def order(self, user: User) -> dict:
+        return {
+            'p': max(1, round(user.rng.gauss(self.price, self.price_sd))),
+            'q': user.rng.randint(1, self.max_quantity),
+            'd': user.rng.choice(('buy', 'sell')),
+            'tif': 'IOC' if user.rng.random() < self.ioc else 'GTC',
+        }
+
+    def _submit(self, user):
+        return 'POST', '/submit', {'json': self.order(user)}
+
+    def _batch(self, user):
+        return 'POST', '/submit/batch', {'json': [self.order(user) for _ in range(10)]}
+
+    def _cancel(self, user):
+        timestamp = user.resting.pop(user.rng.randrange(len(user.resting))) if user.resting else 0
+        return 'POST', '/cancel', {'params': {'logical_timestamp': timestamp}}
+
+    def _cancel_all(self, user):
+        user.resting.clear()
+        return 'POST', '/cancel/all', {}
+
+    def _depth(self, user):
+        return 'GET', '/depth', {'params': {'levels': 10}}
+
+    def _trades(self, user):
+        return 'GET', '/trades', {}
+
+    def _candles(self, user):
+        return 'GET', '/candles', {}
+
+    def _orderbook(self, user):
+        return 'GET', '/orderbook', {}
+
+    def _balance(self, user):
+        return 'GET', '/balance', {}
+
+    def _active(self, user):
+        return 'GET', '/orders/active', {}
+
+    def _me(self, user):
+        return 'GET', '/me', {}
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)  # route -> seconds
+        self.statuses = defaultdict(lambda: defaultdict(int))  # route -> status (0 for no response) -> count
+
+    def add(self, route: str, status: int, latency: float):
+        self.latencies[route].append(latency)
+        self.statuses[route][status] += 1
+
+    def summary(self, duration: float) -> dict[str, dict]:
+        summary = {}
+        for route in sorted(self.latencies, key=lambda route: -len(self.latencies[route])):
+            latencies = sorted(latency * 1e3 for latency in self.latencies[route])
+            statuses = self.statuses[route]
+            count = len(latencies)
+            histogram, below = {}, 0
+            for bucket in BUCKETS:
+                inside = sum(1 for latency in latencies[below:] if latency <= bucket)
+                histogram[f'<={bucket:g}ms' if bucket != float('inf') else 'slower'] = inside
+                below += inside
+            summary[route] = {
+                'requests': count,
+                'throughput': count / duration,
+                'ok': sum(n for status, n in statuses.items() if 200 <= status < 400) / count,
+                'rejected': sum(n for status, n in statuses.items() if 400 <= status < 500 and status != 429) / count,
+                'rate_limited': statuses[429] / count,
+                'errors': sum(n for status, n in statuses.items() if status >= 500 or status == 0) / count,
+                **{f'p{q}': latencies[min(count - 1, int(q / 100 * count))] for q in (50, 90, 99)},
+                'max': latencies[-1],
+                'histogram': histogram,
+            }
+        return summary
+
+
+async def send(client: httpx.AsyncClient, workload: Workload, user: User, results: Results,
+               start: Optional[float] = None):
+    """
+    One request for a user. Open loop passes the time it meant to send it, so time spent waiting for a
+    connection counts, and a slow server doesn't hide its latency by slowing us down.
+    """
+    route, method, path, kwargs = workload.request(user)
+    start = perf_counter() if start is None else start
+    try:
+        response = await client.request(method, path, headers=user.headers, **kwargs)
+    except httpx.HTTPError:
+        results.add(route, 0, perf_counter() - start)
+        return
+    results.add(route, response.status_code, perf_counter() - start)
+    if route == 'submit' and response.status_code == 200:
+        user.resting.append(response.json())
+
+
+async def closed_loop(client, workload, users, results, duration: float, think: float):
+    """Every user sends a request, waits for the answer, thinks for a while, and goes again."""
+    deadline = perf_counter() + duration
+
+    async def trader(user: User):
+        while perf_counter() < deadline:
+            await send(client, workload, user, results)
+            if think:
+                await asyncio.sleep(user.rng.expovariate(1 / think))
+
+    await asyncio.gather(*(trader(user) for user in users))
+
+
+async def open_loop(client, workload, users, results, duration: float, rate: float, seed: int):
+    """Requests arrive at `rate` per second on average (a Poisson process), whether earlier ones finished or not."""
+    rng = random.Random(seed)
+    start = perf_counter()
+    arrival, tasks = 0.0, []
+    while True:
+        arrival += rng.expovariate(rate)
+        if arrival >= duration:
+            break
+        await asyncio.sleep(max(0.0, start + arrival - perf_counter()))
+        tasks.append(asyncio.create_task(send(client, workload, rng.choice(users), results, start + arrival)))
+    await asyncio.gather(*tasks)
+
+
+def prepare_db(location: str, users: int, cash: int, stock: int) -> list[tuple[str, str]]:
+    """Traders with cash and stock, and tokens for them, so we don't spend the run hashing passwords."""
+    conn = create_db(location)
+    hashed_password = hash_password(PASSWORD)
+    names = [f'trader{i}' for i in range(users)]
+    conn.executemany('insert into auth(participant_id, name, hashed_password) values (?, ?, ?)',
+                     [(i, name, hashed_password) for i, name in enumerate(names)])
+    conn.executemany('insert into accounts(participant_id, balance) values (?, ?)', [(i, cash) for i in range(users)])
+    conn.executemany('insert into positions(participant_id, instrument, stock) values (?, ?, ?)',
+                     [(i, DEFAULT_INSTRUMENT, stock) for i in range(users)])
+    for i in range(users):
+        journal.append(conn, {'type': 'account', 'participant_id': i, 'balance': cash})
+        journal.append(conn, {'type': 'position', 'participant_id': i, 'instrument': DEFAULT_INSTRUMENT,
+                              'stock': stock})
+    conn.commit()
+    conn.close()
+    return [(name, create_token({'sub': name})) for name in names]
+
+
+def start_server(server: str, port: int, workers: int, env: dict) -> list[subprocess.Popen]:
+    processes = []
+    if 'SEQUENCER_ADDRESS' in env:
+        processes.append(subprocess.Popen([sys.executable, 'sequencer.py'], env=env))
+    if server == 'gunicorn':
+        command = ['gunicorn', '-k', 'uvicorn.workers.UvicornWorker', '-w', str(workers), '-b', f'127.0.0.1:{port}',
+                   'api:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'api:app', '--port', str(port), '--workers', str(workers),
+                   '--log-level', 'warning']
+    processes.append(subprocess.Popen(command, env=env))
+    for _ in range(300):
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/')
+            return processes
+        except httpx.TransportError:
+            sleep(0.1)
+    stop(processes)
+    raise RuntimeError('The server did not start')
+
+
+def stop(processes: list[subprocess.Popen]):
+    for process in reversed(processes):
+        process.terminate()
+        process.wait()
+
+
+async def login(url: str, users: int, seed: int) -> list[tuple[str, str]]:
+    """Sign up and log in over HTTP, for a server we didn't start ourselves."""
+    tokens = []
+    async with httpx.AsyncClient(base_url=url) as client:
+        for i in range(users):
+            name = f'loadgen-{seed}-{i}'
+            await client.post('/signup', params={'name': name, 'password': PASSWORD})
+            response = await client.post(f'/{os.environ["TOKEN_URL"]}', data={'username': name, 'password': PASSWORD})
+            response.raise_for_status()
+            tokens.append((name, response.json()['access_token']))
+    return tokens
+
+
+def report(summary: dict[str, dict]):
+    print(f"{'route':<12}{'requests':>10}{'req/s':>9}{'ok':>7}{'4xx':>7}{'429':>7}{'error':>7}"
+          f"{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for route, stats in summary.items():
+        print(f"{route:<12}{stats['requests']:>10}{stats['throughput']:>9.1f}{stats['ok']:>7.1%}"
+              f"{stats['rejected']:>7.1%}{stats['rate_limited']:>7.1%}{stats['errors']:>7.1%}"
+              f"{stats['p50']:>9.1f}{stats['p90']:>9.1f}{stats['p99']:>9.1f}{stats['max']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate traders against the API over HTTP.')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=30, help='Seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Routes and their weights, like submit=4,depth=1')
+    parser.add_argument('--price', type=float, default=100, help='Mean order price')
+    parser.add_argument('--price-sd', type=float, default=5, help='Standard deviation of order prices')
+    parser.add_argument('--max-quantity', type=int, default=10)
+    parser.add_argument('--ioc', type=float, default=0.1, help='Fraction of orders that are immediate or cancel')
+    parser.add_argument('--open-loop', type=float, metavar='RATE',
+                        help='Send this many requests per second in total, rather than one at a time per user')
+    parser.add_argument('--think', type=float, default=0, help='Mean seconds between requests of a user (closed loop)')
+    parser.add_argument('--url', help='Use a running server, rather than starting one on a fresh database')
+    parser.add_argument('--server', choices=['uvicorn', 'gunicorn'], default='uvicorn')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--sequencer', action='store_true',
+                        help='Also start a sequencer for order entry, always the case with more than one worker')
+    parser.add_argument('--no-rate-limits', action='store_true')
+    parser.add_argument('--output', help='Save the results as JSON')
+    args = parser.parse_args()
+    args.sequencer = args.sequencer or args.workers > 1  # Only one process can match, see db_utils.claim_writer
+    workload = Workload(args.mix, args.price, args.price_sd, args.max_quantity, args.ioc)
+
+    processes = []
+    with tempfile.TemporaryDirectory() as directory:
+        if args.url is None:
+            env = {**os.environ, 'DB_LOCATION': os.path.join(directory, 'loadgen.db')}
+            if args.sequencer:
+                env['SEQUENCER_ADDRESS'] = os.path.join(directory, 'sequencer.sock')
+            if args.no_rate_limits:
+                env['DISABLE_RATE_LIMITS'] = '1'
+            tokens = prepare_db(env['DB_LOCATION'], args.users, cash=10 ** 9, stock=10 ** 6)
+            processes = start_server(args.server, args.port, args.workers, env)
+            url = f'http://127.0.0.1:{args.port}'
+        else:
+            url = args.url
+            tokens = asyncio.run(login(url, args.users, args.seed))
+        users = [User(name, token, args.seed * 1_000_003 + i) for i, (name, token) in enumerate(tokens)]
+        results = Results()
+
+        async def run():
+            limits = httpx.Limits(max_connections=args.users)
+            async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+                if args.open_loop:
+                    await open_loop(client, workload, users, results, args.duration, args.open_loop, args.seed)
+                else:
+                    await closed_loop(client, workload, users, results, args.duration, args.think)
+
+        started = perf_counter()
+        try:
+            asyncio.run(run())
+            elapsed = perf_counter() - started
+        finally:
+            stop(processes)
+    summary = results.summary(elapsed)
+    report(summary)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'arguments': vars(args), 'routes': summary}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+import threading
+from typing import Callable, Iterable
+
+# Seconds, for everything we time. Prometheus wants the upper bound of every bucket, +Inf is implied.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Metric(ABC):
+    """
+    Every thread updates its own shard, so recording never waits for a lock or for another thread.
+    Only creating a thread's shard and collecting (when /metrics is scraped) take the lock.
+    Shards stay around when their thread ends, so nothing gets lost.
+    """
+    kind = ''
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.local = threading.local()
+        self.shards: list[dict] = []
+        self.lock = threading.Lock()
+
+    def shard(self) -> dict:
+        try:
+            return self.local.shard
+        except AttributeError:
+            self.local.shard = {}
+            with self.lock:
+                self.shards.append(self.local.shard)
+            return self.local.shard
+
+    @abstractmethod
+    def merged(self) -> dict:
+        """Current value of every set of label values."""
+
+    @abstractmethod
+    def samples(self) -> Iterable[str]:
+        """Lines of the text format, see expose."""
+
+    def expose(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}', *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def merged(self) -> dict[tuple, float]:
+        total = {}
+        with self.lock:
+            for shard in self.shards:
+                for labels, value in list(shard.items()):
+                    total[labels] = total.get(labels, 0) + value
+        return total
+
+    def samples(self):
+        for labels, value in sorted(self.merged().items()):
+            yield f'{self.name}{_labels(self.labels, labels)} {value:g}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        shard = self.shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # One count per bucket (not cumulative yet), then +Inf, then the sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def merged(self) -> dict[tuple, list]:
+        total = {}
+        with self.lock:
+            for shard in self.shards:
+                for labels, counts in list(shard.items()):
+                    into = total.setdefault(labels, [0] * len(counts))
+                    for i, count in enumerate(list(counts)):
+                        into[i] += count
+        return total
+
+    def samples(self):
+        for labels, counts in sorted(self.merged().items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                yield f'{self.name}_bucket{_labels((*self.labels, "le"), (*labels, le))} {cumulative}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {counts[-1]:g}'
+
+
+class Gauge(Metric):
+    """
+    Read when collecting, from a function that returns {label values: value}.
+    Also for counters that something else keeps already, with kind='counter'.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], read: Callable[[], dict[tuple, float]],
+                 kind: str = 'gauge'):
+        super().__init__(name, help, labels)
+        self.read = read
+        self.kind = kind
+
+    def merged(self) -> dict[tuple, float]:
+        return self.read()
+
+    def samples(self):
+        for labels, value in sorted(self.merged().items()):
+            yield f'{self.name}{_labels(self.labels, labels)} {value:g}'
+
+
+registry: list[Metric] = []
+
+
+def register(metric: Metric) -> Metric:
+    registry.append(metric)
+    return metric
+
+
+def expose() -> str:
+    """Everything in the Prometheus text format. Every process has its own metrics, like it has its own books."""
+    return '\n'.join(metric.expose() for metric in registry) + '\n'
+
+
+requests = register(Histogram('http_request_duration_seconds', 'Time to handle a request, by route.',
+                              ('method', 'route', 'status')))
+match_time = register(Histogram('engine_match_seconds', 'Time limit_order spent matching, in SQL or Python.',
+                                ('part',)))
+commit_time = register(Histogram('engine_commit_seconds', 'Time it took to commit engine changes.'))
+fills = register(Histogram('engine_fills_per_order', 'Number of resting orders an order traded with.',
+                           buckets=(0, 1, 2, 5, 10, 20, 50, 100)))
+rate_limited = register(Counter('rate_limit_rejections_total', 'Requests rejected by a rate limiter.', ('group',)))
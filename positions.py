@@ -0,0 +1,48 @@
+from typing import Optional
+
+# Positions are kept at average cost: cost is what the open position cost, negative for a short, so the average
+# entry price is cost / stock. Closing (part of) a position moves the difference with its share of the cost into
+# realized P&L. The engine and the journal both keep positions with fill, in the same order, so replaying the journal
+# gives back exactly the same numbers.
+
+
+def fill(stock: int, cost: float, realized: float, price: int, bought: int) -> tuple[int, float, float]:
+    """(stock, cost, realized) after buying `bought` at price, or selling if it's negative."""
+    if stock == 0:
+        return bought, float(bought * price), realized  # Whatever cost was left over isn't part of this position
+    if (stock > 0) == (bought > 0):
+        return stock + bought, cost + bought * price, realized
+    # Part of the position that gets closed, with the sign of the position
+    closed = min(abs(bought), abs(stock)) * (1 if stock > 0 else -1)
+    closed_cost = cost * closed / stock
+    realized += closed * price - closed_cost
+    stock += bought
+    # Whatever is left of the order opens a position the other way
+    cost = 0.0 if stock == 0 else cost - closed_cost + (bought + closed) * price
+    return stock, cost, realized
+
+
+def allocate(stock: int, cost: float, allocated: int) -> tuple[int, float]:
+    """
+    (stock, cost) after the admin hands out shares (at no cost), or takes them back. Taking shares back takes their
+    share of the cost with them like a sale does, but realizes nothing. engine.credit_stock does the same in SQL.
+    """
+    if stock == 0 or stock + allocated == 0 or (stock > 0) != (stock + allocated > 0):
+        return stock + allocated, 0.0
+    if (stock > 0) == (allocated > 0):
+        return stock + allocated, cost
+    return stock + allocated, cost * (stock + allocated) / stock
+
+
+def pnl(stock: int, cost: float, realized: float, mark: Optional[float]) -> dict:
+    """Figures for one position. Without a mark price it's valued at cost, so there's no unrealized P&L."""
+    value = cost if mark is None else stock * mark
+    return {
+        'stock': stock,
+        'average_price': cost / stock if stock else None,
+        'mark': mark,
+        'value': value,
+        'realized': realized,
+        'unrealized': value - cost,
+        'pnl': realized + value - cost,
+    }
@@ -0,0 +1,53 @@
+from collections import OrderedDict
+import threading
+from time import monotonic
+from typing import Callable, Hashable
+
+
+class TokenBucketLimiter:
+    """
+    In-memory token buckets, one per key (an IP, a participant, ...).
+    Every bucket holds at most `burst` tokens and refills at `rate` tokens per second, a request costs one token.
+    We only remember the `max_keys` most recently seen keys: forgetting a key hands it a full bucket next time,
+    which is the same as what it would have had after being idle for burst / rate seconds.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10_000, clock: Callable[[], float] = monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets: OrderedDict[Hashable, tuple[float, float]] = OrderedDict()  # key -> (tokens, last refill)
+        self.lock = threading.Lock()
+
+    def allow(self, key: Hashable, cost: float = 1) -> bool:
+        now = self.clock()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return allowed
+
+    def wait(self, key: Hashable, cost: float = 1) -> float:
+        """Seconds until allow would let a request of cost through, for Retry-After."""
+        now = self.clock()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.burst, now))
+        return max(0.0, (cost - min(self.burst, tokens + (now - last) * self.rate)) / self.rate)
+
+    def charge(self, key: Hashable, cost: float):
+        """
+        Take tokens whether there are enough or not, for costs we only know afterwards, like CPU time.
+        A bucket can go below zero that way, and allow refuses everything until it's back to zero.
+        """
+        now = self.clock()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (self.burst, now))
+            self.buckets[key] = (min(self.burst, tokens + (now - last) * self.rate) - cost, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
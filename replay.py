@@ -0,0 +1,153 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+from time import perf_counter, sleep
+from typing import Optional
+
+from db_utils import connect_to_db
+from engine import limit_order, limit_orders, cancel_order, cancel_orders, cancel_all_orders, amend_order, drop_book
+from engine import credit_cash, credit_stock, pay_dividend
+from engine import transfer_cash, allocate_shares, distribute_dividend, add_earnings, add_instrument, add_accounts
+import journal
+
+# Engine functions a capture can have calls to, see capture.py
+CALLS = {func.__name__: func
+         for func in (limit_order, limit_orders, cancel_order, cancel_orders, cancel_all_orders, amend_order,
+                      transfer_cash, allocate_shares, distribute_dividend, add_earnings, add_instrument,
+                      add_accounts)}
+# What has to come out the same as when it was captured, in a fixed order. Not the timestamps of trades:
+# those are when they happened, and a replay happens later.
+COMPARED = {
+    'exchange': 'select logical_timestamp, participant_id, instrument, price, amount from exchange order by 1',
+    'accounts': 'select participant_id, balance from accounts order by 1',
+    'positions': 'select participant_id, instrument, stock, cost, realized from positions order by 1, 2',
+    'trades': 'select sequence, instrument, buyer, seller, price, amount from trades order by 1',
+}
+
+
+def load(path: str) -> list[list]:
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+
+def apply_event(c: sqlite3.Cursor, event: dict):
+    """Redo something the capture has as its journal entry, rather than as a call, and commit."""
+    kind = event['type']
+    if kind == 'cash':
+        credit_cash(c, event.get('transfers') or [(event['participant_id'], event['amount'])])
+    elif kind == 'position':
+        credit_stock(c, event['instrument'], event.get('allocations') or [(event['participant_id'], event['stock'])])
+    elif kind == 'dividend':
+        pay_dividend(c, event['instrument'], event['dividend'])
+    else:
+        if kind == 'account':
+            c.execute('insert or replace into accounts(participant_id, balance) values (?, ?)',
+                      (event['participant_id'], event['balance']))
+        elif kind == 'instrument':
+            c.execute('insert or ignore into instruments(symbol) values (?)', (event['symbol'],))
+        elif kind == 'earnings':
+            c.execute('insert into earnings(instrument, amount, timestamp) values (:instrument, :amount, :timestamp)',
+                      event)
+        else:
+            raise ValueError(f"Can't replay {kind} entries.")
+        journal.append(c, event)
+    c.connection.commit()
+
+
+def replay(c: sqlite3.Cursor, lines: list[list], speed: Optional[float] = None) -> dict:
+    """
+    Run a capture against the database c is connected to, straight into the engine.
+    As fast as possible, or with speed, at the pace it was captured at, sped up that many times.
+    """
+    orders = errors = 0
+    start = perf_counter()
+    for offset, _, name, payload in lines:
+        if speed is not None:
+            wait = start + offset / speed - perf_counter()
+            if wait > 0:
+                sleep(wait)
+        if name == 'event':
+            apply_event(c, payload)
+            continue
+        try:
+            CALLS[name](c, **payload)
+        except Exception:
+            errors += 1  # It changed something when it was captured, so something's off
+        orders += len(payload['orders']) if name == 'limit_orders' else name in ('limit_order', 'amend_order')
+    seconds = perf_counter() - start
+    return {'calls': len(lines), 'orders': orders, 'errors': errors, 'seconds': seconds,
+            'calls_per_second': len(lines) / seconds if seconds else None,
+            'orders_per_second': orders / seconds if seconds else None}
+
+
+def dump(c: sqlite3.Cursor) -> dict[str, bytes]:
+    """Everything in COMPARED, serialized the same way every time, so equal state means equal bytes."""
+    return {table: json.dumps(c.execute(sql).fetchall(), separators=(',', ':')).encode()
+            for table, sql in COMPARED.items()}
+
+
+def differences(replayed: dict[str, bytes], expected: dict[str, bytes]) -> list[str]:
+    """A line for every table that doesn't match, with the first row that doesn't."""
+    found = []
+    for table in COMPARED:
+        if replayed[table] == expected[table]:
+            continue
+        ours, theirs = json.loads(replayed[table]), json.loads(expected[table])
+        at = next((i for i, (a, b) in enumerate(zip(ours, theirs)) if a != b), min(len(ours), len(theirs)))
+        found.append(f'{table}: {len(ours)} rows replayed, {len(theirs)} expected, first difference at row {at}: '
+                     f'{ours[at] if at < len(ours) else None} != {theirs[at] if at < len(theirs) else None}')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a capture (see capture.py) straight into the engine.')
+    parser.add_argument('capture')
+    parser.add_argument('--db', help='Database to start from, defaults to the copy made when capturing')
+    parser.add_argument('--expected', help='Database to compare the result with, like the one that was captured')
+    parser.add_argument('--speed', type=float,
+                        help='Keep the original pace, sped up this many times. By default, replay as fast as possible.')
+    parser.add_argument('--storage', choices=['memory', 'disk'], default='memory')
+    parser.add_argument('--output', help='Save the results as JSON')
+    args = parser.parse_args()
+
+    lines = load(args.capture)
+    with tempfile.TemporaryDirectory() as directory:
+        conn = connect_to_db(':memory:' if args.storage == 'memory' else os.path.join(directory, 'replay.db'))
+        source = sqlite3.connect(args.db or f'{args.capture}.db')
+        source.backup(conn)
+        source.close()
+        drop_book(conn)
+        try:
+            results = replay(conn.cursor(), lines, args.speed)
+            replayed = dump(conn.cursor())
+        finally:
+            drop_book(conn)
+            conn.close()
+
+    print(f"Replayed {results['calls']} calls with {results['orders']} orders in {results['seconds']:.3f} s: "
+          f"{results['calls_per_second'] or 0:.0f} calls/s, {results['orders_per_second'] or 0:.0f} orders/s. "
+          f"{results['errors']} failed.")
+    results['sha256'] = {table: hashlib.sha256(data).hexdigest() for table, data in replayed.items()}
+    found = []
+    if args.expected:
+        expected = connect_to_db(args.expected, read_only=True)
+        found = differences(replayed, dump(expected.cursor()))
+        expected.close()
+        for difference in found:
+            print(f'Mismatch in {difference}')
+        if not found:
+            print(f"Identical: {', '.join(COMPARED)}.")
+        results['mismatches'] = found
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if found or results['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
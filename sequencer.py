@@ -0,0 +1,245 @@
+from concurrent.futures import Future
+import itertools
+import logging
+from multiprocessing.connection import Client, Connection, Listener
+import os
+import queue
+import socket
+import threading
+from typing import Callable, Optional
+
+from db_utils import claim_writer, get_pool, migrate, DEFAULT_INSTRUMENT
+from engine import limit_order, limit_orders, cancel_order, cancel_orders, cancel_all_orders, amend_order
+from engine import transfer_cash, allocate_shares, distribute_dividend, add_earnings, add_instrument, add_accounts
+from engine import apply_levels, engine_lock, follow, notify, subscribe
+from tape import TradeTape
+from workers import MatchingWorker
+import capture
+import journal
+
+logger = logging.getLogger(__name__)
+
+# What API processes are allowed to ask for, by name
+COMMANDS = {func.__name__: func
+            for func in (limit_order, limit_orders, cancel_order, cancel_orders, cancel_all_orders, amend_order,
+                         transfer_cash, allocate_shares, distribute_dividend, add_earnings, add_instrument,
+                         add_accounts)}
+# Commands that aren't about one book, they get a worker of their own
+ADMIN_COMMANDS = {'transfer_cash', 'allocate_shares', 'distribute_dividend', 'add_earnings', 'add_instrument',
+                  'add_accounts', 'cancel_all_orders'}
+
+
+class Peer:
+    """One connected API process. Messages go out on their own thread, so a slow peer never holds up matching."""
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.outbox = queue.Queue()
+        self.thread = threading.Thread(target=self._send, daemon=True)
+        self.thread.start()
+
+    def send(self, message: tuple):
+        self.outbox.put(message)
+
+    def _send(self):
+        while True:
+            message = self.outbox.get()
+            if message is None:
+                return
+            try:
+                self.conn.send(message)
+            except (OSError, ValueError):
+                return
+
+    def close(self):
+        self.outbox.put(None)
+
+
+class Sequencer:
+    """
+    The single writer: owns the matching engine and the write connections, and runs order entry for every
+    API process. Like get_worker does without a sequencer, every instrument has a worker of its own, which runs
+    the calls for it one at a time in the order they arrive, so a busy book only holds up its own orders.
+    Admin changes and cancelling everything go to one more worker, self.worker. Commits still happen one at a time
+    under the engine lock, so the journal has a single order.
+    Every peer gets the events of every commit, before the reply to the call that caused them.
+    Run it with `python sequencer.py`, and start the API processes with the same SEQUENCER_ADDRESS.
+    """
+
+    def __init__(self, address, authkey: bytes, location: Optional[str] = None):
+        self.listener = Listener(address, authkey=authkey)
+        self.location = location or os.environ.get('DB_LOCATION', ':memory:')
+        self.worker = MatchingWorker(self.location, 'sequencer')
+        self.workers: dict[str, MatchingWorker] = {}  # Per instrument
+        self.threads = {self.worker.thread}
+        self.peers: set[Peer] = set()
+        self.lock = threading.Lock()
+        subscribe(self.broadcast)
+
+    def worker_for(self, command: str, kwargs: dict) -> MatchingWorker:
+        """The worker of the instrument a command is about, started on first use, or self.worker."""
+        if command in ADMIN_COMMANDS:
+            return self.worker
+        if command == 'limit_orders':
+            instruments = {order.get('instrument', DEFAULT_INSTRUMENT) for order in kwargs.get('orders', [])}
+            if len(instruments) != 1:
+                return self.worker
+            instrument, = instruments
+        else:
+            instrument = kwargs.get('instrument', DEFAULT_INSTRUMENT)
+        with self.lock:
+            if instrument not in self.workers:
+                self.workers[instrument] = MatchingWorker(self.location, f'sequencer-{instrument}')
+                self.threads.add(self.workers[instrument].thread)
+            return self.workers[instrument]
+
+    def broadcast(self, events: list[dict]):
+        """Engine listener, see engine.subscribe."""
+        if threading.current_thread() not in self.threads:
+            return  # Not ours to send, like events a SequencerClient in the same process got from us already
+        with self.lock:
+            for peer in self.peers:
+                peer.send(('events', events))
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                return  # Closed
+            except Exception:
+                logger.exception('Rejected a connection')  # Most likely the wrong authkey
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn: Connection):
+        peer = Peer(conn)
+        with self.lock:
+            self.peers.add(peer)
+        try:
+            while True:
+                request_id, command, kwargs = conn.recv()
+                if command not in COMMANDS:
+                    peer.send(('reply', request_id, False, Exception(f'Unknown command {command}.')))
+                    continue
+                self.worker_for(command, kwargs).submit(COMMANDS[command], **kwargs).add_done_callback(
+                    lambda future, request_id=request_id: peer.send(('reply', request_id, *_outcome(future)))
+                )
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.peers.discard(peer)
+            peer.close()
+
+    def close(self):
+        self.listener.close()
+        for worker in [self.worker, *self.workers.values()]:
+            worker.close()
+
+
+def _outcome(future: Future) -> tuple[bool, object]:
+    error = future.exception()
+    if error is None:
+        return True, future.result()
+    return False, Exception(str(error))  # Plain exceptions always unpickle on the other side
+
+
+class SequencerClient:
+    """
+    Hands engine calls to the sequencer, with the same interface as a MatchingWorker.
+    Applies the events the sequencer sends: keeps the price levels of the books up to date with them, so reads never
+    need to load a book, and tells the local listeners. Since events arrive before the reply, a caller sees its own
+    order in the book.
+    """
+
+    def __init__(self, address, authkey: bytes):
+        pool = get_pool(read_only=True)
+        conn = pool.acquire()
+        try:
+            self.location = follow(conn)
+        finally:
+            pool.release(conn)
+        self.conn = Client(address, authkey=authkey)
+        self.pending: dict[int, Future] = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._receive, daemon=True)
+        self.thread.start()
+
+    def submit(self, func: Callable, **kwargs) -> Future:
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ConnectionError('Lost the connection to the sequencer.')
+            request_id = next(self.ids)
+            self.pending[request_id] = future
+            try:
+                self.conn.send((request_id, func.__name__, kwargs))
+            except Exception:
+                del self.pending[request_id]
+                raise
+        return future
+
+    def _receive(self):
+        try:
+            while True:
+                kind, *message = self.conn.recv()
+                if kind == 'events':
+                    self._apply(*message)
+                else:
+                    request_id, ok, value = message
+                    with self.lock:
+                        future = self.pending.pop(request_id)
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.conn.close()
+            with self.lock:
+                self.closed = True
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                future.set_exception(ConnectionError('Lost the connection to the sequencer.'))
+
+    def _apply(self, events: list[dict]):
+        with engine_lock:
+            apply_levels(self.location, events)
+            notify(events)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        # Closing the connection under the receiving thread doesn't wake it up, shutting down the socket does
+        try:
+            with socket.socket(fileno=os.dup(self.conn.fileno())) as sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # It's gone already
+        self.thread.join()
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    sequencer = Sequencer(os.environ['SEQUENCER_ADDRESS'], os.environ['SECRET_KEY'].encode())
+    claim_writer(sequencer.location)
+    # Bring the database up to date, and the tables up with the journal, before taking orders
+    sequencer.worker.submit(lambda c: migrate(c.connection)).result()
+    sequence = sequencer.worker.submit(journal.recover).result()
+    if sequence is not None:
+        logger.info('Replayed the journal up to %s', sequence)
+    if os.environ.get('CAPTURE_PATH'):
+        sequencer.worker.submit(lambda c: capture.start(os.environ['CAPTURE_PATH'], c.connection)).result()
+        logger.info('Capturing to %s', os.environ['CAPTURE_PATH'])
+    if os.environ.get('TAPE_DIR'):
+        trade_tape = TradeTape(os.environ['TAPE_DIR'], sequencer.location)
+        sequencer.worker.submit(trade_tape.catch_up).result()
+        subscribe(trade_tape.publish)
+    sequencer.serve_forever()
@@ -0,0 +1,228 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+import logging
+import mmap
+import os
+import struct
+import threading
+from typing import Iterator, Optional
+
+from db_utils import connect_to_db
+
+logger = logging.getLogger(__name__)
+
+# The tape: trades and price level changes as fixed-width records in append-only files, for analytics and for
+# serving /trades without going through SQLite row by row. A tape is a directory of files named after the sequence
+# number of their first record, each a header and then records, and a new file starts once one reaches max_bytes.
+# Sequence numbers go up by one per record, so finding one is arithmetic: trades use the sequence of the trades
+# table, levels get their own. Readers map the files, so they can be in other processes than the one writing.
+# Instrument symbols are stored in 16 bytes, longer ones get cut off.
+MAGIC = b'OBTAPE\x00\x01'
+HEADER = struct.Struct('<8sHHIq40x')  # magic, version, record size, reserved, first sequence number
+# sequence, microseconds since the epoch (local time, like the timestamps in the database), kind, instrument,
+# price, amount, and then buyer and seller for trades, or the number of orders for levels
+RECORD = struct.Struct('<qqB7x16sqqqq')
+TRADE, BID, ASK = 0, 1, 2
+EPOCH = datetime(1970, 1, 1)
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def microseconds(timestamp: datetime) -> int:
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def timestamp(microseconds: int) -> datetime:
+    return EPOCH + timedelta(microseconds=microseconds)
+
+
+@lru_cache(maxsize=1024)
+def _second(seconds: int) -> str:
+    return str(EPOCH + timedelta(seconds=seconds))
+
+
+def timestamp_text(microseconds: int) -> str:
+    """str(timestamp(microseconds)), like the database has it, but a lot quicker since trades come in bunches."""
+    seconds, fraction = divmod(microseconds, 1_000_000)
+    return f'{_second(seconds)}.{fraction:06d}' if fraction else _second(seconds)
+
+
+def _files(directory: str) -> list[tuple[int, str]]:
+    """(first sequence number, path) of every file of the tape in order."""
+    names = [name for name in os.listdir(directory) if name.endswith('.tape')] if os.path.isdir(directory) else []
+    return sorted((int(name[:-len('.tape')]), os.path.join(directory, name)) for name in names)
+
+
+class TapeWriter:
+    """Appends records to a tape. Only one writer per tape, and it isn't thread safe: engine listeners don't need it."""
+
+    def __init__(self, directory: str, max_bytes: int = MAX_BYTES, first: int = 1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        files = _files(directory)
+        if files:
+            start, path = files[-1]
+            self.file = open(path, 'r+b')
+            # Drop half a record, if we crashed while writing one
+            records = (os.path.getsize(path) - HEADER.size) // RECORD.size
+            self.file.truncate(HEADER.size + records * RECORD.size)
+            self.file.seek(0, os.SEEK_END)
+            self.next = start + records
+        else:
+            self.file = None
+            self.next = first
+
+    def _start_file(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(os.path.join(self.directory, f'{self.next:020d}.tape'), 'wb')
+        self.file.write(HEADER.pack(MAGIC, 1, RECORD.size, 0, self.next))
+
+    def append(self, records: list[tuple]):
+        """Write records (everything but the sequence number, which is the next one) and flush them."""
+        for record in records:
+            if self.file is None or self.file.tell() + RECORD.size > self.max_bytes:
+                self._start_file()
+            self.file.write(RECORD.pack(self.next, *record))
+            self.next += 1
+        if self.file is not None:
+            self.file.flush()
+
+    def truncate(self, next: int):
+        """Drop the records from sequence number next on, say after journal.restore. They have to be on the tape."""
+        self.close()
+        for start, path in reversed(_files(self.directory)):
+            if start < next:
+                self.file = open(path, 'r+b')
+                self.file.truncate(HEADER.size + (next - start) * RECORD.size)
+                self.file.seek(0, os.SEEK_END)
+                break
+            os.remove(path)
+        self.next = next
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class TapeReader:
+    """
+    Reads a tape by mapping its files. Files grow while we read them, so a file is mapped again once it's grown.
+    view gives the records as raw bytes without copying them, records unpacks them one at a time.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.maps: dict[str, mmap.mmap] = {}
+        self.lock = threading.Lock()
+
+    def _map(self, path: str) -> memoryview:
+        with self.lock:
+            size = os.path.getsize(path)
+            if size < HEADER.size:
+                return memoryview(b'')  # Just created, the header is on its way
+            mapped = self.maps.get(path)
+            if mapped is None or len(mapped) != size:
+                with open(path, 'rb') as file:
+                    header = HEADER.unpack_from(file.read(HEADER.size))
+                    if header[0] != MAGIC or header[2] != RECORD.size:
+                        raise ValueError(f'{path} is not a tape we can read.')
+                    # Old maps go away once nobody has a view of them anymore
+                    mapped = self.maps[path] = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        records = (size - HEADER.size) // RECORD.size
+        return memoryview(mapped)[HEADER.size:HEADER.size + records * RECORD.size]
+
+    def bounds(self) -> tuple[int, int]:
+        """First and last sequence number on the tape. The last is one less than the first if it's empty."""
+        files = _files(self.directory)
+        if not files:
+            return 1, 0
+        start, path = files[-1]
+        return files[0][0], start + len(self._map(path)) // RECORD.size - 1
+
+    def view(self, start: Optional[int] = None, stop: Optional[int] = None) -> Iterator[memoryview]:
+        """Raw records with start <= sequence < stop, one view per file, say for numpy.frombuffer."""
+        files = _files(self.directory)
+        for i, (first, path) in enumerate(files):
+            if stop is not None and first >= stop:
+                return
+            if start is not None and i + 1 < len(files) and files[i + 1][0] <= start:
+                continue  # Nothing we want in this one
+            records = self._map(path)
+            count = len(records) // RECORD.size
+            begin = 0 if start is None else max(0, start - first)
+            end = count if stop is None else min(count, stop - first)
+            if begin < end:
+                yield records[begin * RECORD.size:end * RECORD.size]
+
+    def records(self, start: Optional[int] = None, stop: Optional[int] = None) -> Iterator[tuple]:
+        """Unpacked records with start <= sequence < stop, see RECORD."""
+        for view in self.view(start, stop):
+            yield from RECORD.iter_unpack(view)
+
+
+def trade_record(trade: dict) -> tuple:
+    """A record without its sequence number, from a row of the trades table or a trade event."""
+    when = trade['timestamp']
+    when = datetime.fromisoformat(when) if isinstance(when, str) else when
+    return (microseconds(when), TRADE, trade['instrument'].encode()[:16], trade['price'], trade['amount'],
+            trade['buyer'], trade['seller'])
+
+
+def as_trade(record: tuple) -> dict:
+    """A trade record the way /trades returns them."""
+    sequence, when, _, instrument, price, amount, buyer, seller = record
+    return {'sequence': sequence, 'instrument': instrument.rstrip(b'\x00').decode(), 'timestamp': timestamp_text(when),
+            'buyer': buyer, 'seller': seller, 'price': price, 'amount': amount}
+
+
+class TradeTape:
+    """
+    Engine listener that writes trades to directory/trades and level changes to directory/levels.
+    Run it in the process that does the matching: the API, or the sequencer if there is one.
+    Trades it didn't see being made, like the ones from before it started, it reads from the database.
+    """
+
+    def __init__(self, directory: str, location: str, max_bytes: int = MAX_BYTES):
+        self.location = location
+        self.trades = TapeWriter(os.path.join(directory, 'trades'), max_bytes)
+        self.levels = TapeWriter(os.path.join(directory, 'levels'), max_bytes)
+
+    def catch_up(self, c):
+        """Write the trades in the database that aren't on the tape yet, or drop the ones that aren't in it anymore."""
+        last, = c.execute('select coalesce(max(sequence), 0) from trades').fetchone()
+        if self.trades.next > last + 1:
+            logger.warning('Trade tape is at %s, but the last trade is %s, dropping the rest', self.trades.next, last)
+            self.trades.truncate(last + 1)
+        rows = c.execute('select sequence, instrument, timestamp, buyer, seller, price, amount from trades '
+                         'where sequence >= ? order by sequence', (self.trades.next,))
+        for row in rows:
+            sequence, instrument, when, buyer, seller, price, amount = row
+            if sequence != self.trades.next:
+                raise ValueError(f'Trade {self.trades.next} is missing from the trades table.')
+            self.trades.append([trade_record({'instrument': instrument, 'timestamp': when, 'buyer': buyer,
+                                              'seller': seller, 'price': price, 'amount': amount})])
+
+    def publish(self, events: list[dict]):
+        """Engine listener, see engine.subscribe."""
+        trades = [event for event in events if event['type'] == 'trade']
+        if trades and trades[0]['sequence'] != self.trades.next:
+            # Someone else traded in this database, get what we missed
+            logger.warning('Trade tape is at %s, but got trade %s', self.trades.next, trades[0]['sequence'])
+            conn = connect_to_db(self.location, read_only=True)
+            try:
+                self.catch_up(conn)
+            finally:
+                conn.close()
+            trades = [trade for trade in trades if trade['sequence'] >= self.trades.next]
+        self.trades.append([trade_record(trade) for trade in trades])
+        self.levels.append([
+            (microseconds(datetime.now()), BID if event['side'] == 'buy' else ASK, event['instrument'].encode()[:16],
+             event['price'], event['amount'], event['orders'], 0)
+            for event in events if event['type'] == 'level'
+        ])
+
+    def close(self):
+        self.trades.close()
+        self.levels.close()
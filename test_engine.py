@@ -1,10 +1,35 @@
+import asyncio
+import json
+import os
+import socket
 import sqlite3
+import subprocess
+import sys
+import threading
 from copy import deepcopy
 
+import numpy as np
 import pytest
 
-from db_utils import create_db, query
-from engine import insert_order, limit_order
+from db_utils import create_db, connect_to_db, close_pools, query, DEFAULT_INSTRUMENT
+from engine import insert_order, limit_order, limit_orders, cancel_order, cancel_orders, cancel_all_orders, amend_order
+from engine import get_book, drop_book, depth
+from feed import MarketDataFeed
+from sequencer import Sequencer, SequencerClient
+from workers import MatchingWorker, close_workers
+import analytics
+import bench
+import bots
+import candles
+import capture
+import db_utils
+import engine
+import export
+import journal
+import metrics
+import positions
+import replay
+import tape
 
 
 class OrderFree:
@@ -182,6 +207,767 @@ def test_order_too_big(orderbook):
                                         {'participant_id': 1, 'balance': 100 - 31*5, 'stock': 15}]))
 
 
+def test_sweep_levels(orderbook):
+    orders = [
+        {'participant_id': 0, 'price': 33, 'amount': -3},
+        {'participant_id': 1, 'price': 31, 'amount': -3},
+        {'participant_id': 0, 'price': 32, 'amount': -3},
+        {'participant_id': 2, 'price': 32, 'amount': 8},
+    ]
+    accounts = [{'participant_id': 0, 'balance': 100, 'stock': 10},
+                {'participant_id': 1, 'balance': 100, 'stock': 10},
+                {'participant_id': 2, 'balance': 100, 'stock': 10}]
+
+    c = orderbook.cursor()
+    insert_accounts(c, accounts)
+    for order in orders:
+        order['logical_timestamp'] = limit_order(c, **order)
+
+    book_, accounts_ = read(c)
+    expected_order = orders[3]
+    expected_order['amount'] = 2
+    assert (book_ == OrderFree([orders[0], expected_order])) \
+           and (accounts_ == OrderFree([{'participant_id': 0, 'balance': 100 + 32 * 3, 'stock': 7},
+                                        {'participant_id': 1, 'balance': 100 + 31 * 3, 'stock': 7},
+                                        {'participant_id': 2, 'balance': 100 - 31 * 3 - 32 * 3, 'stock': 16}]))
+
+
+def test_cancel_order(orderbook):
+    accounts = [{'participant_id': 0, 'balance': 100, 'stock': 10}, {'participant_id': 1, 'balance': 100, 'stock': 10}]
+    c = orderbook.cursor()
+    insert_accounts(c, accounts)
+
+    ts = limit_order(c, participant_id=0, price=31, amount=-5)
+    assert not cancel_order(c, participant_id=1, logical_timestamp=ts)
+    assert cancel_order(c, participant_id=0, logical_timestamp=ts)
+    assert not cancel_order(c, participant_id=0, logical_timestamp=ts)
+
+    # Cancelled order should not be matched anymore
+    limit_order(c, participant_id=1, price=31, amount=5)
+    book_, accounts_ = read(c)
+    assert book_ == [{'participant_id': 1, 'price': 31, 'amount': 5, 'logical_timestamp': ts + 1}]
+    assert accounts_ == OrderFree(accounts)
+
+    assert cancel_all_orders(c, participant_id=1) == [ts + 1]
+    assert read(c)[0] == [] and len(get_book(c)) == 0
+
+
+def test_amend_and_cancel_orders(orderbook):
+    accounts = [{'participant_id': 0, 'balance': 100, 'stock': 10}, {'participant_id': 1, 'balance': 100, 'stock': 10}]
+    c = orderbook.cursor()
+    insert_accounts(c, accounts)
+    first = limit_order(c, participant_id=0, price=31, amount=-5)
+    second = limit_order(c, participant_id=1, price=31, amount=-5)
+
+    # Shrinking keeps the place in the queue, anything else is a new order at the back
+    assert amend_order(c, participant_id=1, logical_timestamp=first, size=1) is None
+    assert amend_order(c, participant_id=0, logical_timestamp=first, size=3) == first
+    assert get_book(c).depth(False) == [{'price': 31, 'amount': 8, 'orders': 2}]
+    limit_order(c, participant_id=1, price=31, amount=2)
+    assert get_book(c).get(first).amount == -1 and get_book(c).get(second).amount == -5
+    replaced = amend_order(c, participant_id=0, logical_timestamp=first, size=2)
+    assert replaced > second and first not in get_book(c)
+    with pytest.raises(Exception, match='Shorting'):
+        amend_order(c, participant_id=0, logical_timestamp=replaced, size=20)
+    assert get_book(c).get(replaced).amount == -2
+
+    # A new price can trade right away
+    bid = limit_order(c, participant_id=0, price=29, amount=1)
+    moved = amend_order(c, participant_id=1, logical_timestamp=second, price=29)
+    assert bid not in get_book(c) and second not in get_book(c) and get_book(c).get(replaced).amount == -2
+
+    assert cancel_orders(c, participant_id=0, logical_timestamps=[replaced, bid, moved]) == [replaced]
+    assert read(c)[0] == [{'participant_id': 1, 'price': 29, 'amount': -4, 'logical_timestamp': moved}]
+    assert journal.state_at(c)[0].rows()['exchange'] == [(moved, 1, DEFAULT_INSTRUMENT, 29, -4)]
+
+
+def test_positions():
+    # Long 10 at 3, sell 4 at 5, then flip to short 2 at 1
+    position = positions.fill(0, 0.0, 0.0, 3, 10)
+    assert position == (10, 30.0, 0.0)
+    position = positions.fill(*position, 5, -4)
+    assert position == (6, 18.0, 8.0)
+    position = positions.fill(*position, 1, -8)
+    assert position == (-2, -2.0, -4.0)
+    assert positions.allocate(10, 30.0, -4) == (6, 18.0) and positions.allocate(6, 18.0, 4) == (10, 18.0)
+    assert positions.allocate(6, 18.0, -6) == (0, 0.0) and positions.fill(0, 18.0, 0.0, 3, 1) == (1, 3.0, 0.0)
+    assert positions.pnl(*position, mark=2) == {
+        'stock': -2, 'average_price': 1.0, 'mark': 2, 'value': -4, 'realized': -4.0, 'unrealized': -2.0, 'pnl': -6.0
+    }
+
+
+def test_credit_stock(orderbook):
+    insert_accounts(orderbook, [{'participant_id': 0, 'balance': 0}, {'participant_id': 1, 'balance': 0}])
+    stock = 'select participant_id, stock from positions order by 1'
+    # All or nothing: 1 would end up short, so 0 doesn't get any either
+    with pytest.raises(ValueError, match='participant 1 short'):
+        engine.credit_stock(orderbook.cursor(), DEFAULT_INSTRUMENT, [(0, 5), (1, -6), (1, -5)])
+    assert orderbook.execute(stock).fetchall() == [(0, 10), (1, 10)]
+    engine.credit_stock(orderbook.cursor(), DEFAULT_INSTRUMENT, [(0, 5), (1, -10), (2, 3)])
+    assert orderbook.execute(stock).fetchall() == [(0, 15), (1, 0), (2, 3)]
+
+
+def test_take_back_stock(orderbook):
+    c = orderbook.cursor()
+    c.executemany('insert into accounts(participant_id, balance) values (?, 1000)', [(0,), (1,)])
+    held = 'select stock, cost, realized from positions where participant_id=1'
+    engine.allocate_shares(c, DEFAULT_INSTRUMENT, [(0, 10)])
+    limit_order(c, participant_id=0, price=30, amount=-10)
+    limit_order(c, participant_id=1, price=30, amount=10)
+    assert c.execute(held).fetchone() == (10, 300.0, 0.0)
+    # Half of it goes with half the cost, the rest with all of it
+    engine.allocate_shares(c, DEFAULT_INSTRUMENT, [(1, -5)])
+    assert c.execute(held).fetchone() == (5, 150.0, 0.0)
+    engine.allocate_shares(c, DEFAULT_INSTRUMENT, [(1, -5)])
+    assert c.execute(held).fetchone() == (0, 0.0, 0.0)
+    engine.allocate_shares(c, DEFAULT_INSTRUMENT, [(0, 5)])
+    limit_order(c, participant_id=0, price=40, amount=-5)
+    limit_order(c, participant_id=1, price=40, amount=5)
+    assert positions.pnl(*c.execute(held).fetchone(), mark=40) == {
+        'stock': 5, 'average_price': 40.0, 'mark': 40, 'value': 200, 'realized': 0.0, 'unrealized': 0.0, 'pnl': 0.0
+    }
+    assert journal.state_at(c)[0].rows()['positions'] == c.execute('select * from positions order by 1, 2').fetchall()
+    drop_book(c)
+
+
+def test_add_accounts(orderbook):
+    c = orderbook.cursor()
+    alice, bob = engine.add_accounts(c, [('alice', 'hash'), ('bob', 'hash')], 100)
+    # All or nothing, carol doesn't get in either
+    with pytest.raises(ValueError, match='already exists'):
+        engine.add_accounts(c, [('carol', 'hash'), ('bob', 'hash')], 100)
+    assert c.execute('select name, participant_id from auth order by 2').fetchall() == [('alice', alice), ('bob', bob)]
+    assert c.execute('select * from accounts order by 1').fetchall() == [(alice, 100), (bob, 100)]
+    assert journal.state_at(c)[0].rows()['accounts'] == [(alice, 100), (bob, 100)]
+
+
+def test_book_mirrors_exchange(orderbook):
+    accounts = [{'participant_id': 0, 'balance': 100, 'stock': 10}, {'participant_id': 1, 'balance': 100, 'stock': 10}]
+    c = orderbook.cursor()
+    insert_accounts(c, accounts)
+    for price, amount in [(31, -3), (32, -3), (30, 2), (29, 4), (32, 4), (30, -5)]:
+        limit_order(c, participant_id=price % 2, price=price, amount=amount)
+
+    book = get_book(c)
+    in_memory = [{'participant_id': o.participant_id, 'price': o.price, 'amount': o.amount, 'logical_timestamp': ts}
+                 for ts, o in book.orders.items()]
+    book_, _ = read(c)
+    assert book_ == OrderFree(in_memory)
+
+    # Reloading from the exchange table gives the same book
+    drop_book(c)
+    assert get_book(c).prices == book.prices
+    assert {ts: o.amount for ts, o in get_book(c).orders.items()} == {ts: o.amount for ts, o in book.orders.items()}
+
+
+def test_single_commit(orderbook):
+    accounts = [{'participant_id': 0, 'balance': 100, 'stock': 10}, {'participant_id': 1, 'balance': 100, 'stock': 10}]
+    c = orderbook.cursor()
+    insert_accounts(c, accounts)
+    limit_order(c, participant_id=0, price=31, amount=-5)
+
+    statements = []
+    orderbook.set_trace_callback(statements.append)
+    limit_order(c, participant_id=1, price=31, amount=3)
+    orderbook.set_trace_callback(None)
+    assert statements.count('COMMIT') == 1 and statements[-1] == 'COMMIT'
+    assert not orderbook.in_transaction
+
+
+def test_batch(orderbook):
+    accounts = [{'participant_id': 0, 'balance': 100, 'stock': 10}, {'participant_id': 1, 'balance': 100, 'stock': 10}]
+    c = orderbook.cursor()
+    insert_accounts(c, accounts)
+
+    results = limit_orders(c, [
+        {'participant_id': 0, 'price': 31, 'amount': -5},
+        {'participant_id': 0, 'price': 30, 'amount': -20},  # Would go short
+        {'participant_id': 1, 'price': 32, 'amount': 3},
+        {'participant_id': 1, 'price': 30, 'amount': 3, 'time_in_force': 'IOC'},
+    ])
+    assert not orderbook.in_transaction
+    assert results == [
+        {'logical_timestamp': 1, 'fills': []},
+        {'error': 'Shorting is not allowed.'},
+        {'logical_timestamp': 2, 'fills': [{'logical_timestamp': 1, 'price': 31, 'amount': 3}]},
+        {'logical_timestamp': 3, 'fills': []},
+    ]
+    book_, accounts_ = read(c)
+    assert book_ == [{'participant_id': 0, 'price': 31, 'amount': -2, 'logical_timestamp': 1}] \
+           and accounts_ == OrderFree([{'participant_id': 0, 'balance': 100 + 31 * 3, 'stock': 7},
+                                       {'participant_id': 1, 'balance': 100 - 31 * 3, 'stock': 13}])
+
+
+def test_depth(orderbook):
+    accounts = [{'participant_id': 0, 'balance': 100, 'stock': 10}, {'participant_id': 1, 'balance': 100, 'stock': 10}]
+    c = orderbook.cursor()
+    insert_accounts(c, accounts)
+    for price, amount in [(31, -3), (31, -2), (33, -1), (29, 4), (28, 1), (28, 2)]:
+        limit_order(c, participant_id=0, price=price, amount=amount)
+    to_cancel = limit_order(c, participant_id=1, price=32, amount=-4)
+    assert depth(c, 2) == {
+        'buy': [{'price': 29, 'amount': 4, 'orders': 1}, {'price': 28, 'amount': 3, 'orders': 2}],
+        'sell': [{'price': 31, 'amount': 5, 'orders': 2}, {'price': 32, 'amount': 4, 'orders': 1}],
+    }
+
+    # Fill one and a half orders at 31, cancel 32
+    limit_order(c, participant_id=1, price=31, amount=4)
+    cancel_order(c, participant_id=1, logical_timestamp=to_cancel)
+    assert depth(c)['sell'] == [{'price': 31, 'amount': 1, 'orders': 1}, {'price': 33, 'amount': 1, 'orders': 1}]
+
+    # Same as rebuilding from scratch
+    expected = depth(c)
+    drop_book(c)
+    assert depth(c) == expected
+
+
+def test_trades(orderbook):
+    accounts = [{'participant_id': 0, 'balance': 100, 'stock': 10}, {'participant_id': 1, 'balance': 100, 'stock': 10}]
+    c = orderbook.cursor()
+    insert_accounts(c, accounts)
+    limit_order(c, participant_id=0, price=31, amount=-2)
+    limit_order(c, participant_id=0, price=32, amount=-2)
+    limit_order(c, participant_id=1, price=32, amount=3)
+    limit_order(c, participant_id=1, price=30, amount=2)
+    limit_order(c, participant_id=0, price=29, amount=-4)
+
+    trades = query(c, 'select sequence, buyer, seller, price, amount from trades order by sequence')
+    assert trades == [
+        {'sequence': 1, 'buyer': 1, 'seller': 0, 'price': 31, 'amount': 2},
+        {'sequence': 2, 'buyer': 1, 'seller': 0, 'price': 32, 'amount': 1},
+        {'sequence': 3, 'buyer': 1, 'seller': 0, 'price': 30, 'amount': 2},
+    ]
+    assert query(c, "select * from log where event ->> 'type' = 'trade'") == []
+
+
+def test_candles(orderbook):
+    c = orderbook.cursor()
+    insert_accounts(c, [{'participant_id': 0, 'balance': 10 ** 6}, {'participant_id': 1, 'balance': 10 ** 6}])
+    # Earlier trades, spread over a few minutes
+    c.executemany('insert into trades(timestamp, instrument, buyer, seller, price, amount) values (?, ?, 1, 0, ?, ?)',
+                  [(f'2024-01-01 10:0{minute}:{second:02d}', DEFAULT_INSTRUMENT, price, amount)
+                   for minute, second, price, amount in [(0, 0, 30, 2), (0, 0, 32, 1), (0, 59, 28, 3), (4, 30, 31, 1),
+                                                         (5, 1, 35, 4), (9, 0, 33, 2)]])
+    store = candles.CandleStore()
+    store.backfill(c)
+    minutes = c.execute("select strftime('%Y-%m-%d %H:%M:00', timestamp) as start, max(price), min(price), sum(amount) "
+                        'from trades group by start order by start').fetchall()
+    assert [(candle['start'], candle['high'], candle['low'], candle['volume'])
+            for candle in store.get('1m', 10)] == minutes
+    assert [(candle['open'], candle['close'], candle['vwap']) for candle in store.get('5m', 10)] == [
+        (30, 31, (60 + 32 + 84 + 31) / 7), (35, 33, (140 + 66) / 6)
+    ]
+
+    # New trades go into the candles as they happen, and end up the same as backfilling them
+    engine.subscribe(store.publish)
+    try:
+        limit_order(c, participant_id=0, price=31, amount=-3)
+        limit_order(c, participant_id=1, price=32, amount=2)
+        limit_order(c, participant_id=0, price=29, amount=-2)
+        limit_order(c, participant_id=1, price=30, amount=3)
+    finally:
+        engine.listeners.remove(store.publish)
+    backfilled = candles.CandleStore()
+    backfilled.backfill(c)
+    # A sequencer can still send trades the backfill read already, those don't count twice
+    late = query(c, 'select * from trades order by sequence desc limit 1')[0]
+    backfilled.publish([{'type': 'trade', **late, 'journal': 1}])
+    for resolution in candles.RESOLUTIONS:
+        assert store.get(resolution, 10) == backfilled.get(resolution, 10)
+    assert store.vwap() == backfilled.vwap() == c.execute('select 1.0 * sum(price * amount) / sum(amount) '
+                                                          'from trades').fetchone()[0]
+    drop_book(c)
+
+
+def test_instruments(orderbook):
+    accounts = [{'participant_id': 0, 'balance': 100, 'stock': 10}, {'participant_id': 1, 'balance': 100, 'stock': 10}]
+    c = orderbook.cursor()
+    c.execute("insert into instruments(symbol) values ('OTHER')")
+    insert_accounts(c, accounts)
+    insert_accounts(c, [], 'OTHER')
+    c.execute("insert into positions(participant_id, instrument, stock) values (1, 'OTHER', 3)")
+
+    sell = limit_order(c, participant_id=0, price=31, amount=-5)
+    # Same price in another instrument doesn't match, and participant 0 has no OTHER to sell
+    other = limit_order(c, participant_id=1, price=31, amount=-3, instrument='OTHER')
+    with pytest.raises(Exception, match='Shorting'):
+        limit_order(c, participant_id=0, price=31, amount=-1, instrument='OTHER')
+    with pytest.raises(Exception, match='Unknown instrument'):
+        limit_order(c, participant_id=0, price=31, amount=1, instrument='NOPE')
+
+    limit_order(c, participant_id=0, price=31, amount=2, instrument='OTHER')
+    limit_order(c, participant_id=1, price=31, amount=1)
+
+    book_, accounts_ = read(c)
+    assert book_ == [{'participant_id': 0, 'price': 31, 'amount': -4, 'logical_timestamp': sell}]
+    assert accounts_ == OrderFree([{'participant_id': 0, 'balance': 100 - 2 * 31 + 31, 'stock': 9},
+                                   {'participant_id': 1, 'balance': 100 + 2 * 31 - 31, 'stock': 11}])
+    book_, accounts_ = read(c, 'OTHER')
+    assert book_ == [{'participant_id': 1, 'price': 31, 'amount': -1, 'logical_timestamp': other}]
+    assert accounts_ == OrderFree([{'participant_id': 0, 'balance': 100 - 2 * 31 + 31, 'stock': 2},
+                                   {'participant_id': 1, 'balance': 100 + 2 * 31 - 31, 'stock': 1}])
+
+    assert depth(c, instrument='OTHER')['sell'] == [{'price': 31, 'amount': 1, 'orders': 1}]
+    assert cancel_all_orders(c, participant_id=1, instrument='OTHER') == [other]
+    assert len(get_book(c, 'OTHER')) == 0 and len(get_book(c)) == 1
+
+
+def test_feed():
+    feed = MarketDataFeed(history=3, max_queue=2)
+
+    async def follow():
+        slow, backlog, sequence = feed.subscribe(asyncio.get_running_loop(), since=0)
+        assert backlog is None and sequence is None
+        # Messages are numbered by the journal, so another process numbers them the same
+        for journaled in (11, 12, 14, 15):
+            feed.publish([{'type': 'trade', 'price': journaled, 'journal': journaled}])
+        await asyncio.sleep(0)
+        # Two behind is as far as it goes, the rest is dropped and the client told to resync
+        assert [slow.queue.get_nowait() for _ in range(3)] == [
+            {'type': 'events', 'sequence': 11, 'events': [{'type': 'trade', 'price': 11, 'journal': 11}]},
+            {'type': 'events', 'sequence': 12, 'events': [{'type': 'trade', 'price': 12, 'journal': 12}]},
+            None,
+        ]
+        feed.publish([{'type': 'trade', 'price': 17, 'journal': 17}])
+        await asyncio.sleep(0)
+        assert slow.lagging and slow.queue.empty()
+        feed.unsubscribe(slow)
+        # Catching up from the history while it lasts, or a snapshot after that, or from before we were around
+        _, backlog, sequence = feed.subscribe(asyncio.get_running_loop(), since=12)
+        assert [message['sequence'] for message in backlog] == [14, 15, 17] and sequence == 17
+        _, backlog, _ = feed.subscribe(asyncio.get_running_loop(), since=11)
+        assert backlog is None
+        fresh = MarketDataFeed()
+        fresh.publish([{'type': 'trade', 'price': 17, 'journal': 17}])
+        assert [message['sequence'] for message in fresh.subscribe(asyncio.get_running_loop(), since=16)[1]] == [17]
+        assert fresh.subscribe(asyncio.get_running_loop(), since=15)[1] is None
+        fresh.publish([{'type': 'trade', 'price': 9, 'journal': 9}])  # Restored to an earlier point
+        assert [message['sequence'] for message in fresh.subscribe(asyncio.get_running_loop(), since=8)[1]] == [9]
+        assert fresh.subscribe(asyncio.get_running_loop(), since=17)[1] is None
+
+    asyncio.run(follow())
+
+
+def test_sequencer(tmp_path, monkeypatch):
+    location = str(tmp_path / 'exchange.db')
+    monkeypatch.setenv('DB_LOCATION', location)
+    conn = create_db(location)
+    insert_accounts(conn, [{'participant_id': i, 'balance': 1000} for i in range(4)])
+    conn.commit()
+    conn.close()
+
+    sequencer = Sequencer(str(tmp_path / 'sequencer.sock'), b'secret', location)
+    threading.Thread(target=sequencer.serve_forever, daemon=True).start()
+    clients = [SequencerClient(str(tmp_path / 'sequencer.sock'), b'secret') for _ in range(2)]
+    try:
+        # Two API processes sending orders at the same time still get every order matched one at a time
+        futures = [clients[i % 2].submit(limit_order, participant_id=i % 4, price=30 + i % 3, amount=(-1) ** i)
+                   for i in range(40)]
+        timestamps = [future.result(timeout=10) for future in futures]
+        assert sorted(timestamps) == list(range(1, 41))
+
+        with pytest.raises(Exception, match='Shorting is not allowed.'):
+            clients[0].submit(limit_order, participant_id=0, price=30, amount=-100).result(timeout=10)
+        with pytest.raises(Exception, match='Unknown command'):
+            clients[0].submit(create_db, location=location).result(timeout=10)
+        # Admin changes go through it too
+        clients[1].submit(engine.transfer_cash, transfers=[(3, 5)]).result(timeout=10)
+        clients[1].submit(engine.add_instrument, symbol='OTHER').result(timeout=10)
+        clients[1].submit(engine.allocate_shares, instrument='OTHER', allocations=[(0, 5)]).result(timeout=10)
+        # Every instrument has a worker of its own, a book that's busy doesn't hold up the others
+        busy = threading.Event()
+        sequencer.workers[DEFAULT_INSTRUMENT].submit(lambda c: busy.wait(10))
+        stuck = clients[0].submit(limit_order, participant_id=1, price=30, amount=1)
+        clients[1].submit(limit_order, participant_id=0, price=30, amount=-1, instrument='OTHER').result(timeout=10)
+        assert not stuck.done()
+        busy.set()
+        stuck.result(timeout=10)
+        assert set(sequencer.workers) == {DEFAULT_INSTRUMENT, 'OTHER'}
+
+        # The replies come after the events, so the book we read has every order in it already
+        conn = connect_to_db(location)
+        book, _ = read(conn.cursor())
+        assert {order['logical_timestamp'] for order in book} == set(get_book(conn).orders)
+        drop_book(conn)
+
+        # Reads keep up from the level events alone, the book is only ever read once
+        loads = []
+        from_db = engine.PriceLevels.from_db
+        monkeypatch.setattr(engine.PriceLevels, 'from_db',
+                            lambda c, instrument: loads.append(instrument) or from_db(c, instrument))
+        for i in range(300):
+            if i % 7 == 6:
+                clients[i % 2].submit(cancel_all_orders, participant_id=i % 4).result(timeout=10)
+            else:  # Some of these are rejected once the money or the stock runs out, that's fine
+                clients[i % 2].submit(limit_order, participant_id=i % 4, price=25 + i % 11,
+                                      amount=(-1) ** i * (1 + i % 3)).exception(timeout=10)
+            if i % 50 == 0:
+                book = engine.OrderBook.from_db(conn)
+                assert depth(conn) == {'buy': book.depth(True), 'sell': book.depth(False)}
+        book = engine.OrderBook.from_db(conn)
+        assert depth(conn, 3) == {'buy': book.depth(True, 3), 'sell': book.depth(False, 3)}
+        assert loads == [DEFAULT_INSTRUMENT]
+        conn.close()
+    finally:
+        for client in clients:
+            client.close()
+        sequencer.close()
+        close_pools()
+
+
+def test_journal(orderbook, monkeypatch):
+    monkeypatch.setattr(journal, 'SNAPSHOT_INTERVAL', 3)
+    accounts = [{'participant_id': 0, 'balance': 100, 'stock': 10}, {'participant_id': 1, 'balance': 100, 'stock': 10}]
+    c = orderbook.cursor()
+    insert_accounts(c, accounts)
+    for account in accounts:
+        journal.append(c, {'type': 'account', 'participant_id': account['participant_id'], 'balance': 100})
+        journal.append(c, {'type': 'position', 'participant_id': account['participant_id'],
+                           'instrument': DEFAULT_INSTRUMENT, 'stock': 10})
+
+    def tables():
+        return {table: sorted(c.execute(f'select {", ".join(columns)} from {table}').fetchall())
+                for table, columns in journal.TABLES.items()}
+
+    states, trades = {}, {}
+    for price, amount in [(31, -3), (32, -3), (30, 2), (29, 4), (32, 4), (30, -5), (33, 1)]:
+        limit_order(c, participant_id=price % 2, price=price, amount=amount)
+        states[journal.head(c)] = tables()
+        trades[journal.head(c)] = query(c, 'select * from trades order by sequence')
+    cancel_all_orders(c, participant_id=0)
+    states[journal.head(c)] = tables()
+    # Someone signing up after the point we go back to
+    c.execute("insert into auth(participant_id, name, hashed_password) values (2, 'late', 'x')")
+    c.execute('insert into accounts(participant_id, balance) values (2, 100)')
+    journal.append(c, {'type': 'account', 'participant_id': 2, 'balance': 100})
+
+    # Any point in time, from whichever snapshot comes before it
+    assert query(c, 'select sequence from snapshots') == [{'sequence': 3}, {'sequence': 6}, {'sequence': 9},
+                                                          {'sequence': 12}]
+    for sequence, state in states.items():
+        rows = journal.state_at(c, sequence)[0].rows()
+        assert {table: sorted(rows[table]) for table in rows} == state
+
+    # Going back in place drops the rest of the journal, the trades and signups after it, and the book follows
+    journal.restore(c, 10)
+    drop_book(c)
+    assert tables() == states[10] and journal.head(c) == 10
+    assert query(c, 'select * from trades order by sequence') == trades[10]
+    assert query(c, 'select participant_id from auth') == []
+    assert journal.recover(c) is None
+    assert set(get_book(c).orders) == {order['logical_timestamp'] for order in read(c)[0]}
+
+
+def test_migrate(tmp_path):
+    # A database from before instruments, positions and the journal, with a trade in its log
+    conn = connect_to_db(str(tmp_path / 'old.db'))
+    conn.executescript("""
+        create table exchange (participant_id integer, price integer, amount integer,
+                               logical_timestamp integer primary key autoincrement);
+        create table accounts (participant_id integer primary key, balance integer default 0 not null,
+                               stock integer default 0 not null);
+        create table log (event json, timestamp text);
+        create table earnings (amount integer, timestamp text);
+        create table auth (participant_id integer primary key, name text unique not null,
+                           hashed_password text not null);
+        insert into accounts values (0, 90, 11), (1, 110, 9);
+        insert into exchange(participant_id, price, amount) values (0, 31, -2), (1, 29, 3);
+        insert into log values ('{"type": "trade", "buyer": 1, "seller": 0, "amount": 1, "price": 10}', '2024-01-01');
+        insert into earnings values (5, '2024-01-01');
+    """)
+    db_utils.migrate(conn)
+    db_utils.migrate(conn)  # Nothing left to do
+    assert query(conn.cursor(), 'select * from positions order by participant_id') == [
+        {'participant_id': 0, 'instrument': DEFAULT_INSTRUMENT, 'stock': 11, 'cost': 0, 'realized': 0},
+        {'participant_id': 1, 'instrument': DEFAULT_INSTRUMENT, 'stock': 9, 'cost': 0, 'realized': 0},
+    ]
+    assert conn.execute('select * from accounts').fetchall() == [(0, 90), (1, 110)]
+    assert conn.execute('select instrument, amount from earnings').fetchall() == [(DEFAULT_INSTRUMENT, 5)]
+    # The tables are as of the whole log, and the journal can rebuild them from there
+    assert journal.recover(conn) is None and journal.head(conn) == 1
+    before = {table: conn.execute(f'select * from {table}').fetchall() for table in journal.TABLES}
+    assert journal.restore(conn) == 1
+    assert {table: conn.execute(f'select * from {table}').fetchall() for table in journal.TABLES} == before
+    assert depth(conn) == {'buy': [{'price': 29, 'amount': 3, 'orders': 1}],
+                           'sell': [{'price': 31, 'amount': 2, 'orders': 1}]}
+    limit_order(conn.cursor(), participant_id=1, price=31, amount=2)
+    assert conn.execute('select sequence, buyer, seller, amount from trades').fetchall() == [(1, 1, 0, 2)]
+    drop_book(conn)
+    conn.close()
+
+
+def test_claim_writer(tmp_path):
+    location = str(tmp_path / 'test.db')
+    create_db(location).close()
+    db_utils.claim_writer(location)
+    db_utils.claim_writer(location)  # We have it already
+    other = subprocess.run([sys.executable, '-c', f'import db_utils; db_utils.claim_writer({location!r})'],
+                           capture_output=True, text=True, env={**os.environ, 'TOKEN_URL': 'token'})
+    assert other.returncode != 0 and 'Another process is writing' in other.stderr
+    bots_run = subprocess.run([sys.executable, 'bots.py', '--db', location, '--duration', '0'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    assert bots_run.returncode != 0 and 'Another process is writing' in bots_run.stderr
+
+
+def test_background_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, 'SNAPSHOT_INTERVAL', 3)
+    monkeypatch.setattr(journal, 'SNAPSHOTS_KEPT', 2)
+    location = str(tmp_path / 'test.db')
+    conn = create_db(location)
+    insert_accounts(conn, [{'participant_id': i, 'balance': 100} for i in range(2)])
+    conn.commit()
+    c = conn.cursor()
+    for price, amount in [(31, -3), (32, -3), (30, 2), (29, 4), (32, 4), (30, -5), (33, 1), (30, -1)]:
+        limit_order(c, participant_id=price % 2, price=price, amount=amount)
+        conn.commit()
+        journal.close_snapshotters()  # Wait for it, otherwise it may well be as of a later entry
+
+    # Taken once the entry was committed, and only the last ones are kept
+    state, sequence = journal.state_at(c)
+    assert query(c, 'select sequence from snapshots') == [{'sequence': 6}, {'sequence': 9}]
+    assert journal.State(c.execute('select state from snapshots where sequence=9').fetchone()[0]).rows() == \
+        journal.state_at(c, 9)[0].rows()
+    assert state.rows()['exchange'] == sorted(c.execute('select logical_timestamp, participant_id, instrument, '
+                                                        'price, amount from exchange').fetchall())
+    drop_book(conn)
+    conn.close()
+
+
+def test_capture_replay(tmp_path):
+    location = str(tmp_path / 'test.db')
+    conn = create_db(location)
+    insert_accounts(conn.cursor(), [{'participant_id': i, 'balance': 1000, 'stock': 10} for i in range(3)])
+    conn.executemany('insert into auth(participant_id, name, hashed_password) values (?, ?, ?)',
+                     [(i, f'user{i}', 'hash') for i in range(3)])
+    conn.commit()
+    capture.start(str(tmp_path / 'capture.log'), conn)
+    worker = MatchingWorker(location, 'test')
+    try:
+        for participant_id, price, amount in [(0, 31, -3), (1, 32, 4), (2, 30, -20), (2, 33, -2), (1, 33, 5)]:
+            try:
+                worker.submit(limit_order, participant_id=participant_id, price=price, amount=amount).result()
+            except Exception:
+                pass  # Shorting, so it's not in the capture
+        worker.submit(engine.transfer_cash, transfers=[(0, 5), (2, 7)]).result()
+        worker.submit(engine.add_accounts, accounts=[('dave', 'hash')], balance=100).result()
+        # Like a script setting up an account, outside of the workers
+        conn.execute('insert into accounts(participant_id, balance) values (9, 50)')
+        journal.append(conn, {'type': 'account', 'participant_id': 9, 'balance': 50})
+        conn.commit()
+        capture.committed()
+        worker.submit(limit_orders, orders=[{'participant_id': 0, 'price': 29, 'amount': 1}] * 2).result()
+        worker.submit(cancel_all_orders, participant_id=0).result()
+    finally:
+        worker.close()
+        capture.stop()
+
+    lines = replay.load(str(tmp_path / 'capture.log'))
+    assert [name for _, _, name, _ in lines] == ['limit_order'] * 4 + ['transfer_cash', 'add_accounts', 'event',
+                                                                       'limit_orders', 'cancel_all_orders']
+    replayed = connect_to_db(str(tmp_path / 'capture.log.db'))
+    try:
+        assert replay.replay(replayed.cursor(), lines)['errors'] == 0
+        assert replay.dump(replayed.cursor()) == replay.dump(conn.cursor())
+        assert replay.differences(replay.dump(replayed.cursor()), replay.dump(conn.cursor())) == []
+    finally:
+        drop_book(replayed)
+        drop_book(conn)
+        replayed.close()
+        conn.close()
+
+
+def test_tape(tmp_path):
+    location = str(tmp_path / 'test.db')
+    conn = create_db(location)
+    c = conn.cursor()
+    insert_accounts(c, [{'participant_id': 0, 'balance': 1000, 'stock': 10}, {'participant_id': 1, 'balance': 1000}])
+    conn.commit()
+    limit_order(c, participant_id=0, price=30, amount=-1)
+    limit_order(c, participant_id=1, price=30, amount=1)
+    # Three records per file, and a trade from before the tape
+    trade_tape = tape.TradeTape(str(tmp_path / 'tape'), location, tape.HEADER.size + 3 * tape.RECORD.size)
+    trade_tape.catch_up(c)
+    engine.subscribe(trade_tape.publish)
+    try:
+        for price in range(31, 37):
+            limit_order(c, participant_id=0, price=price, amount=-1)
+            limit_order(c, participant_id=1, price=price, amount=1)
+    finally:
+        engine.listeners.remove(trade_tape.publish)
+        trade_tape.close()
+        drop_book(conn)
+
+    reader = tape.TapeReader(str(tmp_path / 'tape' / 'trades'))
+    trades = query(c, 'select * from trades order by sequence')
+    conn.close()
+    assert reader.bounds() == (1, 7) and len(os.listdir(tmp_path / 'tape' / 'trades')) == 3
+    assert [tape.as_trade(record) for record in reader.records()] == trades
+    assert [tape.as_trade(record) for record in reader.records(3, 6)] == trades[2:5]
+    assert sum(len(view) for view in reader.view(2)) == 6 * tape.RECORD.size
+    levels = list(tape.TapeReader(str(tmp_path / 'tape' / 'levels')).records())
+    assert len(levels) == 12 and {record[2] for record in levels} == {tape.ASK}
+
+    # The database went back to before the fifth trade, so does the tape
+    conn = connect_to_db(location)
+    conn.execute('delete from trades where sequence > 4')
+    trade_tape = tape.TradeTape(str(tmp_path / 'tape'), location, tape.HEADER.size + 3 * tape.RECORD.size)
+    trade_tape.catch_up(conn)
+    trade_tape.close()
+    conn.close()
+    assert reader.bounds() == (1, 4) and len(os.listdir(tmp_path / 'tape' / 'trades')) == 2
+    assert [tape.as_trade(record) for record in reader.records()] == trades[:4]
+
+
+def test_export(tmp_path):
+    location = str(tmp_path / 'test.db')
+    conn = create_db(location)
+    c = conn.cursor()
+    insert_accounts(c, [{'participant_id': 0, 'balance': 1000, 'stock': 10}, {'participant_id': 1, 'balance': 1000}])
+    conn.commit()
+    for price in (10, 20):
+        limit_order(c, participant_id=0, price=price, amount=-2)
+        limit_order(c, participant_id=1, price=price, amount=1)
+    engine.pay_dividend(c, DEFAULT_INSTRUMENT, 3)
+    journal.snapshot(c)
+    conn.commit()
+    # The tape has the first two trades, the database the third as well
+    trade_tape = tape.TradeTape(str(tmp_path / 'tape'), location)
+    trade_tape.catch_up(c)
+    trade_tape.close()
+    limit_order(c, participant_id=1, price=20, amount=1)
+    limit_order(c, participant_id=1, price=5, amount=1)
+    drop_book(conn)
+
+    reader = tape.TapeReader(str(tmp_path / 'tape' / 'trades'))
+    rows = {'trades': 3, 'earnings': 0, 'dividends': 1, 'book': 3}
+    assert export.write(c, str(tmp_path / 'db'), chunk_rows=2) == rows
+    assert export.write(c, str(tmp_path / 'from_tape'), reader) == rows
+    conn.close()
+    trades = export.load(str(tmp_path / 'db'), 'trades')
+    assert all(np.array_equal(trades[column], column_from_tape)
+               for column, column_from_tape in export.load(str(tmp_path / 'from_tape'), 'trades').items())
+    assert trades['timestamp'].dtype == np.dtype('datetime64[us]') and list(trades['price']) == [10, 10, 20]
+    assert list(export.load(str(tmp_path / 'db'), 'dividends')['dividend']) == [3]
+
+    vwap = analytics.vwap(trades)
+    assert list(vwap['instrument']) == [DEFAULT_INSTRUMENT] and vwap['vwap'][0] == 40 / 3
+    volume = analytics.volume_per_participant(trades)
+    assert list(volume['participant_id']) == [0, 1] and list(volume['bought']) == [0, 3]
+    assert list(volume['cash']) == [40, -40]
+    # Only asking 20 when the snapshot was taken, and bidding 5 now
+    spread = analytics.spread(export.load(str(tmp_path / 'db'), 'book'))
+    assert np.isnan(spread['bid'][0]) and list(spread['ask']) == [20, 20] and list(spread['spread'][1:]) == [15]
+
+
+def test_bots(tmp_path, monkeypatch):
+    location = str(tmp_path / 'bots.db')
+    monkeypatch.setenv('DB_LOCATION', location)
+    conn = create_db(location)
+    insert_accounts(conn, [{'participant_id': i, 'balance': 10 ** 6} for i in range(5)])
+    conn.commit()
+    conn.close()
+
+    class Hog(bots.Bot):
+        def on_tick(self):
+            sum(range(100_000))
+
+    traders = [bots.MarketMaker('mm', seed=0), bots.NoiseTrader('noise', seed=1), Hog('hog')]
+    traders += [bots.Momentum(f'momentum{i}', seed=i) for i in range(2)]
+    for participant_id, bot in enumerate(traders):
+        bot.participant_id = participant_id
+    traders[1].every = 1
+    runtime = bots.Runtime(traders, tick=0.01, cpu_budget=0.001)
+    try:
+        asyncio.run(runtime.run(0.5))
+    finally:
+        close_workers()
+    assert engine.listeners.count(runtime.publish) == 0
+    conn = connect_to_db(location)
+    stock = dict(conn.execute('select participant_id, stock from positions'))
+    traded, = conn.execute('select count(*) from trades').fetchone()
+    assert traded > 0 and all(stock[bot.participant_id] == bot.stock for bot in traders)
+    assert runtime.quotes[DEFAULT_INSTRUMENT].levels == {side == 'buy': {level['price']: level['amount']
+                                                                         for level in levels}
+                                                         for side, levels in depth(conn).items()}
+    drop_book(conn)
+    conn.close()
+    summary = runtime.summary()
+    assert summary['MarketMaker']['orders'] > 0 and summary['NoiseTrader']['fills'] > 0
+    # Way over its budget, so it only gets a turn every now and then
+    assert summary['Hog']['skipped'] > summary['Hog']['turns'] > 0 and summary['Hog']['calls'] == 0
+
+
+def test_bench():
+    results = [bench.run(scenario, 'memory', 20) for scenario in bench.SCENARIOS if scenario != 'deep_book_100k']
+    assert all(result['orders_per_second'] > 0 and result['p50'] <= result['p99'] <= result['p999']
+               for result in results)
+    slower = [{**result, 'orders_per_second': result['orders_per_second'] / 2} for result in results]
+    assert bench.regressions(results, results, 0.1) == []
+    assert len(bench.regressions(slower, results, 0.1)) == len(results)
+
+
+def test_loadgen(tmp_path):
+    with socket.socket() as free:
+        free.bind(('127.0.0.1', 0))
+        port = free.getsockname()[1]
+    output = tmp_path / 'loadgen.json'
+    subprocess.run([sys.executable, 'loadgen.py', '--users', '4', '--duration', '1', '--port', str(port),
+                    '--mix', 'submit=3,cancel=1,depth=1', '--output', str(output)],
+                   cwd=os.path.dirname(os.path.abspath(__file__)), check=True, timeout=60)
+    routes = json.loads(output.read_text())['routes']
+    assert set(routes) == {'submit', 'cancel', 'depth'}
+    for stats in routes.values():
+        assert stats['requests'] > 0 and stats['errors'] == 0
+        assert stats['ok'] + stats['rejected'] + stats['rate_limited'] == pytest.approx(1)
+        assert sum(stats['histogram'].values()) == stats['requests'] and stats['p50'] <= stats['p99'] <= stats['max']
+    assert routes['depth']['ok'] + routes['depth']['rate_limited'] == pytest.approx(1)
+
+
+def test_metrics():
+    counter = metrics.Counter('test_total', 'Test.', ('kind',))
+    histogram = metrics.Histogram('test_seconds', 'Test.', buckets=(0.1, 1))
+
+    def record():
+        for value in (0.05, 0.1, 0.5, 5):
+            counter.inc('a')
+            histogram.observe(value)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.expose().splitlines()[-1] == 'test_total{kind="a"} 16'
+    assert list(histogram.samples()) == [
+        'test_seconds_bucket{le="0.1"} 8', 'test_seconds_bucket{le="1"} 12', 'test_seconds_bucket{le="+Inf"} 16',
+        'test_seconds_count 16', 'test_seconds_sum 22.6',
+    ]
+    gauge = metrics.Gauge('test_depth', 'Test.', ('side',), lambda: {('buy',): 2, ('sell',): 3})
+    assert gauge.merged() == {('buy',): 2, ('sell',): 3} and list(gauge.samples())[0] == 'test_depth{side="buy"} 2'
+    with pytest.raises(TypeError):
+        metrics.Metric('test', 'Test.')
+
+
+def test_sql_tracing(tmp_path):
+    location = str(tmp_path / 'test.db')
+    conn = create_db(location)
+    conn.execute('insert into accounts(participant_id, balance) values (0, 1000)')
+    conn.commit()
+    db_utils.enable_profiling()
+    worker = MatchingWorker(location, 'test')
+    try:
+        with db_utils.trace_request('test') as trace:
+            worker.submit(limit_order, participant_id=0, price=10, amount=1).result()
+    finally:
+        worker.close()
+        db_utils.enable_profiling(False)
+        drop_book(conn)
+        conn.close()
+    statements = [sql for sql, _ in trace.statements]
+    assert 'commit' in statements
+    assert any(sql.startswith('insert into exchange') for sql in statements)
+
+
 @pytest.fixture
 def orderbook():
     conn = create_db(':memory:')
@@ -189,12 +975,21 @@ def orderbook():
     conn.close()
 
 
-def insert_accounts(book: sqlite3.Cursor, accounts: list[dict]):
-    book.executemany('insert into accounts(participant_id, balance, stock) values(:participant_id, :balance, 10)',
-                     accounts)
+def insert_accounts(book: sqlite3.Cursor, accounts: list[dict], instrument: str = DEFAULT_INSTRUMENT):
+    book.executemany('insert into accounts(participant_id, balance) values(:participant_id, :balance)', accounts)
+    book.executemany(
+        'insert into positions(participant_id, instrument, stock) values(:participant_id, :instrument, 10)',
+        [{**account, 'instrument': instrument} for account in accounts]
+    )
 
 
-def read(book: sqlite3.Cursor) -> tuple[list[dict], list[dict]]:
-    exchange = query(book, 'select * from exchange')
-    accounts = query(book, 'select * from accounts')
+def read(book: sqlite3.Cursor, instrument: str = DEFAULT_INSTRUMENT) -> tuple[list[dict], list[dict]]:
+    exchange = query(book, 'select participant_id, price, amount, logical_timestamp from exchange where instrument=?',
+                     (instrument,))
+    accounts = query(
+        book,
+        'select accounts.participant_id, balance, coalesce(stock, 0) as stock from accounts '
+        'left join positions on positions.participant_id=accounts.participant_id and instrument=?',
+        (instrument,)
+    )
     return exchange, accounts
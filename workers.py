@@ -0,0 +1,88 @@
+from concurrent.futures import Future
+import contextvars
+import os
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+from db_utils import connect_to_db
+import capture
+
+
+class MatchingWorker:
+    """
+    Runs engine calls one at a time, in the order they were submitted, on its own thread with its own connection.
+    get_worker gives every instrument its own, so a flood of orders in one instrument only has to wait for itself,
+    and orders in other instruments keep getting their turn at the database in between.
+    """
+
+    def __init__(self, location: str, name: str):
+        self.location = location
+        self.name = name
+        self.jobs = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=f'matching-{name}', daemon=True)
+        self.thread.start()
+
+    def submit(self, func: Callable, **kwargs) -> Future:
+        """
+        Call func(cursor, **kwargs) on the worker thread. It's up to the caller to only submit one instrument.
+        It runs in the caller's context, so profiling counts its statements towards the caller's request.
+        """
+        future = Future()
+        self.jobs.put((func, kwargs, future, contextvars.copy_context(), time.time()))
+        return future
+
+    def _run(self):
+        conn = connect_to_db(self.location)
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                func, kwargs, future, context, arrival = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(context.run(capture.run, func, conn.cursor(), arrival, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            conn.close()
+
+    def close(self):
+        self.closed = True
+        self.jobs.put(None)
+        self.thread.join()
+
+
+_workers: dict[tuple[str, Optional[str]], MatchingWorker] = {}
+_workers_lock = threading.Lock()
+
+
+def get_worker(instrument: str) -> MatchingWorker:
+    """
+    Worker for an instrument in the database at DB_LOCATION, started on first use.
+    If SEQUENCER_ADDRESS is set, every instrument goes through the sequencer process instead, see sequencer.py.
+    """
+    address = os.environ.get('SEQUENCER_ADDRESS')
+    with _workers_lock:
+        if address:
+            key = (address, None)
+            if key not in _workers or _workers[key].closed:
+                from sequencer import SequencerClient  # Not at the top, the sequencer runs MatchingWorkers itself
+
+                _workers[key] = SequencerClient(address, os.environ['SECRET_KEY'].encode())
+        else:
+            key = (os.environ.get('DB_LOCATION', ':memory:'), instrument)
+            if key not in _workers:
+                _workers[key] = MatchingWorker(*key)
+        return _workers[key]
+
+
+def close_workers():
+    with _workers_lock:
+        for worker in _workers.values():
+            worker.close()
+        _workers.clear()